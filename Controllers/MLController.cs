@@ -14,6 +14,7 @@ namespace TrafficAnalysisAPI.Controllers
     ///   - feature-selection: локальный силуэт на сессии
     ///   - flow-analyze:      модель (rf или catboost) на FlowMetrics
     ///   - compare:           A/B сравнение обеих моделей
+    ///   - flow-explain:      вклады признаков для подозрительных flows
     ///   - model-meta:        что внутри global_features.json / catboost_features.json
     /// </summary>
     [Route("api/[controller]")]
@@ -259,6 +260,58 @@ namespace TrafficAnalysisAPI.Controllers
             }
         }
 
+        // =====================================================================
+        // POST /api/ml/flow-explain?sessionId=X&model=rf|catboost&threshold=0.5&topK=10
+        // Почему flow помечен: вклады признаков для flows с proba >= threshold
+        // =====================================================================
+        [HttpPost("flow-explain")]
+        [ProducesResponseType(StatusCodes.Status200OK)]
+        [ProducesResponseType(StatusCodes.Status400BadRequest)]
+        public async Task<IActionResult> FlowExplain(
+            [FromQuery] int sessionId,
+            [FromQuery] string model = "rf",
+            [FromQuery] double threshold = 0.5,
+            [FromQuery] int topK = 10)
+        {
+            var modelLower = (model ?? "rf").ToLower();
+            if (modelLower != "rf" && modelLower != "catboost")
+                return BadRequest(new { message = "model должно быть 'rf' или 'catboost'" });
+
+            var sw = Stopwatch.StartNew();
+
+            var flows = await _context.FlowMetrics
+                .AsNoTracking()
+                .Where(f => f.SessionId == sessionId)
+                .ToListAsync();
+
+            if (flows.Count == 0)
+                return BadRequest(new
+                {
+                    message = $"Сессия {sessionId} не содержит flow-метрик."
+                });
+
+            try
+            {
+                string resultJson = _pythonML.ExplainFlows(flows, modelLower, threshold, topK);
+                sw.Stop();
+
+                _logger.LogInformation(
+                    $"[FlowExplain-{modelLower}] session={sessionId}, flows={flows.Count}, " +
+                    $"{sw.ElapsedMilliseconds}ms");
+
+                return Content(resultJson, "application/json");
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, $"[FlowExplain-{modelLower}] Error");
+                return StatusCode(500, new
+                {
+                    message = $"Ошибка объяснения ({modelLower})",
+                    error = ex.Message,
+                });
+            }
+        }
+
         // =====================================================================
         // POST /api/ml/compare?sessionId=X
         // Запускает обе модели и возвращает их предсказания рядом + метрики сравнения
@@ -284,22 +337,25 @@ namespace TrafficAnalysisAPI.Controllers
 
             try
             {
-                // RF
-                var swRf = Stopwatch.StartNew();
-                var rfPredictions = _pythonML.PredictFlowsBatch(flows, "rf");
-                swRf.Stop();
-
-                // CatBoost
-                var swCb = Stopwatch.StartNew();
-                var cbPredictions = _pythonML.PredictFlowsBatch(flows, "catboost");
-                swCb.Stop();
+                // Обе модели за один вызов: общая матрица, scaler и IsolationForest
+                var joint = _pythonML.PredictCompare(flows);
+                var rfPredictions = joint.Rf;
+                var cbPredictions = joint.CatBoost;
+
+                // Время модели = общие стадии + свой predict (IsolationForest
+                // входит в "rf"/"catBoost"); стадии — timingsMs из model_compare.py
+                double Stage(string name) =>
+                    joint.TimingsMs.TryGetValue(name, out var ms) ? ms : 0.0;
+                var sharedMs = Stage("parse") + Stage("allowlist") + Stage("matrix")
+                               + Stage("scale") + Stage("format");
+                var rfMs = (long)Math.Round(sharedMs + Stage("rf"));
+                var cbMs = (long)Math.Round(sharedMs + Stage("catBoost"));
 
                 // Сопоставляем по FlowId
                 var rfMap = rfPredictions.ToDictionary(p => p.FlowId);
                 var cbMap = cbPredictions.ToDictionary(p => p.FlowId);
 
                 var sideBySide = new List<FlowComparisonRowDto>();
-                int agreeAttack = 0, agreeNorm = 0, disagree = 0;
 
                 foreach (var flow in flows)
                 {
@@ -309,10 +365,6 @@ namespace TrafficAnalysisAPI.Controllers
                     bool rfAttack = rf?.IsAttack ?? false;
                     bool cbAttack = cb?.IsAttack ?? false;
 
-                    if (rfAttack && cbAttack) agreeAttack++;
-                    else if (!rfAttack && !cbAttack) agreeNorm++;
-                    else disagree++;
-
                     sideBySide.Add(new FlowComparisonRowDto
                     {
                         FlowId = flow.Id,
@@ -343,32 +395,25 @@ namespace TrafficAnalysisAPI.Controllers
                     RfModel = new ModelSummaryDto
                     {
                         AttackFlows = rfPredictions.Count(p => p.IsAttack),
-                        ElapsedMs = swRf.ElapsedMilliseconds,
+                        ElapsedMs = rfMs,
                         Features = rfMeta?.FeatureNames ?? new(),
                         Metrics = rfMeta?.Metrics,
                     },
                     CatBoostModel = new ModelSummaryDto
                     {
                         AttackFlows = cbPredictions.Count(p => p.IsAttack),
-                        ElapsedMs = swCb.ElapsedMilliseconds,
+                        ElapsedMs = cbMs,
                         Features = cbMeta?.FeatureNames ?? new(),
                         Metrics = cbMeta?.Metrics,
                     },
-                    Agreement = new AgreementStatsDto
-                    {
-                        BothAttack = agreeAttack,
-                        BothNormal = agreeNorm,
-                        Disagree = disagree,
-                        AgreementRate = flows.Count > 0
-                            ? (double)(agreeAttack + agreeNorm) / flows.Count
-                            : 0.0,
-                    },
+                    // Согласие посчитано в Python (NumPy) по тем же isAttack
+                    Agreement = joint.Agreement,
                     Comparison = sideBySide,
                 };
 
                 _logger.LogInformation(
-                    $"[Compare] RF: {result.RfModel.AttackFlows}atk/{swRf.ElapsedMilliseconds}ms, " +
-                    $"CB: {result.CatBoostModel.AttackFlows}atk/{swCb.ElapsedMilliseconds}ms, " +
+                    $"[Compare] RF: {result.RfModel.AttackFlows}atk/{rfMs}ms, " +
+                    $"CB: {result.CatBoostModel.AttackFlows}atk/{cbMs}ms, " +
                     $"agreement={result.Agreement.AgreementRate:P1}");
 
                 return Ok(result);
@@ -3,6 +3,7 @@ using Microsoft.AspNetCore.Mvc;
 using Microsoft.EntityFrameworkCore;
 using System.Diagnostics;
 using System.Text.Json;
+using System.Text.RegularExpressions;
 using TrafficAnalysisAPI.Data;
 using TrafficAnalysisAPI.Services.Interfaces;
 
@@ -15,8 +16,13 @@ namespace TrafficAnalysisAPI.Controllers
     ///
     /// Два режима:
     ///   POST /api/similarity/find         — поиск top-K похожих на target flow
+    ///   POST /api/similarity/find-multi   — то же для списка target (кластер алертов)
     ///   POST /api/similarity/knn-classify — kNN-классификация всех flows
     ///                                       (альтернативный детектор атак)
+    ///
+    /// Поиск по всем сессиям (персистентный индекс, similarity_index.py):
+    ///   POST /api/similarity/index        — добавить / переиндексировать сессию
+    ///   POST /api/similarity/find-global  — top-K похожих по всему индексу
     /// </summary>
     [Route("api/[controller]")]
     [ApiController]
@@ -27,6 +33,10 @@ namespace TrafficAnalysisAPI.Controllers
         private readonly IPythonMLService _pythonML;
         private readonly ILogger<SimilarityController> _logger;
 
+        // Имя набора прототипов — каталог в хранилище Python, без путей
+        private static readonly Regex PrototypeNameRegex =
+            new Regex("^[A-Za-z0-9_-]{1,64}$", RegexOptions.Compiled);
+
         public SimilarityController(
             ApplicationDbContext context,
             IPythonMLService pythonML,
@@ -79,7 +89,7 @@ namespace TrafficAnalysisAPI.Controllers
                     });
 
                 string resultJson = _pythonML.FindSimilarFlows(
-                    flows, targetFlowId, w1, w2, w3, k);
+                    flows, targetFlowId, w1, w2, w3, k, searchSessionId);
 
                 stopwatch.Stop();
 
@@ -105,6 +115,77 @@ namespace TrafficAnalysisAPI.Controllers
             }
         }
 
+        /// <summary>
+        /// POST /api/similarity/find-multi?targetFlowIds=1&amp;targetFlowIds=2&amp;w1=0.10&amp;w2=0.60&amp;w3=0.30&amp;k=10[&amp;sessionId=X]
+        /// Топ-K похожих для каждого target за один вызов. Без sessionId
+        /// поиск идёт в сессии первого найденного target.
+        /// </summary>
+        [HttpPost("find-multi")]
+        public async Task<IActionResult> FindSimilarMulti(
+            [FromQuery] List<int> targetFlowIds,
+            [FromQuery] double w1 = 0.10,
+            [FromQuery] double w2 = 0.60,
+            [FromQuery] double w3 = 0.30,
+            [FromQuery] int k = 10,
+            [FromQuery] int? sessionId = null)
+        {
+            if (targetFlowIds == null || targetFlowIds.Count == 0)
+                return BadRequest(new { message = "Нужен хотя бы один targetFlowIds" });
+            if (k < 1 || k > 100)
+                return BadRequest(new { message = "k должен быть от 1 до 100" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                int? searchSessionId = sessionId;
+                if (searchSessionId == null)
+                {
+                    var first = await _context.FlowMetrics
+                        .FirstOrDefaultAsync(f => targetFlowIds.Contains(f.Id));
+                    if (first == null)
+                        return NotFound(new { message = "Ни один из target flows не найден" });
+                    searchSessionId = first.SessionId;
+                }
+
+                var flows = await _context.FlowMetrics
+                    .Where(f => f.SessionId == searchSessionId)
+                    .ToListAsync();
+
+                if (flows.Count < 2)
+                    return Ok(new
+                    {
+                        message = "Недостаточно flows в сессии (минимум 2)",
+                        targets = Array.Empty<object>(),
+                    });
+
+                string resultJson = _pythonML.FindSimilarFlowsMulti(
+                    flows, targetFlowIds, w1, w2, w3, k, searchSessionId);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(resultJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = searchSessionId;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[Similarity] find-multi: targets={targetFlowIds.Count}, k={k}, " +
+                    $"elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[Similarity] find-multi error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка расчёта сходства",
+                    error = ex.Message
+                });
+            }
+        }
+
         // ============================================================
         // РЕЖИМ 2: kNN-классификация (детектор на мере сходства)
         // ============================================================
@@ -159,7 +240,7 @@ namespace TrafficAnalysisAPI.Controllers
                     $"[kNN-Sim] Step 2: kNN classification (k={k})");
 
                 string knnJson = _pythonML.KnnClassifyFlows(
-                    flows, labelsByFlowId, w1, w2, w3, k);
+                    flows, labelsByFlowId, w1, w2, w3, k, sessionId);
 
                 stopwatch.Stop();
 
@@ -186,9 +267,499 @@ namespace TrafficAnalysisAPI.Controllers
             }
         }
 
+        /// <summary>
+        /// POST /api/similarity/knn-classify-incremental?sessionId=X&amp;afterFlowId=Y&amp;w1=0.10&amp;w2=0.60&amp;w3=0.30&amp;k=5&amp;model=rf
+        /// kNN-классификация при дозаписи flows в сессию (живой захват,
+        /// импорт по частям). С afterFlowId метки ML считаются и в Python
+        /// передаются только flows с Id &gt; afterFlowId; без него — вся
+        /// сессия (известные Python flows пропускаются). Если Python не
+        /// помнит сессию (перезапуск, вытеснение), он отвечает
+        /// sessionStateMissing — тогда передаётся вся сессия. В ответе —
+        /// предсказания только изменившихся flows и lastFlowId для
+        /// следующего вызова. refresh=true — полный пересчёт.
+        /// </summary>
+        [HttpPost("knn-classify-incremental")]
+        public async Task<IActionResult> KnnClassifyIncremental(
+            [FromQuery] int sessionId,
+            [FromQuery] int? afterFlowId = null,
+            [FromQuery] double w1 = 0.10,
+            [FromQuery] double w2 = 0.60,
+            [FromQuery] double w3 = 0.30,
+            [FromQuery] int k = 5,
+            [FromQuery] bool refresh = false,
+            [FromQuery] string model = "rf")
+        {
+            if (k < 1 || k > 50)
+                return BadRequest(new { message = "k должен быть от 1 до 50" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var (flows, labelsByFlowId) = await LoadIncrementalFlows(sessionId, afterFlowId, model);
+                string knnJson = _pythonML.KnnClassifyIncremental(
+                    flows, labelsByFlowId, w1, w2, w3, k, sessionId, refresh,
+                    isDelta: afterFlowId.HasValue);
+
+                if (afterFlowId.HasValue && IsSessionStateMissing(knnJson))
+                {
+                    // kNN по одной новой порции был бы неверным — передаём всю сессию
+                    _logger.LogWarning(
+                        $"[kNN-Sim] Python has no state for session {sessionId}, resending all flows");
+                    (flows, labelsByFlowId) = await LoadIncrementalFlows(sessionId, null, model);
+                    knnJson = _pythonML.KnnClassifyIncremental(
+                        flows, labelsByFlowId, w1, w2, w3, k, sessionId, refresh);
+                }
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(knnJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = sessionId;
+                responseDict["lastFlowId"] = flows.Count > 0 ? flows[^1].Id : afterFlowId;
+                responseDict["modelUsedAsGroundTruth"] = model;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[kNN-Sim] Incremental done: {flows.Count} new flows, elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] incremental error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка инкрементальной kNN-классификации",
+                    error = ex.Message
+                });
+            }
+        }
+
+        // ============================================================
+        // РЕЖИМ 3: подбор весов kNN
+        // ============================================================
+        /// <summary>
+        /// POST /api/similarity/sweep-weights?sessionId=X&amp;gridStep=0.1&amp;kValues=3&amp;kValues=5&amp;model=rf
+        /// Метки ML-модели, как в knn-classify, затем agreement/F1 kNN для
+        /// всей сетки весов (симплекс с шагом gridStep) и всех k за один
+        /// вызов Python — вместо десятков вызовов knn-classify.
+        /// </summary>
+        [HttpPost("sweep-weights")]
+        public async Task<IActionResult> SweepWeights(
+            [FromQuery] int sessionId,
+            [FromQuery] List<int> kValues,
+            [FromQuery] double gridStep = 0.1,
+            [FromQuery] string model = "rf")
+        {
+            if (kValues == null || kValues.Count == 0)
+                kValues = new List<int> { 5 };
+            if (kValues.Any(k => k < 1 || k > 50))
+                return BadRequest(new { message = "k должен быть от 1 до 50" });
+            if (gridStep < 0.01 || gridStep > 1.0)
+                return BadRequest(new { message = "gridStep должен быть от 0.01 до 1" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var flows = await _context.FlowMetrics
+                    .Where(f => f.SessionId == sessionId)
+                    .ToListAsync();
+
+                int kMax = kValues.Max();
+                if (flows.Count < kMax + 1)
+                    return BadRequest(new
+                    {
+                        message = $"В сессии {flows.Count} flows, требуется хотя бы {kMax + 1}"
+                    });
+
+                var mlPredictions = _pythonML.PredictFlowsBatch(flows, model);
+                var labelsByFlowId = new Dictionary<int, bool>();
+                for (int i = 0; i < flows.Count && i < mlPredictions.Count; i++)
+                {
+                    labelsByFlowId[flows[i].Id] = mlPredictions[i].IsAttack;
+                }
+
+                string sweepJson = _pythonML.SweepWeights(
+                    flows, labelsByFlowId, kValues, gridStep, sessionId);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(sweepJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = sessionId;
+                responseDict["modelUsedAsGroundTruth"] = model;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[kNN-Sim] Sweep done: {flows.Count} flows, elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] sweep error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка подбора весов kNN",
+                    error = ex.Message
+                });
+            }
+        }
+
+        // ============================================================
+        // ПРОТОТИПЫ kNN
+        // ============================================================
+        /// <summary>
+        /// POST /api/similarity/prototypes/build?sessionId=X&amp;name=default&amp;method=kmedoids&amp;perClass=50&amp;k=1&amp;model=rf
+        /// Метки ML-модели, как в knn-classify, затем отбор прототипов
+        /// каждого класса (kmedoids или cnn) и сохранение набора name.
+        /// В ответе — согласие kNN по прототипам с полным kNN и время обоих.
+        /// </summary>
+        [HttpPost("prototypes/build")]
+        public async Task<IActionResult> BuildPrototypes(
+            [FromQuery] int sessionId,
+            [FromQuery] string name = "default",
+            [FromQuery] string method = "kmedoids",
+            [FromQuery] int perClass = 50,
+            [FromQuery] double w1 = 0.10,
+            [FromQuery] double w2 = 0.60,
+            [FromQuery] double w3 = 0.30,
+            [FromQuery] int k = 1,
+            [FromQuery] string model = "rf")
+        {
+            if (k < 1 || k > 50)
+                return BadRequest(new { message = "k должен быть от 1 до 50" });
+            if (perClass < 1 || perClass > 2000)
+                return BadRequest(new { message = "perClass должен быть от 1 до 2000" });
+            if (method != "kmedoids" && method != "cnn")
+                return BadRequest(new { message = "method: kmedoids или cnn" });
+            if (!PrototypeNameRegex.IsMatch(name))
+                return BadRequest(new { message = "name: только A-Z, a-z, 0-9, _ и - (до 64 символов)" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var flows = await _context.FlowMetrics
+                    .Where(f => f.SessionId == sessionId)
+                    .ToListAsync();
+
+                // + сравнение с полным kNN (k=5) в similarity_prototypes
+                int minFlows = Math.Max(k, 5) + 1;
+                if (flows.Count < minFlows)
+                    return BadRequest(new
+                    {
+                        message = $"В сессии {flows.Count} flows, требуется хотя бы {minFlows}"
+                    });
+
+                var mlPredictions = _pythonML.PredictFlowsBatch(flows, model);
+                var labelsByFlowId = new Dictionary<int, bool>();
+                for (int i = 0; i < flows.Count && i < mlPredictions.Count; i++)
+                {
+                    labelsByFlowId[flows[i].Id] = mlPredictions[i].IsAttack;
+                }
+
+                string buildJson = _pythonML.BuildPrototypes(
+                    flows, labelsByFlowId, w1, w2, w3, name, method, perClass, k);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(buildJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = sessionId;
+                responseDict["modelUsedAsGroundTruth"] = model;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[kNN-Sim] Prototypes '{name}' built from {flows.Count} flows, elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] prototype build error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка отбора прототипов",
+                    error = ex.Message
+                });
+            }
+        }
+
+        /// <summary>
+        /// POST /api/similarity/prototypes/classify?sessionId=X&amp;name=default&amp;model=rf
+        /// kNN-классификация flows сессии по сохранённым прототипам.
+        /// С model — ещё и agreement с метками этой ML-модели.
+        /// </summary>
+        [HttpPost("prototypes/classify")]
+        public async Task<IActionResult> ClassifyWithPrototypes(
+            [FromQuery] int sessionId,
+            [FromQuery] string name = "default",
+            [FromQuery] string? model = null)
+        {
+            if (!PrototypeNameRegex.IsMatch(name))
+                return BadRequest(new { message = "name: только A-Z, a-z, 0-9, _ и - (до 64 символов)" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var flows = await _context.FlowMetrics
+                    .Where(f => f.SessionId == sessionId)
+                    .ToListAsync();
+
+                if (flows.Count == 0)
+                    return NotFound(new { message = $"В сессии {sessionId} нет flows" });
+
+                Dictionary<int, bool>? labelsByFlowId = null;
+                if (!string.IsNullOrEmpty(model))
+                {
+                    var mlPredictions = _pythonML.PredictFlowsBatch(flows, model);
+                    labelsByFlowId = new Dictionary<int, bool>();
+                    for (int i = 0; i < flows.Count && i < mlPredictions.Count; i++)
+                    {
+                        labelsByFlowId[flows[i].Id] = mlPredictions[i].IsAttack;
+                    }
+                }
+
+                string resultJson = _pythonML.ClassifyWithPrototypes(flows, name, labelsByFlowId);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(resultJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = sessionId;
+                if (!string.IsNullOrEmpty(model))
+                    responseDict["modelUsedAsGroundTruth"] = model;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] prototype classify error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка классификации по прототипам",
+                    error = ex.Message
+                });
+            }
+        }
+
+        // ============================================================
+        // КЛАСТЕРЫ: граф сходства flows («кампании»)
+        // ============================================================
+        /// <summary>
+        /// POST /api/similarity/clusters?sessionId=X&amp;k=10&amp;tau=0.75&amp;method=louvain&amp;edges=auto&amp;model=rf
+        /// Группы взаимно похожих flows сессии: граф k ближайших соседей
+        /// с sim ≥ tau, компоненты связности или сообщества Louvain.
+        /// Доля атак по кластерам — по меткам ML-модели model.
+        /// </summary>
+        [HttpPost("clusters")]
+        public async Task<IActionResult> ClusterFlows(
+            [FromQuery] int sessionId,
+            [FromQuery] double w1 = 0.10,
+            [FromQuery] double w2 = 0.60,
+            [FromQuery] double w3 = 0.30,
+            [FromQuery] int k = 10,
+            [FromQuery] double tau = 0.75,
+            [FromQuery] string method = "louvain",
+            [FromQuery] string edges = "auto",
+            [FromQuery] string model = "rf")
+        {
+            if (k < 1 || k > 50)
+                return BadRequest(new { message = "k должен быть от 1 до 50" });
+            if (tau < 0 || tau > 1)
+                return BadRequest(new { message = "tau должен быть от 0 до 1" });
+            if (method != "louvain" && method != "components")
+                return BadRequest(new { message = "method: louvain или components" });
+            if (edges != "auto" && edges != "exact" && edges != "lsh")
+                return BadRequest(new { message = "edges: auto, exact или lsh" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var flows = await _context.FlowMetrics
+                    .Where(f => f.SessionId == sessionId)
+                    .ToListAsync();
+
+                if (flows.Count < 2)
+                    return BadRequest(new
+                    {
+                        message = $"В сессии {flows.Count} flows, требуется хотя бы 2"
+                    });
+
+                var mlPredictions = _pythonML.PredictFlowsBatch(flows, model);
+                var labelsByFlowId = new Dictionary<int, bool>();
+                for (int i = 0; i < flows.Count && i < mlPredictions.Count; i++)
+                {
+                    labelsByFlowId[flows[i].Id] = mlPredictions[i].IsAttack;
+                }
+
+                string clustersJson = _pythonML.ClusterSimilarityGraph(
+                    flows, labelsByFlowId, w1, w2, w3, k, tau, method, edges, sessionId);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(clustersJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = sessionId;
+                responseDict["modelUsedAsGroundTruth"] = model;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[kNN-Sim] Clusters done: {flows.Count} flows, elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] clustering error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка кластеризации по графу сходства",
+                    error = ex.Message
+                });
+            }
+        }
+
+        // ============================================================
+        // ИНДЕКС: добавление сессии
+        // ============================================================
+        /// <summary>
+        /// POST /api/similarity/index?sessionId=X
+        /// Добавляет flows сессии в персистентный индекс сходства
+        /// (повторный вызов переиндексирует сессию).
+        /// </summary>
+        [HttpPost("index")]
+        public async Task<IActionResult> IndexSession([FromQuery] int sessionId)
+        {
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var flows = await _context.FlowMetrics
+                    .Where(f => f.SessionId == sessionId)
+                    .ToListAsync();
+
+                if (flows.Count == 0)
+                    return NotFound(new { message = $"В сессии {sessionId} нет flows" });
+
+                string resultJson = _pythonML.IndexSessionFlows(flows, sessionId);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(resultJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["sessionId"] = sessionId;
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[SimilarityIndex] session={sessionId}, flows={flows.Count}, " +
+                    $"elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[SimilarityIndex] index error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка индексации сессии",
+                    error = ex.Message
+                });
+            }
+        }
+
+        // ============================================================
+        // ИНДЕКС: поиск похожих по всем сессиям
+        // ============================================================
+        /// <summary>
+        /// POST /api/similarity/find-global?targetFlowId=Y&amp;w1=0.10&amp;w2=0.60&amp;w3=0.30&amp;k=10
+        /// Находит топ-K flows, похожих на target, среди всех проиндексированных сессий.
+        /// </summary>
+        [HttpPost("find-global")]
+        public async Task<IActionResult> FindSimilarGlobal(
+            [FromQuery] int targetFlowId,
+            [FromQuery] double w1 = 0.10,
+            [FromQuery] double w2 = 0.60,
+            [FromQuery] double w3 = 0.30,
+            [FromQuery] int k = 10)
+        {
+            if (k < 1 || k > 100)
+                return BadRequest(new { message = "k должен быть от 1 до 100" });
+
+            var stopwatch = Stopwatch.StartNew();
+
+            try
+            {
+                var target = await _context.FlowMetrics
+                    .FirstOrDefaultAsync(f => f.Id == targetFlowId);
+                if (target == null)
+                    return NotFound(new { message = $"Flow #{targetFlowId} не найден" });
+
+                string resultJson = _pythonML.FindSimilarInIndex(target, w1, w2, w3, k);
+
+                stopwatch.Stop();
+
+                using var doc = JsonDocument.Parse(resultJson);
+                var responseDict = JsonElementToDict(doc.RootElement);
+                responseDict["elapsedMs"] = stopwatch.ElapsedMilliseconds;
+
+                _logger.LogInformation(
+                    $"[SimilarityIndex] find-global: target={targetFlowId}, k={k}, " +
+                    $"elapsed={stopwatch.ElapsedMilliseconds}ms");
+
+                return Ok(responseDict);
+            }
+            catch (Exception ex)
+            {
+                _logger.LogError(ex, "[SimilarityIndex] find-global error");
+                return StatusCode(500, new
+                {
+                    message = "Ошибка поиска по индексу сходства",
+                    error = ex.Message
+                });
+            }
+        }
+
         // ============================================================
         // Helper: парсинг JsonElement в Dictionary рекурсивно
         // ============================================================
+        /// <summary>
+        /// Flows сессии (только Id &gt; afterFlowId, если задан) и метки ML-модели для них.
+        /// </summary>
+        private async Task<(List<TrafficAnalysisAPI.Models.FlowMetrics> Flows, Dictionary<int, bool> Labels)>
+            LoadIncrementalFlows(int sessionId, int? afterFlowId, string model)
+        {
+            var query = _context.FlowMetrics.Where(f => f.SessionId == sessionId);
+            if (afterFlowId.HasValue)
+                query = query.Where(f => f.Id > afterFlowId.Value);
+            var flows = await query.OrderBy(f => f.Id).ToListAsync();
+
+            var labelsByFlowId = new Dictionary<int, bool>();
+            if (flows.Count > 0)
+            {
+                var mlPredictions = _pythonML.PredictFlowsBatch(flows, model);
+                for (int i = 0; i < flows.Count && i < mlPredictions.Count; i++)
+                {
+                    labelsByFlowId[flows[i].Id] = mlPredictions[i].IsAttack;
+                }
+            }
+            return (flows, labelsByFlowId);
+        }
+
+        private static bool IsSessionStateMissing(string knnJson)
+        {
+            using var doc = JsonDocument.Parse(knnJson);
+            return doc.RootElement.ValueKind == JsonValueKind.Object
+                && doc.RootElement.TryGetProperty("sessionStateMissing", out var missing)
+                && missing.ValueKind == JsonValueKind.True;
+        }
+
         private static Dictionary<string, object> JsonElementToDict(JsonElement elem)
         {
             var dict = new Dictionary<string, object>();
@@ -21,7 +21,7 @@
         /// <summary>Low / Medium / High / Critical</summary>
         public string ThreatLevel { get; set; } = "Low";
 
-        /// <summary>supervised / unsupervised / both / none</summary>
+        /// <summary>supervised / unsupervised / both / none / allowlist</summary>
         public string Method { get; set; } = "none";
 
         /// <summary>0 = норма, 1 = атака (только RF)</summary>
@@ -54,6 +54,34 @@
         public double AgreementRate { get; set; }
     }
 
+    /// <summary>
+    /// Ответ Python model_compare.predict_compare: предсказания обеих моделей,
+    /// посчитанные за один проход (общая матрица; scaler и IsolationForest —
+    /// если совпадают), с allow-list и каскадом каждой модели, как в flow-analyze,
+    /// статистика согласия и время по стадиям.
+    /// </summary>
+    public class JointPredictionResultDto
+    {
+        public List<FlowMLPredictionDto> Rf { get; set; } = new();
+        public List<FlowMLPredictionDto> CatBoost { get; set; } = new();
+        public AgreementStatsDto Agreement { get; set; } = new();
+
+        /// <summary>Совпала ли предобработка (скейлинг выполнен один раз)</summary>
+        public bool SharedPreprocessing { get; set; }
+
+        /// <summary>Один и тот же IsolationForest у обеих моделей (и без каскада) — IF выполнен один раз</summary>
+        public bool SharedAnomalyDetector { get; set; }
+
+        /// <summary>Сколько flows попало в allow-list каждой модели: rf, catBoost</summary>
+        public Dictionary<string, int> Allowlisted { get; set; } = new();
+
+        /// <summary>Включён ли каскад у модели: rf, catBoost</summary>
+        public Dictionary<string, bool> Cascade { get; set; } = new();
+
+        /// <summary>Время стадий в мс: parse, allowlist, matrix, scale, rf, catBoost, format</summary>
+        public Dictionary<string, double> TimingsMs { get; set; } = new();
+    }
+
     /// <summary>Попарное сравнение предсказаний на одном flow.</summary>
     public class FlowComparisonRowDto
     {
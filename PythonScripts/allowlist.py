@@ -0,0 +1,293 @@
+"""
+PythonScripts/allowlist.py
+
+Allow-list («быстрая полоса» для заведомо легитимного трафика) перед
+моделью в predict_items.
+
+Зачем:
+  Большая доля flows — DNS к корпоративным резолверам, NTP, известные
+  бэкапы — всё равно в белом списке, но каждый проходил сборку матрицы
+  признаков, RF/CatBoost и IsolationForest. Здесь такие flows
+  отсекаются до модели и получают method='allowlist'.
+
+Правила (JSON, список или {"rules": [...]}):
+  [
+    {"name": "dns-resolvers", "destination": ["10.0.0.53/32", "10.0.1.53"],
+     "ports": [53], "protocol": "UDP"},
+    {"name": "ntp", "destination": ["10.0.0.0/8"], "ports": [123], "protocol": "UDP"},
+    {"name": "backup", "destination": ["10.9.9.0/24"], "ports": ["8400-8403"],
+     "protocol": "TCP"}
+  ]
+  destination — IPv4 CIDR (без маски — /32); ports — номера или диапазоны
+  "a-b" (нет ключа — любой порт); protocol — имя (TCP/UDP/ICMP), номер
+  или "*" (нет ключа — любой).
+
+Как компилируется (один раз, при загрузке):
+  - для каждого протокола — массив group[65536]: порт -> id группы
+    правил, покрывающих этот порт (-1 — ни одного);
+  - CIDR каждой группы сливаются в непересекающиеся интервалы и кодируются
+    в uint64 как (group << 32) | ip — все группы лежат в ОДНОМ
+    отсортированном массиве, проверка батча — один np.searchsorted.
+  Для N flows: O(N) на разбор IP/портов + O(N log R) на поиск.
+
+Подключение: HybridIDS / CatBoostIDS.load() подхватывают allowlist.json
+рядом с моделью (или путь из IDS_ALLOWLIST); вручную —
+model.enable_allowlist(path_or_rules), статистика — model.allowlist_stats().
+"""
+
+import ipaddress
+import json
+import os
+import socket
+import struct
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+from profiling import NULL_TIMER
+
+
+ALLOWLIST_FILE = 'allowlist.json'
+
+N_PORTS = 65536
+ANY_PROTOCOL = -1
+
+_PROTOCOL_NUMBERS = {'ICMP': 1, 'TCP': 6, 'UDP': 17, 'ICMPV6': 58, 'SCTP': 132}
+
+# 'stage' ответа для flow из allow-list в режиме каскада: ступени модели — 1 и 2
+ALLOWLIST_STAGE = -1
+
+# Memo разбора IP-строк: в трафике адреса сильно повторяются
+_IP_MEMO_MAX = 200_000
+
+
+def protocol_number(value) -> int:
+    """'TCP' / 'tcp' / 6 / '6' -> 6; пусто или неизвестно -> -2 (не совпадёт ни с чем)."""
+    if value is None or value == '':
+        return -2
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    text = str(value).strip().upper()
+    if text.isdigit():
+        return int(text)
+    return _PROTOCOL_NUMBERS.get(text, -2)
+
+
+def _parse_ports(ports) -> np.ndarray:
+    """[53, "8400-8403"] -> bool-маска на 65536 портов; None -> все порты."""
+    mask = np.zeros(N_PORTS, dtype=bool)
+    if ports is None:
+        mask[:] = True
+        return mask
+    for p in ports if isinstance(ports, (list, tuple)) else [ports]:
+        lo, _, hi = str(p).partition('-')
+        lo = int(lo)
+        hi = int(hi) if hi else lo
+        if not 0 <= lo <= hi < N_PORTS:
+            raise ValueError(f"Некорректный порт/диапазон: {p}")
+        mask[lo:hi + 1] = True
+    return mask
+
+
+def _merge_intervals(intervals: List[tuple]) -> List[tuple]:
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+class Allowlist:
+    """Скомпилированные правила + счётчики пропущенных мимо модели строк."""
+
+    def __init__(self, rules: List[Dict], source: str = None):
+        self.rules = [dict(r) for r in rules]
+        self.source = source
+        self._ip_memo: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.rows_seen = 0
+        self.rows_allowed = 0
+        self._compile()
+
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_file(cls, path: str) -> 'Allowlist':
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        rules = data.get('rules', []) if isinstance(data, dict) else data
+        return cls(rules, source=os.path.abspath(path))
+
+    @classmethod
+    def for_model(cls, model_path: str):
+        """allowlist.json рядом с моделью (или IDS_ALLOWLIST); нет файла — None."""
+        path = os.environ.get('IDS_ALLOWLIST') or os.path.join(
+            os.path.dirname(os.path.abspath(model_path)), ALLOWLIST_FILE)
+        if not os.path.exists(path):
+            return None
+        allowlist = cls.from_file(path)
+        print(f"[Allowlist] {len(allowlist.rules)} правил из {path}")
+        return allowlist
+
+    def _compile(self):
+        # Протокол правила -> список (маска портов, интервалы IP)
+        by_protocol: Dict[int, List[tuple]] = {}
+        for rule in self.rules:
+            destinations = rule.get('destination')
+            if not destinations:
+                raise ValueError(f"Правило {rule.get('name', '?')}: нужен destination (CIDR)")
+            if isinstance(destinations, str):
+                destinations = [destinations]
+            intervals = []
+            for cidr in destinations:
+                net = ipaddress.ip_network(str(cidr).strip(), strict=False)
+                if net.version != 4:
+                    raise ValueError(f"Правило {rule.get('name', '?')}: поддерживается только IPv4 ({cidr})")
+                intervals.append((int(net.network_address), int(net.broadcast_address)))
+
+            protocol = rule.get('protocol', '*')
+            proto = ANY_PROTOCOL if protocol in (None, '*', '') else protocol_number(protocol)
+            if proto == -2:
+                raise ValueError(f"Правило {rule.get('name', '?')}: неизвестный протокол {protocol}")
+            by_protocol.setdefault(proto, []).append((_parse_ports(rule.get('ports')), intervals))
+
+        # Группа = набор правил, покрывающих порт. Подпись порта — упакованные
+        # биты «правило i покрывает порт»; одинаковые подписи -> одна группа.
+        self._port_groups: Dict[int, np.ndarray] = {}
+        starts, ends = [], []
+        n_groups = 0
+        for proto, proto_rules in by_protocol.items():
+            covered = np.stack([mask for mask, _ in proto_rules])          # (R, 65536)
+            signatures = np.packbits(covered, axis=0).T                     # (65536, ceil(R/8))
+            unique, inverse = np.unique(signatures, axis=0, return_inverse=True)
+            groups = np.full(N_PORTS, -1, dtype=np.int64)
+            for u, signature in enumerate(unique):
+                rule_idx = np.flatnonzero(np.unpackbits(signature)[:len(proto_rules)])
+                if not len(rule_idx):
+                    continue
+                gid = n_groups
+                n_groups += 1
+                groups[inverse.ravel() == u] = gid
+                for lo, hi in _merge_intervals(
+                        [iv for r in rule_idx for iv in proto_rules[r][1]]):
+                    starts.append((gid << 32) | lo)
+                    ends.append((gid << 32) | hi)
+            self._port_groups[proto] = groups
+
+        order = np.argsort(np.array(starts, dtype=np.uint64), kind='stable')
+        self._starts = np.array(starts, dtype=np.uint64)[order]
+        self._ends = np.array(ends, dtype=np.uint64)[order]
+        self.n_groups = n_groups
+
+    # ------------------------------------------------------------------
+    def _ip_int(self, value) -> int:
+        ip = self._ip_memo.get(value)
+        if ip is None:
+            try:
+                ip = struct.unpack('!I', socket.inet_pton(socket.AF_INET, str(value).strip()))[0]
+            except (OSError, ValueError):
+                ip = -1   # IPv6 / мусор — не совпадёт ни с одним правилом
+            if len(self._ip_memo) >= _IP_MEMO_MAX:
+                self._ip_memo.clear()
+            self._ip_memo[value] = ip
+        return ip
+
+    def _encode(self, items: List[Dict]):
+        n = len(items)
+        ips = np.fromiter((self._ip_int(it.get('DestinationIP', it.get('destinationIP', '')))
+                           for it in items), dtype=np.int64, count=n)
+        ports = np.fromiter((int(it.get('DestinationPort', it.get('destinationPort', -1)) or 0)
+                             for it in items), dtype=np.int64, count=n)
+        protos = np.fromiter((protocol_number(it.get('Protocol', it.get('protocol')))
+                              for it in items), dtype=np.int64, count=n)
+        return ips, ports, protos
+
+    def _match_groups(self, groups: np.ndarray, ips: np.ndarray) -> np.ndarray:
+        ok = (groups >= 0) & (ips >= 0)
+        if not ok.any() or not len(self._starts):
+            return np.zeros(len(ips), dtype=bool)
+        keys = (groups[ok].astype(np.uint64) << np.uint64(32)) | ips[ok].astype(np.uint64)
+        pos = np.searchsorted(self._starts, keys, side='right') - 1
+        hit = (pos >= 0) & (keys <= self._ends[np.maximum(pos, 0)])
+        out = np.zeros(len(ips), dtype=bool)
+        out[np.flatnonzero(ok)[hit]] = True
+        return out
+
+    def match(self, items: List[Dict]) -> np.ndarray:
+        """bool-маска flows, попадающих под правила."""
+        n = len(items)
+        if not n or not self._port_groups:
+            return np.zeros(n, dtype=bool)
+        ips, ports, protos = self._encode(items)
+        valid_port = (ports >= 0) & (ports < N_PORTS)
+        port_idx = np.where(valid_port, ports, 0)
+
+        allowed = np.zeros(n, dtype=bool)
+        for proto, table in self._port_groups.items():
+            rows = valid_port if proto == ANY_PROTOCOL else valid_port & (protos == proto)
+            if not rows.any():
+                continue
+            groups = np.where(rows, table[port_idx], -1)
+            allowed |= self._match_groups(groups, ips)
+        return allowed
+
+    # ------------------------------------------------------------------
+    def apply(self, items: List[Dict], predict_fn, timer=NULL_TIMER,
+              cascade: bool = False) -> List[Dict]:
+        """
+        predict_fn(items) -> список предсказаний модели. Через модель идут
+        только flows вне allow-list, остальные получают allowlisted_prediction;
+        порядок ответа совпадает с items. cascade=True — у модели включён
+        каскад, и ответы allow-list тоже несут 'stage'.
+        """
+        with timer.stage('allowlist'):
+            allowed = self.match(items)
+        n_allowed = int(allowed.sum())
+        timer.count('allowlistRows', n_allowed)
+        with self._lock:
+            self.rows_seen += len(items)
+            self.rows_allowed += n_allowed
+
+        if not n_allowed:
+            return predict_fn(items)
+
+        rest = [it for it, a in zip(items, allowed.tolist()) if not a]
+        predicted = iter(predict_fn(rest) if rest else [])
+        return [allowlisted_prediction(it, cascade) if a else next(predicted)
+                for it, a in zip(items, allowed.tolist())]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'source': self.source,
+                'rules': len(self.rules),
+                'groups': self.n_groups,
+                'intervals': int(len(self._starts)),
+                'rowsSeen': self.rows_seen,
+                'rowsAllowed': self.rows_allowed,
+                'skippedRate': round(self.rows_allowed / self.rows_seen, 4) if self.rows_seen else 0.0,
+            }
+
+
+def allowlisted_prediction(item: Dict, cascade: bool = False) -> Dict:
+    """
+    Ответ для flow из allow-list — той же формы, что format_predictions;
+    cascade=True — с 'stage': ALLOWLIST_STAGE, как строки модели с каскадом.
+    """
+    prediction = {
+        'isAttack': False,
+        'confidence': 0.0,
+        'threatLevel': 'Low',
+        'method': 'allowlist',
+        'rfPrediction': 0,
+        'isAnomaly': False,
+        'sourceIP': item.get('SourceIP', item.get('sourceIP', '')),
+        'destinationIP': item.get('DestinationIP', item.get('destinationIP', '')),
+        'destinationPort': int(item.get('DestinationPort', item.get('destinationPort', 0)) or 0),
+        'protocol': item.get('Protocol', item.get('protocol', '')),
+    }
+    if cascade:
+        prediction['stage'] = ALLOWLIST_STAGE
+    return prediction
@@ -0,0 +1,440 @@
+"""
+PythonScripts/benchmark_inference.py
+
+Воспроизводимый бенчмарк инференса HybridIDS (RF) и CatBoostIDS.
+
+MLController отдаёт только общее ElapsedMs — по нему нельзя сравнить
+модели между собой и понять, куда уходит время. Здесь:
+
+  1. Фиксированный набор flows (seed): синтетический по именам признаков
+     моделей или подвыборка CICIDS (--data_dir).
+  2. Каждая модель — в отдельном процессе (spawn): время загрузки и RSS
+     не смешиваются между моделями.
+  3. Для каждого размера батча (1, 10, 100, 1k, 10k, 100k) батч подаётся
+     JSON-строкой, как из C#, и прогоняется повторно (не меньше
+     --min_repeats, пока не выйдет --seconds_per_batch). Считаются
+     p50/p95/p99 полного predict_batch, строк/сек и p50 по стадиям
+     StageTimer модели (profiling.py, как predict_batch(profile=True)):
+       parse      — json.loads
+       allowlist  — отбор flows по allow-list (если он задан)
+       matrix     — extract_feature_matrix (для RF — вместе со скейлингом)
+       scale      — отдельный скейлинг (CatBoost)
+       supervised — RF / CatBoost predict_proba (+ Pool для CatBoost)
+       anomaly    — IsolationForest.predict
+       format     — format_predictions
+       serialize  — json.dumps
+     Каскад и кеш предсказаний выключены; совпадение ответа с
+     predict_batch проверяется.
+  4. С --concurrency N: пропускная способность N потоков, шлющих батчи
+     по --concurrency_batch строк одновременно, — без планировщика и
+     через inference_scheduler, — против тех же запросов по очереди.
+  5. JSON-отчёт с версиями библиотек и параметрами машины — отчёты
+     с разных прогонов/машин можно сравнивать между собой.
+
+Запуск:
+    cd PythonScripts
+    python benchmark_inference.py
+    python benchmark_inference.py --data_dir data/cicids2017 --rows 100000
+    python benchmark_inference.py --models rf=models/hybrid_ids_v2.pkl --batch_sizes 1,100,10000
+    python benchmark_inference.py --batch_sizes 1000 --concurrency 8
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import psutil
+except ImportError:  # RSS тогда берём из resource (только пик) или не пишем
+    psutil = None
+
+
+DEFAULT_BATCH_SIZES = (1, 10, 100, 1_000, 10_000, 100_000)
+STAGES = ('parse', 'allowlist', 'matrix', 'scale', 'supervised', 'anomaly',
+          'format', 'serialize')
+_MODEL_CLASSES = {
+    'rf': ('hybrid_ids', 'HybridIDS'),
+    'catboost': ('catboost_ids', 'CatBoostIDS'),
+}
+
+
+# =============================================================
+# ПАМЯТЬ
+# =============================================================
+def rss_mb():
+    if psutil is not None:
+        return round(psutil.Process().memory_info().rss / 2**20, 1)
+    return None
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows без psutil
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux — КБ, macOS — байты
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+# =============================================================
+# НАБОР FLOWS
+# =============================================================
+def synthetic_flows(feature_names, rows: int, seed: int = 42):
+    """
+    Синтетические flows: лог-нормальные «объёмы/длительности», флаги 0/1,
+    порты из небольшого набора. Поля IP/Protocol — как у настоящих flows,
+    чтобы serialize-стадия была честной.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name in feature_names:
+        lower = name.lower()
+        if 'flag' in lower:
+            columns[name] = rng.integers(0, 2, rows).astype(float)
+        elif 'port' in lower:
+            columns[name] = rng.choice([53, 80, 443, 22, 8080, 3389], rows).astype(float)
+        else:
+            columns[name] = np.round(rng.lognormal(mean=5.0, sigma=2.5, size=rows), 3)
+
+    src = rng.integers(1, 255, size=(rows, 2))
+    flows = []
+    for i in range(rows):
+        flow = {name: float(col[i]) for name, col in columns.items()}
+        flow['SourceIP'] = f"10.0.{src[i, 0]}.{src[i, 1]}"
+        flow['DestinationIP'] = f"192.168.1.{src[i, 1]}"
+        flow['DestinationPort'] = int(flow.get('DestinationPort', 443))
+        flow['Protocol'] = 'TCP' if i % 5 else 'UDP'
+        flows.append(flow)
+    return flows
+
+
+def cicids_flows(data_dir: str, feature_names, rows: int, seed: int = 42):
+    """Подвыборка CICIDS (после той же очистки, что при обучении)."""
+    from train_hybrid_model import load_cicids, clean_data
+    df = clean_data(load_cicids(data_dir))
+    missing = [f for f in feature_names if f not in df.columns]
+    if missing:
+        raise ValueError(f"В CICIDS нет признаков моделей: {missing}")
+    df = df.sample(n=min(rows, len(df)), random_state=seed, replace=False)
+    flows = df[list(feature_names)].astype(float).to_dict(orient='records')
+    for flow in flows:
+        flow['Protocol'] = 'TCP'
+    return flows
+
+
+# =============================================================
+# СТАДИИ
+# =============================================================
+def _stage_runner(model):
+    """
+    predict_batch со StageTimer: стадии — те, что пишет сама модель
+    (predict_items с timer, как predict_batch(profile=True)). Возвращает
+    функцию payload -> (json ответа, {стадия: секунды}).
+    """
+    from profiling import StageTimer
+
+    def run(payload: str):
+        timer = StageTimer()
+        with timer.stage('parse'):
+            items = json.loads(payload)
+        predictions = model.predict_items(items, timer)
+        with timer.stage('serialize'):
+            out = json.dumps(predictions)
+        return out, {name: us / 1e6 for name, us in timer.timings.items()}
+
+    return run
+
+
+# =============================================================
+# ПРОГОН ОДНОЙ МОДЕЛИ (в отдельном процессе)
+# =============================================================
+def bench_concurrency(model, payloads: list, batch_rows: int, concurrency: int,
+                      requests_per_thread: int) -> dict:
+    """
+    Строк/сек для concurrency * requests_per_thread запросов:
+    serial — по очереди, concurrent — concurrency потоков как есть
+    (каждый со своим n_jobs=-1), scheduled — те же потоки через слоты
+    inference_scheduler.
+    """
+    from inference_scheduler import inference_slot, get_scheduler
+
+    n_requests = concurrency * requests_per_thread
+
+    def call(i, scheduled):
+        payload = payloads[i % len(payloads)]
+        if scheduled:
+            with inference_slot():
+                model.predict_batch(payload)
+        else:
+            model.predict_batch(payload)
+
+    out = {'concurrency': concurrency, 'batch_rows': batch_rows, 'requests': n_requests}
+    t0 = time.perf_counter()
+    for i in range(n_requests):
+        call(i, False)
+    out['serial_rows_per_sec'] = round(n_requests * batch_rows / (time.perf_counter() - t0), 1)
+
+    for mode, scheduled in (('concurrent', False), ('scheduled', True)):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            t0 = time.perf_counter()
+            list(pool.map(lambda i: call(i, scheduled), range(n_requests)))
+            elapsed = time.perf_counter() - t0
+        out[f'{mode}_rows_per_sec'] = round(n_requests * batch_rows / elapsed, 1)
+
+    out['scheduled_over_serial'] = round(out['scheduled_rows_per_sec'] /
+                                         out['serial_rows_per_sec'], 3)
+    out['scheduler'] = get_scheduler().stats()
+    return out
+
+
+def bench_model(model_type: str, model_path: str, flows: list, batch_sizes,
+                min_repeats: int, seconds_per_batch: float, n_jobs,
+                concurrency: int = 0, concurrency_batch: int = 1000,
+                concurrency_requests: int = 4) -> dict:
+    import importlib
+    module_name, class_name = _MODEL_CLASSES[model_type]
+
+    rss_before = rss_mb()
+    t0 = time.perf_counter()
+    module = importlib.import_module(module_name)
+    t_import = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    model = getattr(module, class_name).load(model_path)
+    load_s = time.perf_counter() - t0
+    rss_loaded = rss_mb()
+
+    # Бенчмарк «чистого» пути: без каскада и кеша предсказаний
+    model.disable_cascade()
+    model.disable_prediction_cache()
+    if n_jobs is not None:
+        if model_type == 'rf':
+            model.supervised.n_jobs = n_jobs
+        else:
+            model.thread_count = n_jobs
+        model.anomaly_detector.n_jobs = n_jobs
+
+    run_stages = _stage_runner(model)
+    result = {
+        'type': model_type,
+        'path': os.path.abspath(model_path),
+        'file_mb': round(os.path.getsize(model_path) / 2**20, 3),
+        'version': getattr(model, 'model_version', None),
+        'import_s': round(t_import, 3),
+        'load_s': round(load_s, 3),
+        'rss_before_load_mb': rss_before,
+        'rss_after_load_mb': rss_loaded,
+        'batches': {},
+    }
+
+    for bs in batch_sizes:
+        if bs > len(flows):
+            print(f"[bench:{model_type}] batch {bs} > {len(flows)} flows — пропуск")
+            continue
+        # Батчи — последовательные окна по набору, JSON готовится заранее
+        n_windows = max(1, min(16, len(flows) // bs))
+        payloads = [json.dumps(flows[i * bs:(i + 1) * bs]) for i in range(n_windows)]
+
+        # Проверка: стадии дают тот же ответ, что predict_batch
+        expected = model.predict_batch(payloads[0])
+        staged, _ = run_stages(payloads[0])
+        if staged != expected:
+            raise RuntimeError(f"[bench:{model_type}] стадии расходятся с predict_batch "
+                               f"на батче {bs}")
+
+        totals, stage_times = [], {s: [] for s in STAGES}
+        started = time.perf_counter()
+        rep = 0
+        while rep < min_repeats or time.perf_counter() - started < seconds_per_batch:
+            payload = payloads[rep % n_windows]
+            t0 = time.perf_counter()
+            model.predict_batch(payload)
+            totals.append(time.perf_counter() - t0)
+            _, st = run_stages(payload)
+            for s in STAGES:
+                stage_times[s].append(st.get(s, 0.0))
+            rep += 1
+
+        ms = np.array(totals) * 1000.0
+        stages_ms = {s: round(float(np.percentile(np.array(v) * 1000.0, 50)), 4)
+                     for s, v in stage_times.items()}
+        stage_sum = sum(stages_ms.values()) or 1.0
+        result['batches'][str(bs)] = {
+            'repeats': rep,
+            'p50_ms': round(float(np.percentile(ms, 50)), 4),
+            'p95_ms': round(float(np.percentile(ms, 95)), 4),
+            'p99_ms': round(float(np.percentile(ms, 99)), 4),
+            'mean_ms': round(float(ms.mean()), 4),
+            'rows_per_sec': round(bs / (np.percentile(ms, 50) / 1000.0), 1),
+            'stages_p50_ms': stages_ms,
+            'stages_share': {s: round(v / stage_sum, 4) for s, v in stages_ms.items()},
+        }
+        b = result['batches'][str(bs)]
+        print(f"[bench:{model_type}] batch={bs:<7} reps={rep:<5} p50={b['p50_ms']:.3f}ms "
+              f"p99={b['p99_ms']:.3f}ms  {b['rows_per_sec']:,.0f} rows/s")
+
+    if concurrency > 0:
+        bs = min(concurrency_batch, len(flows))
+        n_windows = max(1, min(16, len(flows) // bs))
+        payloads = [json.dumps(flows[i * bs:(i + 1) * bs]) for i in range(n_windows)]
+        c = result['concurrency'] = bench_concurrency(
+            model, payloads, bs, concurrency, concurrency_requests)
+        print(f"[bench:{model_type}] x{concurrency} batch={bs}: "
+              f"serial {c['serial_rows_per_sec']:,.0f}, concurrent {c['concurrent_rows_per_sec']:,.0f}, "
+              f"scheduled {c['scheduled_rows_per_sec']:,.0f} rows/s")
+
+    result['rss_peak_mb'] = peak_rss_mb()
+    result['rss_end_mb'] = rss_mb()
+    return result
+
+
+# =============================================================
+# MAIN
+# =============================================================
+def environment_info() -> dict:
+    import sklearn
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'psutil': psutil is not None,
+    }
+    try:
+        import catboost
+        info['catboost'] = catboost.__version__
+    except ImportError:
+        info['catboost'] = None
+    return info
+
+
+def parse_models(spec: str):
+    from train_hybrid_model import model_path_for
+    if not spec:
+        return [(t, model_path_for(t)) for t in ('rf', 'catboost')
+                if os.path.exists(model_path_for(t))]
+    models = []
+    for part in spec.split(','):
+        model_type, _, path = part.partition('=')
+        model_type = model_type.strip().lower()
+        if model_type not in _MODEL_CLASSES:
+            raise ValueError(f"Неизвестный тип модели: {model_type}")
+        models.append((model_type, path.strip() or model_path_for(model_type)))
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', default='',
+                        help='rf=path,catboost=path (по умолчанию — обе из models/, если есть)')
+    parser.add_argument('--data_dir', default=None,
+                        help='CICIDS CSV; без него — синтетический набор')
+    parser.add_argument('--rows', type=int, default=None,
+                        help='Размер набора (по умолчанию = максимальный батч)')
+    parser.add_argument('--batch_sizes', default=','.join(map(str, DEFAULT_BATCH_SIZES)))
+    parser.add_argument('--min_repeats', type=int, default=5)
+    parser.add_argument('--seconds_per_batch', type=float, default=2.0)
+    parser.add_argument('--n_jobs', type=int, default=None,
+                        help='n_jobs / thread_count моделей (по умолчанию — как в артефакте)')
+    parser.add_argument('--concurrency', type=int, default=0,
+                        help='Число одновременных запросов для теста планировщика (0 — не гонять)')
+    parser.add_argument('--concurrency_batch', type=int, default=1000)
+    parser.add_argument('--concurrency_requests', type=int, default=4,
+                        help='Запросов на поток в тесте --concurrency')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default=None,
+                        help='Путь JSON-отчёта (по умолчанию — benchmarks/inference_<время>.json)')
+    args = parser.parse_args()
+
+    batch_sizes = sorted({int(b) for b in args.batch_sizes.split(',') if b.strip()})
+    rows = args.rows or max(batch_sizes)
+    models = parse_models(args.models)
+    if not models:
+        parser.error("Нет моделей для бенчмарка (--models)")
+
+    # Набор flows с признаками обеих моделей
+    import joblib
+    feature_names = []
+    for _, path in models:
+        for f in joblib.load(path, mmap_mode='r').get('feature_names', []):
+            if f not in feature_names:
+                feature_names.append(f)
+
+    print("=" * 70)
+    print(f"BENCHMARK: {', '.join(t for t, _ in models)}; "
+          f"{'CICIDS' if args.data_dir else 'synthetic'} {rows:,} flows; "
+          f"batches {batch_sizes}")
+    print("=" * 70)
+
+    if args.data_dir:
+        flows = cicids_flows(args.data_dir, feature_names, rows, args.seed)
+    else:
+        flows = synthetic_flows(feature_names, rows, args.seed)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment_info(),
+        'dataset': {
+            'source': os.path.abspath(args.data_dir) if args.data_dir else 'synthetic',
+            'rows': len(flows),
+            'seed': args.seed,
+            'feature_names': feature_names,
+        },
+        'settings': {
+            'batch_sizes': batch_sizes,
+            'min_repeats': args.min_repeats,
+            'seconds_per_batch': args.seconds_per_batch,
+            'n_jobs': args.n_jobs,
+            'concurrency': args.concurrency,
+            'concurrency_batch': args.concurrency_batch,
+            'concurrency_requests': args.concurrency_requests,
+        },
+        'models': {},
+    }
+
+    # ProcessPoolExecutor, а не mp.Pool: его воркеры не daemon,
+    # и n_jobs=-1 (loky) внутри модели работает как в обычном процессе
+    ctx = mp.get_context('spawn')
+    for model_type, path in models:
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            report['models'][model_type] = pool.submit(
+                bench_model, model_type, path, flows, batch_sizes, args.min_repeats,
+                args.seconds_per_batch, args.n_jobs, args.concurrency,
+                args.concurrency_batch, args.concurrency_requests).result()
+
+    # Сравнение p50 по батчам (если моделей две)
+    if {'rf', 'catboost'} <= set(report['models']):
+        rf_b, cb_b = report['models']['rf']['batches'], report['models']['catboost']['batches']
+        report['comparison'] = {
+            bs: {'rf_p50_ms': rf_b[bs]['p50_ms'], 'catboost_p50_ms': cb_b[bs]['p50_ms'],
+                 'catboost_over_rf': round(cb_b[bs]['p50_ms'] / rf_b[bs]['p50_ms'], 3)}
+            for bs in rf_b if bs in cb_b
+        }
+
+    out = args.out or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'benchmarks',
+        f"inference_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print("\n" + "=" * 70)
+    print("DONE")
+    print("=" * 70)
+    for model_type, r in report['models'].items():
+        print(f"{model_type:9s} load={r['load_s']}s rss={r['rss_after_load_mb']}MB "
+              f"peak={r['rss_peak_mb']}MB")
+    print(f"Report:      {out}")
+
+
+if __name__ == '__main__':
+    main()
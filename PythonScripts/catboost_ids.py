@@ -12,22 +12,50 @@ PythonScripts/catboost_ids.py
   - supervised: CatBoostClassifier вместо RandomForestClassifier
   - Ожидается что CatBoost даст более точные вероятности (calibrated probas)
 
+Изменения в v2.1:
+  - CatBoost обучается и предсказывает на СЫРЫХ признаках (float32, через
+    catboost.Pool): деревьям градиентного бустинга стандартизация ничего
+    не даёт, а стоила полного прохода по матрице и float64-копии.
+    StandardScaler остался только для IsolationForest и считается лениво —
+    когда IF действительно нужен.
+  - Один Pool и один predict_proba на батч (класс = proba > 0.5),
+    вместо predict + predict_proba.
+  - thread_count настраивается (конструктор / атрибут); внутри слота
+    inference_scheduler ограничивается бюджетом потоков слота.
+  - explain_batch: нативные SHAP-значения CatBoost (в логите) для flows
+    с вероятностью атаки выше порога, с кешем по вектору признаков.
+  - Старые v2-артефакты (CatBoost на scaled-признаках) грузятся как раньше:
+    в .pkl пишется 'supervised_input' = 'raw' | 'scaled', у старых его нет
+    -> 'scaled'.
+  - allowlist.json рядом с моделью (или IDS_ALLOWLIST): flows из
+    allow-list получают method='allowlist' без инференса (allowlist.py).
+
 Запуск обучения:
   python train_hybrid_model.py --model_type catboost
 """
 
 import os
 import json
+import time
 import numpy as np
 import joblib
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
 from sklearn.ensemble import IsolationForest
 from sklearn.preprocessing import StandardScaler
-from catboost import CatBoostClassifier
+from catboost import CatBoostClassifier, Pool
+
+from ids_common import (extract_feature_matrix, format_predictions,
+                        PredictionCache, iter_item_chunks,
+                        DEFAULT_STREAM_CHUNK, make_cascade_config,
+                        scale_features, predict_matrix, explain_items,
+                        DEFAULT_EXPLAIN_CACHE_SIZE)
+from profiling import NULL_TIMER, make_timer, profiled_response
+from allowlist import Allowlist
+from inference_scheduler import thread_budget
 
 
-MODEL_VERSION = "2.0-catboost"
+MODEL_VERSION = "2.1-catboost"
 
 # Отдельный кеш для CatBoost моделей (не смешиваем с hybrid_ids)
 _CB_MODEL_CACHE: Dict[str, 'CatBoostIDS'] = {}
@@ -40,11 +68,19 @@ def clear_cache():
 
 
 class CatBoostIDS:
-    def __init__(self):
+    def __init__(self, thread_count: int = -1):
         self.supervised: CatBoostClassifier = None
         self.anomaly_detector: IsolationForest = None
         self.scaler: StandardScaler = None
         self.feature_names: List[str] = []
+        # 'raw' — CatBoost на сырых признаках (v2.1+), 'scaled' — старые v2
+        self.supervised_input: str = 'raw'
+        self.thread_count: int = thread_count
+        self.model_version: str = MODEL_VERSION
+        self.prediction_cache: PredictionCache = None
+        self.allowlist: Allowlist = None
+        self.explanation_cache = PredictionCache(DEFAULT_EXPLAIN_CACHE_SIZE)
+        self.cascade: Dict = None
         self._is_loaded = False
 
     # ------------------------------------------------------------------
@@ -57,10 +93,11 @@ class CatBoostIDS:
         print(f"[CatBoostIDS] Training on {X_train.shape[0]} samples, "
               f"{len(feature_names)} features")
 
-        # CatBoost работает лучше без стандартизации, но мы скейлим для консистентности
-        # с hybrid_ids (чтобы IF работал на тех же scaled-данных)
+        # Scaler нужен только IsolationForest (как в hybrid_ids);
+        # CatBoost учится на сырых признаках
         self.scaler = StandardScaler()
-        X_scaled = self.scaler.fit_transform(X_train)
+        self.scaler.fit(X_train)
+        self.supervised_input = 'raw'
 
         # Баланс классов
         class_counts = np.bincount(y_train)
@@ -83,19 +120,22 @@ class CatBoostIDS:
             random_seed=42,
             verbose=100,              # Печатать прогресс раз в 100 итераций
             allow_writing_files=False,  # не создаёт catboost_info/
-            thread_count=-1,
+            thread_count=self.thread_count,
         )
 
         # CatBoost умеет сам использовать eval set — используем часть train
         # для раннего останова. Но для простоты пока без этого.
-        self.supervised.fit(X_scaled, y_train)
+        train_pool = Pool(np.ascontiguousarray(X_train, dtype=np.float32), label=y_train)
+        self.supervised.fit(train_pool)
+        del train_pool
 
-        # IsolationForest на норме (как в hybrid_ids)
+        # IsolationForest на норме (как в hybrid_ids) — скейлим только её
         normal_mask = (y_train == 0)
-        X_normal = X_scaled[normal_mask]
+        X_normal = X_train[normal_mask]
         if len(X_normal) < 10:
             print("[CatBoostIDS] WARN: мало нормальных образцов")
-            X_normal = X_scaled
+            X_normal = X_train
+        X_normal = self.scaler.transform(X_normal)
 
         self.anomaly_detector = IsolationForest(
             n_estimators=100, contamination=0.1,
@@ -103,6 +143,7 @@ class CatBoostIDS:
         )
         self.anomaly_detector.fit(X_normal)
 
+        self.model_version = f"{MODEL_VERSION}@trained-{time.time():.0f}"
         self._is_loaded = True
 
         print(f"\n[CatBoostIDS] Feature importances:")
@@ -123,9 +164,14 @@ class CatBoostIDS:
             'supervised': self.supervised,
             'anomaly_detector': self.anomaly_detector,
             'scaler': self.scaler,
+            'supervised_input': self.supervised_input,
             'metrics': metrics or {},
         }
-        joblib.dump(payload, model_path)
+        # Через временный файл: модель могла быть загружена с mmap_mode='r'
+        # из этого же .pkl — перезапись на месте испортила бы её массивы
+        tmp_path = model_path + '.tmp'
+        joblib.dump(payload, tmp_path)
+        os.replace(tmp_path, model_path)
         print(f"[CatBoostIDS] Модель сохранена: {model_path}")
 
         # Инвалидируем кеш
@@ -150,7 +196,7 @@ class CatBoostIDS:
         print(f"[CatBoostIDS] Meta JSON: {json_path}")
 
     @classmethod
-    def load(cls, model_path: str) -> 'CatBoostIDS':
+    def load(cls, model_path: str, mmap_mode: str = None) -> 'CatBoostIDS':
         if not os.path.exists(model_path):
             raise FileNotFoundError(
                 f"Файл модели CatBoost не найден: {model_path}. "
@@ -171,13 +217,17 @@ class CatBoostIDS:
             del _CB_MODEL_CACHE[k]
 
         print(f"[CatBoostIDS] CACHE MISS: loading {os.path.basename(abs_path)}...")
-        payload = joblib.load(abs_path)
+        payload = joblib.load(abs_path, mmap_mode=mmap_mode)
         instance = cls()
         instance.supervised = payload['supervised']
         instance.anomaly_detector = payload['anomaly_detector']
         instance.scaler = payload['scaler']
         instance.feature_names = payload.get('feature_names', [])
+        # v2 без этого ключа обучались на scaled-признаках
+        instance.supervised_input = payload.get('supervised_input', 'scaled')
+        instance.model_version = f"{payload.get('version', '?')}@{mtime}"
         instance._is_loaded = True
+        instance.allowlist = Allowlist.for_model(abs_path)
 
         _CB_MODEL_CACHE[cache_key] = instance
 
@@ -186,81 +236,236 @@ class CatBoostIDS:
         return instance
 
     # ------------------------------------------------------------------
-    def predict_batch(self, json_data: str) -> str:
+    def _supervised_pool(self, X: np.ndarray, X_scaled: np.ndarray = None) -> Pool:
+        """Pool для CatBoost: сырые float32-признаки (или scaled для старых v2)."""
+        if self.supervised_input == 'scaled':
+            data = X_scaled if X_scaled is not None else scale_features(X, self.scaler)
+        else:
+            data = X
+        return Pool(np.ascontiguousarray(data, dtype=np.float32))
+
+    def predict_proba_supervised(self, X: np.ndarray, ntree_end: int = 0) -> np.ndarray:
+        """Вероятность атаки от CatBoost для сырой матрицы признаков."""
+        pool = self._supervised_pool(X)
+        return self.supervised.predict_proba(
+            pool, ntree_end=ntree_end, thread_count=thread_budget(self.thread_count))[:, 1]
+
+    def _predict_raw(self, X: np.ndarray, inplace: bool = False, timer=NULL_TIMER):
+        """
+        Матрица признаков -> (pred, proba атаки, сырой ответ IF: -1/1,
+        ступень каскада: 1 — решено первыми итерациями, 2 — полной моделью).
+
+        inplace=True — X можно перезаписать scaled-значениями для IF.
+        Для raw-модели это делается только после predict_proba: Pool может
+        не копировать float32-матрицу, а ссылаться на неё (и помечать
+        read-only — тогда скейлим в отдельный буфер).
+        timer — profiling.StageTimer (стадии scale / supervised / anomaly).
+        """
+        if self.cascade is not None:
+            return self._predict_cascade(X, timer)
+
+        # Батч-инференс: один Pool, один проход; класс 1 <=> proba > 0.5
+        if self.supervised_input == 'raw':
+            with timer.stage('supervised'):
+                pool = self._supervised_pool(X)
+                cb_probas = self.supervised.predict_proba(
+                    pool, thread_count=thread_budget(self.thread_count))[:, 1]
+                del pool
+            with timer.stage('scale'):
+                X_scaled = scale_features(X, self.scaler, inplace=inplace and X.flags.writeable)
+        else:
+            # Старые v2: scaled-матрица нужна и CatBoost, и IF — считаем один раз
+            with timer.stage('scale'):
+                X_scaled = scale_features(X, self.scaler, inplace=inplace)
+            with timer.stage('supervised'):
+                pool = self._supervised_pool(X_scaled, X_scaled)
+                cb_probas = self.supervised.predict_proba(
+                    pool, thread_count=thread_budget(self.thread_count))[:, 1]
+        cb_preds = (cb_probas > 0.5).astype(np.int64)
+        with timer.stage('anomaly'):
+            if_raw = self.anomaly_detector.predict(X_scaled)
+        timer.count('supervisedRows', len(X))
+        timer.count('anomalyRows', len(X))
+        stages = np.full(len(X), 2, dtype=np.int64)
+        return cb_preds, cb_probas, if_raw, stages
+
+    # ------------------------------------------------------------------
+    # Каскад: первые N итераций бустинга как дешёвый пре-фильтр
+    # ------------------------------------------------------------------
+    def configure_cascade(self, first_stage_trees: int = 20, low: float = 0.1,
+                          high: float = 0.9, anomaly_on_all: bool = False):
+        """
+        Включает каскадный инференс. Первая ступень — первые
+        first_stage_trees деревьев бустинга (predict_proba с ntree_end).
+        Строки вне полосы (low, high) решаются сразу, остальные идут
+        в полную модель и IsolationForest.
+        """
+        self.cascade = make_cascade_config(first_stage_trees, low, high, anomaly_on_all)
+        print(f"[CatBoostIDS] Cascade enabled: {self.cascade}")
+
+    def disable_cascade(self):
+        self.cascade = None
+
+    def _predict_cascade(self, X: np.ndarray, timer=NULL_TIMER):
+        cfg = self.cascade
+        n = len(X)
+        n_head = min(cfg['first_stage_trees'], self.supervised.tree_count_)
+
+        with timer.stage('supervised'):
+            cb_probas = self.predict_proba_supervised(X, ntree_end=n_head)
+            uncertain = (cb_probas > cfg['low']) & (cb_probas < cfg['high'])
+            stages = np.where(uncertain, 2, 1).astype(np.int64)
+
+            if uncertain.any() and n_head < self.supervised.tree_count_:
+                cb_probas[uncertain] = self.predict_proba_supervised(X[uncertain])
+        # Бинарный CatBoost: класс 1 <=> proba > 0.5
+        cb_preds = (cb_probas > 0.5).astype(np.int64)
+        n_uncertain = int(uncertain.sum())
+        timer.count('supervisedRows', n)
+        timer.count('cascadeStage2Rows', n_uncertain)
+
+        # IF — единственный потребитель scaled-матрицы, скейлим только нужные строки
+        if_raw = np.ones(n, dtype=np.int64)
+        if cfg['anomaly_on_all']:
+            with timer.stage('scale'):
+                X_scaled = scale_features(X, self.scaler)
+            with timer.stage('anomaly'):
+                if_raw = self.anomaly_detector.predict(X_scaled)
+        elif n_uncertain:
+            with timer.stage('scale'):
+                X_scaled = scale_features(X[uncertain], self.scaler, inplace=True)
+            with timer.stage('anomaly'):
+                if_raw[uncertain] = self.anomaly_detector.predict(X_scaled)
+        timer.count('anomalyRows', n if cfg['anomaly_on_all'] else n_uncertain)
+
+        return cb_preds, cb_probas, if_raw, stages
+
+    def _inference_version(self) -> str:
+        """Версия для кеша предсказаний: модель + режим каскада."""
+        return f"{self.model_version}|cascade={self.cascade}"
+
+    def predict_items(self, items: List[Dict], timer=NULL_TIMER) -> List[Dict]:
         if not self._is_loaded:
             raise RuntimeError("Модель не загружена. Вызовите CatBoostIDS.load()")
-
-        items = json.loads(json_data)
         if not items:
-            return json.dumps([])
-
-        # Матрица фичей
-        feat_matrix = []
-        for item in items:
-            vec = []
-            for feat in self.feature_names:
-                val = item.get(feat)
-                if val is None:
-                    camel = feat[0].lower() + feat[1:]
-                    val = item.get(camel, 0.0)
-                try:
-                    vec.append(float(val) if val is not None else 0.0)
-                except (TypeError, ValueError):
-                    vec.append(0.0)
-            feat_matrix.append(vec)
-
-        X = np.array(feat_matrix, dtype=float)
-        X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
-        X_scaled = self.scaler.transform(X)
-
-        # Батч-инференс
-        cb_preds = self.supervised.predict(X_scaled).flatten().astype(int)
-        cb_probas = self.supervised.predict_proba(X_scaled)[:, 1]
-        if_raw = self.anomaly_detector.predict(X_scaled)
-
-        results = []
-        for i, item in enumerate(items):
-            cb_pred = int(cb_preds[i])
-            cb_proba = float(cb_probas[i])
-            is_anomaly = 1 if int(if_raw[i]) == -1 else 0
-
-            is_attack = bool(cb_pred == 1 or is_anomaly == 1)
-
-            if cb_proba >= 0.8:
-                threat = 'Critical'
-            elif cb_proba >= 0.6:
-                threat = 'High'
-            elif cb_proba >= 0.4:
-                threat = 'Medium'
-            else:
-                threat = 'Low'
-
-            if is_anomaly == 1 and cb_pred == 0 and threat == 'Low':
-                threat = 'Medium'
-
-            if is_anomaly == 1 and cb_pred == 0:
-                method = 'unsupervised'
-            elif is_anomaly == 1 and cb_pred == 1:
-                method = 'both'
-            elif cb_pred == 1:
-                method = 'supervised'
-            else:
-                method = 'none'
-
-            results.append({
-                'isAttack': is_attack,
-                'confidence': round(cb_proba, 4),
-                'threatLevel': threat,
-                'method': method,
-                'rfPrediction': cb_pred,  # оставляем имя "rfPrediction" для совместимости DTO
-                'isAnomaly': bool(is_anomaly),
-                'sourceIP': item.get('SourceIP', item.get('sourceIP', '')),
-                'destinationIP': item.get('DestinationIP',
-                                          item.get('destinationIP', '')),
-                'destinationPort': int(
-                    item.get('DestinationPort',
-                             item.get('destinationPort', 0)) or 0),
-                'protocol': item.get('Protocol', item.get('protocol', '')),
-            })
-
-        return json.dumps(results)
+            return []
+        if self.allowlist is not None:
+            return self.allowlist.apply(
+                items, lambda rest: self._predict_model_items(rest, timer), timer,
+                cascade=self.cascade is not None)
+        return self._predict_model_items(items, timer)
+
+    def _predict_model_items(self, items: List[Dict], timer=NULL_TIMER) -> List[Dict]:
+        """Модель для flows вне allow-list (items не пустой)."""
+        # Матрица своя и дальше не нужна — IF-скейлинг делается на месте
+        with timer.stage('matrix'):
+            X = extract_feature_matrix(items, self.feature_names)
+        timer.count('rows', len(items))
+        cb_preds, cb_probas, if_raw, stages = predict_matrix(self, X, timer)
+
+        with timer.stage('format'):
+            return format_predictions(items, cb_preds, cb_probas, if_raw,
+                                      stages if self.cascade is not None else None)
+
+    def predict_batch(self, json_data: str, profile: bool = False,
+                      profile_top: int = 0) -> str:
+        """profile=True — {"predictions": [...], "profile": {...}}, см. HybridIDS.predict_batch."""
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите CatBoostIDS.load()")
+
+        timer = make_timer(profile, profile_top)
+        with timer.stage('parse'):
+            items = json.loads(json_data)
+        predictions = self.predict_items(items, timer)
+        with timer.stage('serialize'):
+            out = json.dumps(predictions)
+        return out if not profile else profiled_response('predictions', out, timer)
+
+    def predict_batch_iter(self, source, chunk_size: int = DEFAULT_STREAM_CHUNK,
+                           as_json: bool = True) -> Iterator:
+        """
+        Потоковый вариант predict_batch для сессий на миллионы flows.
+
+        source — итерируемое с чанками flows (list[dict]), отдельными flows
+        или строками NDJSON (см. ids_common.iter_item_chunks). Предсказания
+        отдаются чанками по chunk_size: JSON-строка (as_json=True) или список.
+        Пиковая память ~ chunk_size × ширина строки, а не вся сессия.
+        """
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите CatBoostIDS.load()")
+
+        for chunk in iter_item_chunks(source, chunk_size):
+            preds = self.predict_items(chunk)
+            yield json.dumps(preds) if as_json else preds
+
+    # ------------------------------------------------------------------
+    # Объяснения: нативные SHAP-значения CatBoost
+    # ------------------------------------------------------------------
+    def explain_method(self) -> str:
+        return 'catboost_shap'
+
+    def explain_output_space(self) -> str:
+        # ShapValues бинарного CatBoost — в пространстве логита (RawFormulaVal)
+        return 'logOdds'
+
+    def _explain_raw(self, X: np.ndarray):
+        """Сырая матрица -> (base, contrib): base + contrib.sum(1) = логит CatBoost."""
+        shap = self.supervised.get_feature_importance(
+            self._supervised_pool(X), type='ShapValues',
+            thread_count=thread_budget(self.thread_count))
+        return shap[:, -1].copy(), np.ascontiguousarray(shap[:, :-1])
+
+    def explain_items(self, items: List[Dict], threshold: float = 0.5,
+                      top_k: int = 10) -> Dict:
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите CatBoostIDS.load()")
+        return explain_items(self, items, threshold, top_k)
+
+    def explain_batch(self, json_data: str, threshold: float = 0.5,
+                      top_k: int = 10) -> str:
+        """Объяснения для flows с вероятностью атаки >= threshold, см. HybridIDS.explain_batch."""
+        return json.dumps(self.explain_items(json.loads(json_data), threshold, top_k))
+
+    # ------------------------------------------------------------------
+    # Кеш предсказаний
+    # ------------------------------------------------------------------
+    def enable_prediction_cache(self, max_size: int = 100_000,
+                                quantize_decimals: int = None):
+        """
+        Включает LRU-кеш предсказаний по вектору отобранных признаков
+        (см. ids_common.PredictionCache). Повторное включение сбрасывает кеш.
+        """
+        self.prediction_cache = PredictionCache(max_size, quantize_decimals)
+        print(f"[CatBoostIDS] Prediction cache enabled: max_size={max_size}, "
+              f"quantize={quantize_decimals}")
+
+    def disable_prediction_cache(self):
+        self.prediction_cache = None
+
+    def prediction_cache_stats(self) -> str:
+        if self.prediction_cache is None:
+            return json.dumps({'enabled': False})
+        return json.dumps({'enabled': True, **self.prediction_cache.stats()})
+
+    # ------------------------------------------------------------------
+    # Allow-list (быстрая полоса без инференса, см. allowlist.py)
+    # ------------------------------------------------------------------
+    def enable_allowlist(self, rules) -> str:
+        """
+        rules — путь к JSON-файлу правил, JSON-строка или список правил.
+        Подходящие flows получают method='allowlist' без вызова модели.
+        """
+        if isinstance(rules, str) and os.path.exists(rules):
+            self.allowlist = Allowlist.from_file(rules)
+        else:
+            self.allowlist = Allowlist(json.loads(rules) if isinstance(rules, str) else rules)
+        print(f"[CatBoostIDS] Allowlist enabled: {len(self.allowlist.rules)} правил")
+        return self.allowlist_stats()
+
+    def disable_allowlist(self):
+        self.allowlist = None
+
+    def allowlist_stats(self) -> str:
+        if self.allowlist is None:
+            return json.dumps({'enabled': False})
+        return json.dumps({'enabled': True, **self.allowlist.stats()})
@@ -0,0 +1,426 @@
+"""
+PythonScripts/compress_model.py
+
+Сжатие RandomForest из HybridIDS под бюджет по латентности и/или размеру.
+
+RF обучается с n_estimators=200, max_depth=20 — в каждом дереве десятки
+тысяч листьев (см. pkl_check.py). От этого и размер .pkl, и время
+predict_proba. Здесь перебираются кандидаты поменьше:
+
+  subset  — подмножество деревьев: жадный forward-отбор по log-loss
+            ансамбля на валидации (не просто «первые N»), порядок
+            добавления запоминается, так что любой размер — это префикс;
+  depth   — обрезка деревьев по глубине: узлы на глубине max_depth
+            становятся листьями (их value уже хранит распределение
+            классов поддерева), остальное выкидывается из массива узлов;
+  distill — маленький лес, обученный на мягких метках большого:
+            каждая строка входит дважды, с классом 0 и весом 1-p
+            и с классом 1 и весом p (p — proba атаки от исходного RF).
+
+Кандидат выбирается по F1 на валидации среди укладывающихся в бюджет:
+p99 латентности predict_proba на батче --batch_rows строк и/или размер
+массивов деревьев. Валидация — часть hold-out split'а train_hybrid_model
+(на train RF почти не ошибается, выбор по нему тянул бы к глубоким
+деревьям); отчёт до/после (F1, ROC-AUC) — на оставшейся части hold-out.
+Итог — новый .pkl HybridIDS (тот же scaler и IsolationForest) + JSON-отчёт
+с размером и p50/p99.
+
+Запуск:
+    cd PythonScripts
+    python compress_model.py --latency_budget_ms 15
+    python compress_model.py --size_budget_mb 20 --methods subset,depth
+    python compress_model.py --latency_budget_ms 10 --methods distill --out_path models/hybrid_ids_small.pkl
+"""
+
+import os
+import sys
+import copy
+import time
+import argparse
+import json
+import numpy as np
+
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import f1_score, roc_auc_score
+from sklearn.model_selection import train_test_split
+from sklearn.tree._tree import Tree
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hybrid_ids import HybridIDS
+from ids_common import scale_features
+from train_hybrid_model import (load_cicids, clean_data, split_holdout,
+                                model_path_for, DEFAULT_DATA_DIR)
+
+
+DEFAULT_SUBSET_SIZES = (150, 100, 75, 50, 30, 20, 10)
+DEFAULT_DEPTH_CAPS = (None, 16, 14, 12, 10, 8)
+DEFAULT_DISTILL_GRID = ((50, 14), (30, 12), (20, 10), (10, 8))
+TREE_LEAF = -1
+TREE_UNDEFINED = -2
+
+
+# =============================================================
+# РАЗМЕР И ЛАТЕНТНОСТЬ
+# =============================================================
+def forest_nbytes(rf: RandomForestClassifier) -> int:
+    """Размер массивов узлов и value всех деревьев — основная часть .pkl."""
+    total = 0
+    for est in rf.estimators_:
+        tree = est.tree_
+        node_bytes = 64  # dtype узла sklearn: 7 полей по 8 байт + флаг, с выравниванием
+        value_bytes = tree.n_outputs * int(np.max(tree.n_classes)) * 8
+        total += tree.node_count * (node_bytes + value_bytes)
+    return total
+
+
+def measure_latency(predict_fn, X: np.ndarray, batch_rows: int = 1000,
+                    repeats: int = 30, seed: int = 0) -> dict:
+    """p50/p99 времени predict_fn на случайных батчах по batch_rows строк, в мс."""
+    rng = np.random.default_rng(seed)
+    batch_rows = min(batch_rows, len(X))
+    predict_fn(X[:batch_rows])  # прогрев
+    times = []
+    for _ in range(repeats):
+        idx = rng.choice(len(X), batch_rows, replace=False)
+        batch = X[idx]
+        t0 = time.perf_counter()
+        predict_fn(batch)
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return {
+        'batch_rows': int(batch_rows),
+        'p50_ms': round(float(np.percentile(times, 50)), 3),
+        'p99_ms': round(float(np.percentile(times, 99)), 3),
+    }
+
+
+def attack_proba(rf: RandomForestClassifier, X_scaled: np.ndarray) -> np.ndarray:
+    return rf.predict_proba(X_scaled)[:, int(np.flatnonzero(rf.classes_ == 1)[0])]
+
+
+def score(rf, X_scaled, y) -> dict:
+    proba = attack_proba(rf, X_scaled)
+    try:
+        roc = float(roc_auc_score(y, proba))
+    except ValueError:
+        roc = None
+    return {
+        'f1': round(float(f1_score(y, (proba > 0.5).astype(int), zero_division=0)), 4),
+        'roc_auc': round(roc, 4) if roc is not None else None,
+    }
+
+
+# =============================================================
+# КАНДИДАТЫ
+# =============================================================
+def with_estimators(rf: RandomForestClassifier, estimators: list) -> RandomForestClassifier:
+    """Поверхностная копия леса с другим списком деревьев."""
+    small = copy.copy(rf)
+    small.estimators_ = list(estimators)
+    small.n_estimators = len(small.estimators_)
+    return small
+
+
+def greedy_tree_order(rf: RandomForestClassifier, X_val: np.ndarray, y_val: np.ndarray,
+                      max_trees: int) -> list:
+    """
+    Жадный forward-отбор деревьев: на каждом шаге добавляется дерево,
+    сильнее всего уменьшающее log-loss среднего ансамбля на валидации.
+    Возвращает индексы деревьев в порядке добавления.
+    """
+    attack_col = int(np.flatnonzero(rf.classes_ == 1)[0])
+    # (T, n) — proba атаки каждого дерева на валидации
+    P = np.stack([est.predict_proba(X_val)[:, attack_col] for est in rf.estimators_])
+    y = y_val.astype(bool)
+    eps = 1e-6
+
+    order = []
+    remaining = np.ones(len(P), dtype=bool)
+    acc = np.zeros(P.shape[1])
+    for step in range(min(max_trees, len(P))):
+        cand = (acc[None, :] + P) / (step + 1)
+        cand = np.clip(cand, eps, 1 - eps)
+        loss = -np.where(y[None, :], np.log(cand), np.log(1 - cand)).mean(axis=1)
+        loss[~remaining] = np.inf
+        best = int(np.argmin(loss))
+        order.append(best)
+        remaining[best] = False
+        acc += P[best]
+    return order
+
+
+def _node_depths(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    depth = np.zeros(len(left), dtype=np.int64)
+    frontier = np.array([0], dtype=np.int64)
+    while frontier.size:
+        internal = frontier[left[frontier] != TREE_LEAF]
+        children = np.concatenate([left[internal], right[internal]])
+        depth[children] = np.tile(depth[internal] + 1, 2)
+        frontier = children
+    return depth
+
+
+def truncate_tree(estimator, max_depth: int):
+    """
+    Копия DecisionTreeClassifier, обрезанного до max_depth.
+    Узлы глубже выбрасываются из массива (файл реально уменьшается),
+    узлы на глубине max_depth становятся листьями.
+    """
+    tree = estimator.tree_
+    if tree.max_depth <= max_depth:
+        return estimator
+
+    state = tree.__getstate__()
+    nodes, values = state['nodes'], state['values']
+    left, right = nodes['left_child'], nodes['right_child']
+    depth = _node_depths(left, right)
+
+    keep = depth <= max_depth
+    new_index = np.cumsum(keep) - 1
+    new_nodes = nodes[keep].copy()
+    kept_depth = depth[keep]
+
+    internal = (new_nodes['left_child'] != TREE_LEAF) & (kept_depth < max_depth)
+    leaf = ~internal
+    new_nodes['left_child'][internal] = new_index[new_nodes['left_child'][internal]]
+    new_nodes['right_child'][internal] = new_index[new_nodes['right_child'][internal]]
+    new_nodes['left_child'][leaf] = TREE_LEAF
+    new_nodes['right_child'][leaf] = TREE_LEAF
+    new_nodes['feature'][leaf] = TREE_UNDEFINED
+    new_nodes['threshold'][leaf] = TREE_UNDEFINED
+    if 'missing_go_to_left' in new_nodes.dtype.names:
+        new_nodes['missing_go_to_left'][leaf] = 0
+
+    state['nodes'] = new_nodes
+    state['values'] = np.ascontiguousarray(values[keep])
+    state['node_count'] = int(keep.sum())
+    state['max_depth'] = int(max_depth)
+
+    new_tree = Tree(tree.n_features, np.asarray(tree.n_classes, dtype=np.intp), tree.n_outputs)
+    new_tree.__setstate__(state)
+    small = copy.copy(estimator)
+    small.tree_ = new_tree
+    small.max_depth = max_depth
+    return small
+
+
+def distill_forest(teacher: RandomForestClassifier, X_scaled: np.ndarray,
+                   n_estimators: int, max_depth: int, seed: int = 42) -> RandomForestClassifier:
+    """Маленький RF на мягких метках teacher: мягкая метка = вес строки на каждый класс."""
+    p = attack_proba(teacher, X_scaled)
+    X2 = np.concatenate([X_scaled, X_scaled])
+    y2 = np.concatenate([np.zeros(len(p), dtype=int), np.ones(len(p), dtype=int)])
+    w2 = np.concatenate([1.0 - p, p])
+    nonzero = w2 > 0
+
+    student = RandomForestClassifier(
+        n_estimators=n_estimators, max_depth=max_depth,
+        min_samples_split=5, min_samples_leaf=2,
+        random_state=seed, n_jobs=teacher.n_jobs,
+    )
+    student.fit(X2[nonzero], y2[nonzero], sample_weight=w2[nonzero])
+    return student
+
+
+def build_candidates(rf, methods, X_val, y_val, X_distill,
+                     subset_sizes=DEFAULT_SUBSET_SIZES, depth_caps=DEFAULT_DEPTH_CAPS,
+                     distill_grid=DEFAULT_DISTILL_GRID):
+    """Генератор (описание, лес) по выбранным методам."""
+    n_trees = len(rf.estimators_)
+    sizes = [k for k in subset_sizes if k < n_trees] if 'subset' in methods else []
+    depths = [d for d in depth_caps if d is not None] if 'depth' in methods else []
+
+    order = None
+    if sizes:
+        print(f"[compress] Жадный отбор деревьев на валидации ({len(X_val):,} строк)...")
+        order = greedy_tree_order(rf, X_val, y_val, max(sizes))
+
+    truncated = {}  # (индекс дерева, глубина) -> обрезанное дерево
+
+    def tree_at(i, d):
+        if d is None:
+            return rf.estimators_[i]
+        if (i, d) not in truncated:
+            truncated[(i, d)] = truncate_tree(rf.estimators_[i], d)
+        return truncated[(i, d)]
+
+    subsets = [(n_trees, list(range(n_trees)))]
+    subsets += [(k, order[:k]) for k in sizes]
+    for k, indices in subsets:
+        for d in [None] + depths:
+            if k == n_trees and d is None:
+                continue  # это исходная модель
+            if d is None:
+                method = 'subset'
+            elif k < n_trees:
+                method = 'subset+depth'
+            else:
+                method = 'depth'
+            forest = with_estimators(rf, [tree_at(i, d) for i in indices])
+            yield {'method': method, 'trees': k, 'max_depth': d}, forest
+
+    if 'distill' in methods:
+        for n_est, depth in distill_grid:
+            print(f"[compress] Дистилляция: {n_est} деревьев, глубина {depth}...")
+            student = distill_forest(rf, X_distill, n_est, depth)
+            yield {'method': 'distill', 'trees': n_est, 'max_depth': depth}, student
+
+
+def choose(candidates: list, latency_budget_ms, size_budget_mb):
+    """Лучший по F1 на валидации среди укладывающихся в бюджет; иначе самый быстрый."""
+    def fits(c):
+        if latency_budget_ms is not None and c['latency']['p99_ms'] > latency_budget_ms:
+            return False
+        if size_budget_mb is not None and c['size_mb'] > size_budget_mb:
+            return False
+        return True
+
+    ok = [c for c in candidates if fits(c)]
+    if ok:
+        return max(ok, key=lambda c: (c['val']['f1'], -c['latency']['p99_ms'])), True
+    return min(candidates, key=lambda c: (c['latency']['p99_ms'], c['size_mb'])), False
+
+
+# =============================================================
+# MAIN
+# =============================================================
+def compress(model: HybridIDS, X_train, X_holdout, y_holdout, methods,
+             latency_budget_ms=None, size_budget_mb=None, batch_rows=1000,
+             val_rows=20_000, distill_rows=200_000, repeats=30):
+    """
+    Перебирает кандидатов и возвращает (новый лес, отчёт).
+    X_* — сырые признаки в порядке model.feature_names.
+    X_train нужен только дистилляции (метки на нём ставит исходный RF);
+    hold-out делится на валидацию (выбор) и test (отчёт).
+    """
+    rf = model.supervised
+    rng = np.random.default_rng(42)
+
+    val_rows = min(val_rows, len(X_holdout) // 2)
+    X_val, X_test, y_val, y_test = train_test_split(
+        X_holdout, y_holdout, train_size=val_rows, stratify=y_holdout, random_state=42)
+    X_val = scale_features(X_val, model.scaler)
+    X_test_scaled = scale_features(X_test, model.scaler)
+
+    X_distill = None
+    if 'distill' in methods:
+        idx = rng.choice(len(X_train), min(distill_rows, len(X_train)), replace=False)
+        X_distill = scale_features(X_train[idx], model.scaler)
+
+    def describe(forest, meta):
+        return {
+            **meta,
+            'size_mb': round(forest_nbytes(forest) / 2**20, 3),
+            'leaves': int(sum(e.tree_.n_leaves for e in forest.estimators_)),
+            'latency': measure_latency(forest.predict_proba, X_test_scaled,
+                                       batch_rows, repeats),
+            'val': score(forest, X_val, y_val),
+        }
+
+    baseline = describe(rf, {'method': 'original', 'trees': len(rf.estimators_),
+                             'max_depth': rf.max_depth})
+    print(f"[compress] Исходная: {baseline['trees']} деревьев, {baseline['size_mb']} MB, "
+          f"p99={baseline['latency']['p99_ms']}ms, F1(val)={baseline['val']['f1']}")
+
+    candidates, forests = [], []
+    for meta, forest in build_candidates(rf, methods, X_val, y_val, X_distill):
+        info = describe(forest, meta)
+        candidates.append(info)
+        forests.append(forest)
+        print(f"[compress] {info['method']:13s} trees={info['trees']:<4} "
+              f"depth={str(info['max_depth']):<5} size={info['size_mb']:8.3f}MB "
+              f"p99={info['latency']['p99_ms']:8.3f}ms F1(val)={info['val']['f1']:.4f}")
+
+    if not candidates:
+        raise ValueError(f"Нет кандидатов для методов {methods}")
+    best, within_budget = choose(candidates, latency_budget_ms, size_budget_mb)
+    best_forest = forests[candidates.index(best)]
+    if not within_budget:
+        print("[compress] WARN: ни один кандидат не уложился в бюджет — "
+              "берём самый быстрый")
+
+    report = {
+        'budget': {'latency_p99_ms': latency_budget_ms, 'size_mb': size_budget_mb,
+                   'batch_rows': batch_rows},
+        'val_rows': int(len(y_val)),
+        'test_rows': int(len(y_test)),
+        'within_budget': within_budget,
+        'chosen': {k: best[k] for k in ('method', 'trees', 'max_depth')},
+        'before': {**baseline, 'test': score(rf, X_test_scaled, y_test)},
+        'after': {**best, 'test': score(best_forest, X_test_scaled, y_test)},
+        'candidates': candidates,
+    }
+    return best_forest, report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--model_path', default=None,
+                        help='Исходная RF-модель (по умолчанию — models/hybrid_ids_v2.pkl)')
+    parser.add_argument('--out_path', default=None,
+                        help='Куда сохранить сжатую (по умолчанию — *_compressed.pkl)')
+    parser.add_argument('--latency_budget_ms', type=float, default=None,
+                        help='p99 predict_proba на батче --batch_rows строк, мс')
+    parser.add_argument('--size_budget_mb', type=float, default=None,
+                        help='Размер массивов деревьев RF, MB')
+    parser.add_argument('--batch_rows', type=int, default=1000)
+    parser.add_argument('--methods', default='subset,depth',
+                        help='Через запятую: subset, depth, distill')
+    parser.add_argument('--val_rows', type=int, default=20_000)
+    parser.add_argument('--distill_rows', type=int, default=200_000)
+    args = parser.parse_args()
+
+    methods = {m.strip() for m in args.methods.split(',') if m.strip()}
+    unknown = methods - {'subset', 'depth', 'distill'}
+    if unknown:
+        parser.error(f"Неизвестные методы: {sorted(unknown)}")
+    if args.latency_budget_ms is None and args.size_budget_mb is None:
+        parser.error("Нужен хотя бы один бюджет: --latency_budget_ms или --size_budget_mb")
+
+    model_path = args.model_path or model_path_for('rf')
+    out_path = args.out_path or model_path.replace('.pkl', '_compressed.pkl')
+
+    print("=" * 70)
+    print(f"COMPRESS RF: {model_path}")
+    print("=" * 70)
+
+    model = HybridIDS.load(model_path)
+    df = clean_data(load_cicids(args.data_dir))
+    X_train, X_holdout, _, y_holdout = split_holdout(df, model.feature_names)
+    del df
+
+    forest, report = compress(model, X_train, X_holdout, y_holdout, methods,
+                              args.latency_budget_ms, args.size_budget_mb,
+                              args.batch_rows, args.val_rows, args.distill_rows)
+
+    small = copy.copy(model)
+    small.supervised = forest
+    small._cascade_parts = None
+    metrics = dict(model.metrics)
+    metrics['compression'] = {k: v for k, v in report.items() if k != 'candidates'}
+    metrics['compression']['source_model'] = os.path.basename(model_path)
+    json_path = out_path.replace('.pkl', '_features.json')
+    small.save(out_path, json_path=json_path, metrics=metrics)
+
+    report['before']['file_mb'] = round(os.path.getsize(model_path) / 2**20, 3)
+    report['after']['file_mb'] = round(os.path.getsize(out_path) / 2**20, 3)
+    report_path = out_path.replace('.pkl', '_report.json')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    b, a = report['before'], report['after']
+    print("\n" + "=" * 70)
+    print(f"DONE: {a['method']} (trees={a['trees']}, max_depth={a['max_depth']})"
+          f"{'' if report['within_budget'] else '  [ВНЕ БЮДЖЕТА]'}")
+    print("=" * 70)
+    print(f"F1 (test):   {b['test']['f1']} -> {a['test']['f1']}")
+    print(f"ROC-AUC:     {b['test']['roc_auc']} -> {a['test']['roc_auc']}")
+    print(f"Файл:        {b['file_mb']} MB -> {a['file_mb']} MB")
+    print(f"p50/p99:     {b['latency']['p50_ms']}/{b['latency']['p99_ms']} ms -> "
+          f"{a['latency']['p50_ms']}/{a['latency']['p99_ms']} ms")
+    print(f"Model:       {out_path}")
+    print(f"Report:      {report_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,8 @@ import json
 import numpy as np
 from collections import defaultdict
 
+from profiling import make_timer, profiled_response
+
 
 FLOW_TIMEOUT = 120.0       # сек — после этой паузы начинается НОВЫЙ flow
 ACTIVITY_TIMEOUT = 5.0     # сек — граница между active и idle периодом
@@ -410,18 +412,25 @@ def _build_flow_features(flow_id, flow_packets):
 # =============================================================
 # ПУБЛИЧНАЯ ФУНКЦИЯ — её будет вызывать C#
 # =============================================================
-def build_flows_from_packets(json_data):
+def build_flows_from_packets(json_data, profile=False, profile_top=0):
     """
     Принимает JSON-строку: список RawPacket.
     Возвращает JSON-строку: список flow-объектов со всеми признаками.
+
+    profile=True — {"flows": [...], "profile": {...}} со временем стадий
+    parse / split / features / serialize в мкс (см. profiling.py).
     """
+    timer = make_timer(profile, profile_top)
     packets = json.loads(json_data)
+    timer.lap('parse')
     print(f"[flow_features] Received {len(packets)} raw packets")
 
     if len(packets) == 0:
-        return json.dumps([])
+        return json.dumps([]) if not profile else profiled_response('flows', '[]', timer)
 
     flows_dict = _split_into_flows(packets)
+    timer.lap('split')
+    timer.count('packets', len(packets))
     print(f"[flow_features] Grouped into {len(flows_dict)} flows")
 
     result = []
@@ -432,8 +441,12 @@ def build_flows_from_packets(json_data):
         except Exception as e:
             print(f"[flow_features] Skipped flow {flow_id}: {e}")
 
+    timer.lap('features')
+    timer.count('flows', len(result))
     print(f"[flow_features] Built features for {len(result)} flows")
-    return json.dumps(result, default=str)
+    out = json.dumps(result, default=str)
+    timer.lap('serialize')
+    return out if not profile else profiled_response('flows', out, timer)
 
 
 # =============================================================
@@ -13,6 +13,15 @@ PythonScripts/hybrid_ids.py  (v2.1, with in-process cache)
   - Добавлен модульный кеш моделей (_MODEL_CACHE) - загруженная модель
     остаётся в памяти Python-процесса между вызовами. Это убирает ~20 сек
     на повторные запросы от C# backend.
+  - update(X_new, y_new): дообучение без полного переобучения —
+    новые деревья RF через warm_start, IF переобучается на резервуаре
+    нормальных flows, revision артефакта увеличивается
+    (CLI: update_hybrid_model.py).
+  - explain_batch: вклады признаков в вероятность атаки RF для
+    подозрительных flows — TreeSHAP (если установлен shap) или
+    векторизованное разложение по путям деревьев (Saabas).
+  - allowlist.json рядом с моделью (или IDS_ALLOWLIST): flows из
+    allow-list получают method='allowlist' без инференса (allowlist.py).
 
 Формат .pkl (joblib):
   {
@@ -21,7 +30,11 @@ PythonScripts/hybrid_ids.py  (v2.1, with in-process cache)
     'supervised':   RandomForestClassifier,
     'anomaly_detector': IsolationForest,
     'scaler': StandardScaler,
-    'metrics': {'accuracy': ..., 'f1': ..., ...}   # опционально
+    'metrics': {'accuracy': ..., 'f1': ..., ...},  # опционально
+    'revision': 0,                  # число update() поверх обучения
+    'normal_reservoir': ndarray,    # сырые нормальные flows для IF (float32)
+    'reservoir_seen': int,          # сколько нормальных flows прошло через резервуар
+    'reservoir_seeded': bool,       # резервуар заполнен train() из обучающей нормы
   }
 
 Плюс рядом лежит models/global_features.json:
@@ -29,17 +42,40 @@ PythonScripts/hybrid_ids.py  (v2.1, with in-process cache)
 """
 
 import os
+import copy
 import json
+import time
 import numpy as np
 import joblib
-from typing import Dict, List
+from typing import Dict, Iterator, List
 
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier, IsolationForest
 from sklearn.preprocessing import StandardScaler
+from sklearn.utils.class_weight import compute_class_weight
+from scipy.sparse import csr_matrix
+
+from ids_common import (extract_feature_matrix, format_predictions, PredictionCache,
+                        iter_item_chunks, DEFAULT_STREAM_CHUNK,
+                        make_cascade_config, scale_features, predict_matrix,
+                        explain_items, DEFAULT_EXPLAIN_CACHE_SIZE)
+from profiling import NULL_TIMER, make_timer, profiled_response
+from allowlist import Allowlist
+
+
+try:
+    import shap as _shap   # опционально: точный TreeSHAP в explain_batch
+except ImportError:
+    _shap = None
 
 
 MODEL_VERSION = "2.0"
 
+# Размер резервуара нормальных flows, на котором переобучается IF в update()
+DEFAULT_RESERVOIR_SIZE = 50_000
+# Меньше этого IF в update() не переобучаем — оставляем прежний
+MIN_IF_REFIT_ROWS = 256
+
 # ============================================================
 # КЕШ НА УРОВНЕ МОДУЛЯ
 # ============================================================
@@ -63,6 +99,19 @@ class HybridIDS:
         self.anomaly_detector: IsolationForest = None
         self.scaler: StandardScaler = None
         self.feature_names: List[str] = []
+        self.model_version: str = MODEL_VERSION
+        self.prediction_cache: PredictionCache = None
+        self.allowlist: Allowlist = None
+        self.cascade: Dict = None
+        self._cascade_parts = None
+        self.explanation_cache = PredictionCache(DEFAULT_EXPLAIN_CACHE_SIZE)
+        self._explainer = None
+        self.metrics: Dict = {}
+        self.revision: int = 0
+        self.normal_reservoir: np.ndarray = None
+        self.reservoir_seen: int = 0
+        self.reservoir_seeded = False
+        self._rng = np.random.default_rng()
         self._is_loaded = False
 
     # ------------------------------------------------------------------
@@ -99,6 +148,18 @@ class HybridIDS:
         )
         self.anomaly_detector.fit(X_normal)
 
+        # Резервуар для будущих update(): равномерная выборка сырой нормы
+        # (то же состояние, что дал бы алгоритм R после всех нормальных строк)
+        normal_idx = np.flatnonzero(normal_mask)
+        self.reservoir_seen = len(normal_idx)
+        if len(normal_idx) > DEFAULT_RESERVOIR_SIZE:
+            normal_idx = np.sort(self._rng.choice(
+                normal_idx, DEFAULT_RESERVOIR_SIZE, replace=False))
+        self.normal_reservoir = np.ascontiguousarray(X_train[normal_idx], dtype=np.float32)
+        self.reservoir_seeded = True
+        self.revision = 0
+
+        self.model_version = f"{MODEL_VERSION}@trained-{time.time():.0f}"
         self._is_loaded = True
 
         print(f"\n[HybridIDS] Feature importances:")
@@ -109,6 +170,159 @@ class HybridIDS:
         for name, imp in imp_pairs:
             print(f"    {name:30s}  {imp:.4f}")
 
+    # ------------------------------------------------------------------
+    # Дообучение на новых размеченных flows
+    # ------------------------------------------------------------------
+    def _add_to_reservoir(self, X_normal: np.ndarray,
+                          reservoir_size: int = DEFAULT_RESERVOIR_SIZE):
+        """
+        Reservoir sampling (алгоритм R) по сырым нормальным flows:
+        резервуар — равномерная выборка из всех нормальных flows,
+        когда-либо переданных в train()/update(), не больше reservoir_size строк.
+        """
+        X_normal = np.ascontiguousarray(X_normal, dtype=np.float32)
+        if len(X_normal) == 0:
+            return
+        res = self.normal_reservoir
+        if res is None:
+            res = np.empty((0, X_normal.shape[1]), dtype=np.float32)
+        elif not res.flags.writeable:
+            res = np.array(res)  # загружен через mmap_mode='r'
+
+        # Пока резервуар не заполнен — просто дописываем
+        free = max(0, reservoir_size - len(res))
+        head, rest = X_normal[:free], X_normal[free:]
+        if len(head):
+            res = np.concatenate([res, head])
+        self.reservoir_seen += len(head)
+
+        if len(rest):
+            # Строка с порядковым номером t заменяет случайный слот j < size
+            # с вероятностью size / (t + 1)
+            t = self.reservoir_seen + np.arange(len(rest))
+            j = (self._rng.random(len(rest)) * (t + 1)).astype(np.int64)
+            keep = j < len(res)
+            res[j[keep]] = rest[keep]
+            self.reservoir_seen += len(rest)
+
+        self.normal_reservoir = res
+
+    def update(self, X_new: np.ndarray, y_new: np.ndarray, n_new_trees: int = 20,
+               max_trees: int = None, refit_anomaly: bool = True,
+               reservoir_size: int = DEFAULT_RESERVOIR_SIZE,
+               refit_unseeded: bool = False) -> Dict:
+        """
+        Дообучение на новых размеченных flows (подтверждённые аналитиком метки)
+        без прогона всего CICIDS.
+
+          - RF: warm_start, добавляется n_new_trees деревьев, обученных
+            на X_new; если задан max_trees — самые старые деревья
+            отбрасываются, чтобы лес не рос бесконечно;
+          - IF: нормальные строки X_new попадают в резервуар, и IF
+            переобучается на нём целиком (с прежними гиперпараметрами).
+            Только если резервуар засеян train() обучающей нормой: у
+            артефактов до update() его нет, и IF, переобученный на одних
+            новых flows, забыл бы всю обучающую норму — такой refit
+            пропускается (резервуар при этом копится), refit_unseeded=True
+            включает его явно;
+          - scaler не меняется: старые деревья обучены в его координатах;
+          - revision увеличивается, model_version меняется — кеш
+            предсказаний и каскад сбрасываются.
+
+        X_new — сырые признаки в порядке self.feature_names.
+        Сохранение — как обычно через save().
+        """
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите HybridIDS.load()")
+        X_new = np.asarray(X_new)
+        y_new = np.asarray(y_new).astype(int)
+        if X_new.ndim != 2 or X_new.shape[1] != len(self.feature_names):
+            raise ValueError(f"X_new должен иметь {len(self.feature_names)} столбцов, "
+                             f"получено {X_new.shape}")
+        if len(X_new) != len(y_new):
+            raise ValueError("X_new и y_new разной длины")
+        if n_new_trees < 1:
+            raise ValueError("n_new_trees должно быть >= 1")
+        # Новые деревья должны знать оба класса, иначе их predict_proba
+        # не совпадёт по столбцам со старыми
+        missing = set(self.supervised.classes_.tolist()) - set(np.unique(y_new).tolist())
+        if missing:
+            raise ValueError(f"В y_new нет классов {sorted(missing)} — "
+                             f"для warm_start нужны примеры всех классов")
+
+        X_new = np.nan_to_num(np.ascontiguousarray(X_new, dtype=np.float32),
+                              nan=0.0, posinf=0.0, neginf=0.0)
+        X_scaled = scale_features(X_new, self.scaler)
+        trees_before = len(self.supervised.estimators_)
+
+        print(f"[HybridIDS] Update r{self.revision + 1}: {len(X_new)} flows "
+              f"(атак: {int((y_new == 1).sum())}), +{n_new_trees} деревьев")
+
+        rf = self.supervised
+        class_weight = rf.class_weight
+        if class_weight in ('balanced', 'balanced_subsample'):
+            # Те же веса, что дал бы 'balanced' на X_new, но явно —
+            # sklearn не принимает пресеты вместе с warm_start
+            weights = compute_class_weight('balanced', classes=rf.classes_, y=y_new)
+            rf.class_weight = dict(zip(rf.classes_.tolist(), weights))
+        rf.warm_start = True
+        rf.n_estimators = trees_before + n_new_trees
+        try:
+            rf.fit(X_scaled, y_new)
+        finally:
+            rf.warm_start = False
+            rf.class_weight = class_weight
+
+        dropped = 0
+        if max_trees is not None and len(rf.estimators_) > max_trees:
+            dropped = len(rf.estimators_) - max_trees
+            rf.estimators_ = rf.estimators_[dropped:]
+            rf.n_estimators = len(rf.estimators_)
+
+        self._add_to_reservoir(X_new[y_new == 0], reservoir_size)
+        anomaly_refit = False
+        n_reservoir = 0 if self.normal_reservoir is None else len(self.normal_reservoir)
+        if refit_anomaly and not (self.reservoir_seeded or refit_unseeded):
+            refit_anomaly = False
+            print(f"[HybridIDS] WARN: резервуар не засеян обучающей нормой (модель "
+                  f"до update()) — в нём только новые flows ({n_reservoir}); "
+                  f"IsolationForest не переобучен, refit_unseeded=True — переобучить")
+        if refit_anomaly and n_reservoir >= MIN_IF_REFIT_ROWS:
+            detector = clone(self.anomaly_detector)
+            detector.fit(scale_features(self.normal_reservoir, self.scaler))
+            self.anomaly_detector = detector
+            anomaly_refit = True
+        elif refit_anomaly:
+            print(f"[HybridIDS] WARN: в резервуаре {n_reservoir} нормальных flows "
+                  f"(< {MIN_IF_REFIT_ROWS}) — IsolationForest не переобучен")
+
+        self.revision += 1
+        self.model_version = f"{MODEL_VERSION}@r{self.revision}-{time.time():.0f}"
+        self._cascade_parts = None
+        self._explainer = None
+        if self.prediction_cache is not None:
+            self.prediction_cache.clear()
+
+        summary = {
+            'revision': self.revision,
+            'rows': int(len(X_new)),
+            'attacks': int((y_new == 1).sum()),
+            'trees_before': int(trees_before),
+            'trees_added': int(n_new_trees),
+            'trees_dropped': int(dropped),
+            'trees_after': int(len(rf.estimators_)),
+            'anomaly_refit': anomaly_refit,
+            'reservoir_rows': int(n_reservoir),
+            'reservoir_seen': int(self.reservoir_seen),
+            'reservoir_seeded': bool(self.reservoir_seeded),
+            'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        self.metrics.setdefault('updates', []).append(summary)
+        print(f"[HybridIDS] Update готов: деревьев {trees_before} -> "
+              f"{summary['trees_after']} (отброшено {dropped}), "
+              f"IF {'переобучен' if anomaly_refit else 'без изменений'}")
+        return summary
+
     # ------------------------------------------------------------------
     # Сохранение / загрузка
     # ------------------------------------------------------------------
@@ -122,8 +336,16 @@ class HybridIDS:
             'anomaly_detector': self.anomaly_detector,
             'scaler': self.scaler,
             'metrics': metrics or {},
+            'revision': self.revision,
+            'normal_reservoir': self.normal_reservoir,
+            'reservoir_seen': self.reservoir_seen,
+            'reservoir_seeded': self.reservoir_seeded,
         }
-        joblib.dump(payload, model_path)
+        # Через временный файл: модель могла быть загружена с mmap_mode='r'
+        # из этого же .pkl — перезапись на месте испортила бы её массивы
+        tmp_path = model_path + '.tmp'
+        joblib.dump(payload, tmp_path)
+        os.replace(tmp_path, model_path)
         print(f"[HybridIDS] Модель сохранена: {model_path}")
 
         # Сбрасываем кеш после сохранения — чтобы следующий load()
@@ -140,6 +362,7 @@ class HybridIDS:
         meta = {
             'feature_names': self.feature_names,
             'model_version': MODEL_VERSION,
+            'revision': self.revision,
             'model_file': os.path.basename(model_path),
             'trained_on': 'CICIDS-2017',
             'metrics': metrics or {},
@@ -149,10 +372,15 @@ class HybridIDS:
         print(f"[HybridIDS] Meta JSON: {json_path}")
 
     @classmethod
-    def load(cls, model_path: str) -> 'HybridIDS':
+    def load(cls, model_path: str, mmap_mode: str = None) -> 'HybridIDS':
         """
         Загружает модель из .pkl с кешированием.
         Если модель уже в кеше и файл не изменился - возвращает из кеша.
+
+        mmap_mode='r' — обычные numpy-массивы payload (normal_reservoir)
+        отображаются из файла и делятся воркерами inference_server.py через
+        page cache ОС. Деревья sklearn так не делятся: Tree.__setstate__
+        копирует узлы в память процесса.
         """
         if not os.path.exists(model_path):
             raise FileNotFoundError(
@@ -176,14 +404,26 @@ class HybridIDS:
 
         # Реально загружаем с диска
         print(f"[HybridIDS] CACHE MISS: loading {os.path.basename(abs_path)}...")
-        payload = joblib.load(abs_path)
+        payload = joblib.load(abs_path, mmap_mode=mmap_mode)
         instance = cls()
         instance.supervised = payload['supervised']
         instance.anomaly_detector = payload['anomaly_detector']
         instance.scaler = payload['scaler']
         instance.feature_names = payload.get('feature_names', [])
+        instance.metrics = payload.get('metrics', {})
+        # Артефакты до update() этих ключей не имеют
+        instance.revision = payload.get('revision', 0)
+        instance.normal_reservoir = payload.get('normal_reservoir')
+        instance.reservoir_seen = payload.get('reservoir_seen', 0)
+        # Без ключа: резервуар с revision 0 мог положить только train()
+        instance.reservoir_seeded = payload.get(
+            'reservoir_seeded',
+            instance.normal_reservoir is not None and instance.revision == 0)
+        instance.model_version = f"{payload.get('version', '?')}@{mtime}"
         instance._is_loaded = True
 
+        instance.allowlist = Allowlist.for_model(abs_path)
+
         # Сохраняем в кеш
         _MODEL_CACHE[cache_key] = instance
 
@@ -195,127 +435,335 @@ class HybridIDS:
     # Предсказание
     # ------------------------------------------------------------------
     def _predict_vector(self, features_vec: List[float]) -> Dict:
-        X = np.array(features_vec, dtype=float).reshape(1, -1)
-        X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
-        X_scaled = self.scaler.transform(X)
-
-        rf_pred = int(self.supervised.predict(X_scaled)[0])
-        rf_proba = float(self.supervised.predict_proba(X_scaled)[0, 1])
+        """
+        Один вектор признаков (в порядке feature_names) — тем же путём, что
+        predict_items: сборка и скейлинг в extract_feature_matrix, затем
+        _predict_raw, поэтому ответ совпадает с batch-предсказанием.
+        """
+        item = dict(zip(self.feature_names, features_vec))
+        X = extract_feature_matrix([item], self.feature_names, scaler=self.scaler)
+        rf_preds, rf_probas, if_raw, _ = self._predict_raw(X, scaled=True)
+        pred = format_predictions([item], rf_preds, rf_probas, if_raw)[0]
+        return {key: pred[key] for key in ('isAttack', 'confidence', 'threatLevel',
+                                           'method', 'rfPrediction', 'isAnomaly')}
+
+    def predict_proba_supervised(self, X: np.ndarray) -> np.ndarray:
+        """Вероятность атаки от RF для сырой матрицы признаков."""
+        proba = self.supervised.predict_proba(scale_features(X, self.scaler))
+        return proba[:, int(np.flatnonzero(self.supervised.classes_ == 1)[0])]
+
+    def _predict_raw(self, X: np.ndarray, inplace: bool = False, timer=NULL_TIMER,
+                     scaled: bool = False):
+        """
+        Матрица признаков -> (pred, proba атаки, сырой ответ IF: -1/1,
+        ступень каскада: 1 — решено первыми деревьями, 2 — полным ансамблем).
+
+        scaled=True — X уже отскейлен при сборке
+        (extract_feature_matrix(..., scaler=self.scaler)); иначе X сырой и
+        скейлится здесь (inplace=True — прямо в своём буфере). RF и IF
+        получают float32 C-contiguous и не делают собственных копий.
+        timer — profiling.StageTimer (стадии scale / supervised / anomaly).
+        """
+        if scaled:
+            X_scaled = X
+        else:
+            with timer.stage('scale'):
+                X_scaled = scale_features(X, self.scaler, inplace=inplace)
+        if self.cascade is not None:
+            return self._predict_cascade(X_scaled, timer)
+
+        # Батч-инференс — гораздо быстрее чем N одиночных вызовов.
+        # Класс — argmax(proba), ровно как в RandomForestClassifier.predict
+        with timer.stage('supervised'):
+            proba = self.supervised.predict_proba(X_scaled)
+            rf_preds = self.supervised.classes_.take(np.argmax(proba, axis=1))
+            rf_probas = proba[:, 1]
+        with timer.stage('anomaly'):
+            if_raw = self.anomaly_detector.predict(X_scaled)
+        timer.count('supervisedRows', len(X_scaled))
+        timer.count('anomalyRows', len(X_scaled))
+        stages = np.full(len(X_scaled), 2, dtype=np.int64)
+        return rf_preds, rf_probas, if_raw, stages
 
-        if_raw = int(self.anomaly_detector.predict(X_scaled)[0])
-        is_anomaly = 1 if if_raw == -1 else 0
+    # ------------------------------------------------------------------
+    # Каскад: первые N деревьев RF как дешёвый пре-фильтр
+    # ------------------------------------------------------------------
+    def configure_cascade(self, first_stage_trees: int = 20, low: float = 0.1,
+                          high: float = 0.9, anomaly_on_all: bool = False):
+        """
+        Включает каскадный инференс. Первая ступень — первые
+        first_stage_trees деревьев RF. Строки с proba <= low или >= high
+        решаются сразу; остальные досчитываются оставшимися деревьями
+        (итоговая proba совпадает с полным RF) и проходят IsolationForest.
+        См. ids_common.make_cascade_config.
+        """
+        self.cascade = make_cascade_config(first_stage_trees, low, high, anomaly_on_all)
+        self._cascade_parts = None
+        print(f"[HybridIDS] Cascade enabled: {self.cascade}")
 
-        is_attack = bool(rf_pred == 1 or is_anomaly == 1)
+    def disable_cascade(self):
+        self.cascade = None
+        self._cascade_parts = None
 
-        if rf_proba >= 0.8:
-            threat = 'Critical'
-        elif rf_proba >= 0.6:
-            threat = 'High'
-        elif rf_proba >= 0.4:
-            threat = 'Medium'
-        else:
-            threat = 'Low'
+    def _cascade_forests(self):
+        """
+        Делит RF на «голову» (первые N деревьев) и «хвост» (остальные).
+        Оба — поверхностные копии RF с урезанным estimators_, поэтому
+        predict_proba работает как обычно, с тем же n_jobs.
+        """
+        trees = self.supervised.estimators_
+        n_head = min(self.cascade['first_stage_trees'], len(trees))
+        key = (id(self.supervised), n_head)
+        if self._cascade_parts is None or self._cascade_parts[0] != key:
+            head = copy.copy(self.supervised)
+            head.estimators_ = trees[:n_head]
+            head.n_estimators = n_head
+            tail = copy.copy(self.supervised)
+            tail.estimators_ = trees[n_head:]
+            tail.n_estimators = len(trees) - n_head
+            self._cascade_parts = (key, head, tail)
+        return self._cascade_parts[1], self._cascade_parts[2]
+
+    def _predict_cascade(self, X_scaled: np.ndarray, timer=NULL_TIMER):
+        cfg = self.cascade
+        n = len(X_scaled)
+        classes = self.supervised.classes_
+        attack_col = int(np.flatnonzero(classes == 1)[0]) if (classes == 1).any() else 1
+        head, tail = self._cascade_forests()
+        n_head, n_tail = head.n_estimators, tail.n_estimators
+
+        with timer.stage('supervised'):
+            proba = head.predict_proba(X_scaled)
+            p_attack = proba[:, attack_col]
+            uncertain = (p_attack > cfg['low']) & (p_attack < cfg['high'])
+            stages = np.where(uncertain, 2, 1).astype(np.int64)
+
+            if uncertain.any() and n_tail > 0:
+                p_tail = tail.predict_proba(X_scaled[uncertain])
+                # Среднее по всем деревьям = взвешенное среднее головы и хвоста
+                proba[uncertain] = (n_head * proba[uncertain] + n_tail * p_tail) / (n_head + n_tail)
+
+            rf_preds = classes.take(np.argmax(proba, axis=1))
+
+        n_uncertain = int(uncertain.sum())
+        timer.count('supervisedRows', n)
+        timer.count('cascadeStage2Rows', n_uncertain)
+
+        if_raw = np.ones(n, dtype=np.int64)
+        with timer.stage('anomaly'):
+            if cfg['anomaly_on_all']:
+                if_raw = self.anomaly_detector.predict(X_scaled)
+            elif n_uncertain:
+                if_raw[uncertain] = self.anomaly_detector.predict(X_scaled[uncertain])
+        timer.count('anomalyRows', n if cfg['anomaly_on_all'] else n_uncertain)
+
+        return rf_preds, proba[:, attack_col], if_raw, stages
+
+    def _inference_version(self) -> str:
+        """Версия для кеша предсказаний: модель + режим каскада."""
+        return f"{self.model_version}|cascade={self.cascade}"
+
+    def predict_items(self, items: List[Dict], timer=NULL_TIMER) -> List[Dict]:
+        """
+        Batch-предсказание для уже распарсенного списка flows.
+        Векторизованный вызов — быстрее чем по одному.
+        """
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите HybridIDS.load()")
+        if not items:
+            return []
+        if self.allowlist is not None:
+            return self.allowlist.apply(
+                items, lambda rest: self._predict_model_items(rest, timer), timer,
+                cascade=self.cascade is not None)
+        return self._predict_model_items(items, timer)
+
+    def _predict_model_items(self, items: List[Dict], timer=NULL_TIMER) -> List[Dict]:
+        """Модель для flows вне allow-list (items не пустой)."""
+        # Скейлинг — в float64: RF и IF видят ровно scaler.transform(X64),
+        # приведённый к float32
+        with timer.stage('matrix'):
+            if self.prediction_cache is None:
+                raw = None
+                X = extract_feature_matrix(items, self.feature_names, scaler=self.scaler)
+            else:
+                # Ключи кеша — сырые float32-признаки, как у CatBoostIDS
+                raw = extract_feature_matrix(items, self.feature_names, dtype=np.float64)
+                X = scale_features(raw, self.scaler)
+                raw = raw.astype(np.float32)
+        timer.count('rows', len(items))
+        rf_preds, rf_probas, if_raw, stages = predict_matrix(
+            self, X, timer, scaled=True, key_matrix=raw)
+
+        with timer.stage('format'):
+            return format_predictions(items, rf_preds, rf_probas, if_raw,
+                                      stages if self.cascade is not None else None)
+
+    def predict_batch(self, json_data: str, profile: bool = False,
+                      profile_top: int = 0) -> str:
+        """
+        Batch-предсказание для списка flows (JSON in -> JSON out).
 
-        if is_anomaly == 1 and rf_pred == 0 and threat == 'Low':
-            threat = 'Medium'
+        profile=True — ответ {"predictions": [...], "profile": {...}}:
+        время стадий в мкс (parse, matrix — вместе со скейлингом, supervised,
+        anomaly, serialize; cache — если включён кеш), счётчики строк,
+        при profile_top > 0 — cProfile top-N. Без profile — как раньше, список.
+        """
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите HybridIDS.load()")
 
-        if is_anomaly == 1 and rf_pred == 0:
-            method = 'unsupervised'
-        elif is_anomaly == 1 and rf_pred == 1:
-            method = 'both'
-        elif rf_pred == 1:
-            method = 'supervised'
-        else:
-            method = 'none'
-
-        return {
-            'isAttack': is_attack,
-            'confidence': round(rf_proba, 4),
-            'threatLevel': threat,
-            'method': method,
-            'rfPrediction': rf_pred,
-            'isAnomaly': bool(is_anomaly),
-        }
+        timer = make_timer(profile, profile_top)
+        with timer.stage('parse'):
+            items = json.loads(json_data)
+        predictions = self.predict_items(items, timer)
+        with timer.stage('serialize'):
+            out = json.dumps(predictions)
+        return out if not profile else profiled_response('predictions', out, timer)
 
-    def predict_batch(self, json_data: str) -> str:
+    def predict_batch_iter(self, source, chunk_size: int = DEFAULT_STREAM_CHUNK,
+                           as_json: bool = True) -> Iterator:
         """
-        Batch-предсказание для списка flows. Векторизованный вызов —
-        быстрее чем по одному.
+        Потоковый вариант predict_batch для сессий на миллионы flows.
+
+        source — итерируемое с чанками flows (list[dict]), отдельными flows
+        или строками NDJSON (см. ids_common.iter_item_chunks). Предсказания
+        отдаются чанками по chunk_size: JSON-строка (as_json=True) или список.
+        Пиковая память ~ chunk_size × ширина строки, а не вся сессия.
         """
         if not self._is_loaded:
             raise RuntimeError("Модель не загружена. Вызовите HybridIDS.load()")
 
-        items = json.loads(json_data)
-        if not items:
-            return json.dumps([])
-
-        # Собираем матрицу фичей для batch-инференса
-        feat_matrix = []
-        for item in items:
-            vec = []
-            for feat in self.feature_names:
-                val = item.get(feat)
-                if val is None:
-                    camel = feat[0].lower() + feat[1:]
-                    val = item.get(camel, 0.0)
-                try:
-                    vec.append(float(val) if val is not None else 0.0)
-                except (TypeError, ValueError):
-                    vec.append(0.0)
-            feat_matrix.append(vec)
-
-        X = np.array(feat_matrix, dtype=float)
-        X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
-        X_scaled = self.scaler.transform(X)
-
-        # Батч-инференс — гораздо быстрее чем N одиночных вызовов
-        rf_preds = self.supervised.predict(X_scaled)
-        rf_probas = self.supervised.predict_proba(X_scaled)[:, 1]
-        if_raw = self.anomaly_detector.predict(X_scaled)
-
-        results = []
-        for i, item in enumerate(items):
-            rf_pred = int(rf_preds[i])
-            rf_proba = float(rf_probas[i])
-            is_anomaly = 1 if int(if_raw[i]) == -1 else 0
-
-            is_attack = bool(rf_pred == 1 or is_anomaly == 1)
-
-            if rf_proba >= 0.8:
-                threat = 'Critical'
-            elif rf_proba >= 0.6:
-                threat = 'High'
-            elif rf_proba >= 0.4:
-                threat = 'Medium'
-            else:
-                threat = 'Low'
+        for chunk in iter_item_chunks(source, chunk_size):
+            preds = self.predict_items(chunk)
+            yield json.dumps(preds) if as_json else preds
+
+    # ------------------------------------------------------------------
+    # Объяснения: вклады признаков в вероятность атаки RF
+    # ------------------------------------------------------------------
+    def explain_method(self) -> str:
+        return 'treeshap' if _shap is not None else 'saabas'
 
-            if is_anomaly == 1 and rf_pred == 0 and threat == 'Low':
-                threat = 'Medium'
+    def explain_output_space(self) -> str:
+        return 'probability'
 
-            if is_anomaly == 1 and rf_pred == 0:
-                method = 'unsupervised'
-            elif is_anomaly == 1 and rf_pred == 1:
-                method = 'both'
-            elif rf_pred == 1:
-                method = 'supervised'
+    def _tree_explainer(self):
+        """
+        shap.TreeExplainer по RF или, без shap, разложение по путям
+        (Saabas): для каждого дерева разреженная матрица (узлы × признаки),
+        где у узла стоит приращение вероятности атаки относительно
+        родителя в столбце признака родителя. Строится один раз на
+        набор деревьев (после update() — заново).
+        """
+        key = (id(self.supervised), len(self.supervised.estimators_), self.revision)
+        if self._explainer is None or self._explainer[0] != key:
+            rf = self.supervised
+            attack_col = int(np.flatnonzero(rf.classes_ == 1)[0])
+            if _shap is not None:
+                explainer = _shap.TreeExplainer(rf)
             else:
-                method = 'none'
-
-            results.append({
-                'isAttack': is_attack,
-                'confidence': round(rf_proba, 4),
-                'threatLevel': threat,
-                'method': method,
-                'rfPrediction': rf_pred,
-                'isAnomaly': bool(is_anomaly),
-                'sourceIP': item.get('SourceIP', item.get('sourceIP', '')),
-                'destinationIP': item.get('DestinationIP',
-                                          item.get('destinationIP', '')),
-                'destinationPort': int(
-                    item.get('DestinationPort',
-                             item.get('destinationPort', 0)) or 0),
-                'protocol': item.get('Protocol', item.get('protocol', '')),
-            })
-
-        return json.dumps(results)
+                n_features = len(self.feature_names)
+                paths, bias = [], 0.0
+                for est in rf.estimators_:
+                    tree = est.tree_
+                    value = tree.value[:, 0, :]
+                    p_attack = value[:, attack_col] / value.sum(axis=1)
+                    internal = np.flatnonzero(tree.children_left >= 0)
+                    parent = np.full(tree.node_count, -1, dtype=np.int64)
+                    parent[tree.children_left[internal]] = internal
+                    parent[tree.children_right[internal]] = internal
+                    child = np.flatnonzero(parent >= 0)
+                    delta = p_attack[child] - p_attack[parent[child]]
+                    paths.append((est, csr_matrix(
+                        (delta, (child, tree.feature[parent[child]])),
+                        shape=(tree.node_count, n_features))))
+                    bias += p_attack[0]
+                explainer = (paths, bias / len(rf.estimators_))
+            self._explainer = (key, explainer, attack_col)
+        return self._explainer[1], self._explainer[2]
+
+    def _explain_raw(self, X: np.ndarray):
+        """
+        Сырая матрица -> (base, contrib): base + contrib.sum(1) =
+        вероятность атаки RF для каждой строки.
+        """
+        X_scaled = scale_features(X, self.scaler)
+        explainer, attack_col = self._tree_explainer()
+
+        if _shap is not None:
+            sv = explainer.shap_values(X_scaled, check_additivity=False)
+            # Формат shap_values зависит от версии shap: список по классам или 3D
+            sv = sv[attack_col] if isinstance(sv, list) else np.asarray(sv)
+            if sv.ndim == 3:
+                sv = sv[:, :, attack_col]
+            expected = np.atleast_1d(explainer.expected_value)
+            base_value = expected[attack_col] if len(expected) > 1 else expected[0]
+            return np.full(len(X), float(base_value)), np.asarray(sv, dtype=np.float64)
+
+        paths, base_value = explainer
+        contrib = np.zeros((len(X), len(self.feature_names)), dtype=np.float64)
+        for est, delta in paths:
+            contrib += (est.decision_path(X_scaled, check_input=False) @ delta).toarray()
+        contrib /= len(paths)
+        return np.full(len(X), base_value), contrib
+
+    def explain_items(self, items: List[Dict], threshold: float = 0.5,
+                      top_k: int = 10) -> Dict:
+        """Объяснения для flows с вероятностью атаки >= threshold (см. ids_common.explain_items)."""
+        if not self._is_loaded:
+            raise RuntimeError("Модель не загружена. Вызовите HybridIDS.load()")
+        return explain_items(self, items, threshold, top_k)
+
+    def explain_batch(self, json_data: str, threshold: float = 0.5,
+                      top_k: int = 10) -> str:
+        """
+        JSON in (список flows) -> JSON out:
+        {"method", "outputSpace", "totalRows", "explainedRows", "cacheHits",
+         "explanations": [{"index", "flowId", "probability", "baseValue",
+                           "contributions": [{"feature", "value", "contribution"}]}]}
+        """
+        return json.dumps(self.explain_items(json.loads(json_data), threshold, top_k))
+
+    # ------------------------------------------------------------------
+    # Кеш предсказаний
+    # ------------------------------------------------------------------
+    def enable_prediction_cache(self, max_size: int = 100_000,
+                                quantize_decimals: int = None):
+        """
+        Включает LRU-кеш предсказаний по вектору отобранных признаков
+        (сырых, до скейлинга: quantize_decimals — знаки в исходных единицах,
+        см. ids_common.PredictionCache). Повторное включение сбрасывает кеш.
+        """
+        self.prediction_cache = PredictionCache(max_size, quantize_decimals)
+        print(f"[HybridIDS] Prediction cache enabled: max_size={max_size}, "
+              f"quantize={quantize_decimals}")
+
+    def disable_prediction_cache(self):
+        self.prediction_cache = None
+
+    def prediction_cache_stats(self) -> str:
+        if self.prediction_cache is None:
+            return json.dumps({'enabled': False})
+        return json.dumps({'enabled': True, **self.prediction_cache.stats()})
+
+    # ------------------------------------------------------------------
+    # Allow-list (быстрая полоса без инференса, см. allowlist.py)
+    # ------------------------------------------------------------------
+    def enable_allowlist(self, rules) -> str:
+        """
+        rules — путь к JSON-файлу правил, JSON-строка или список правил.
+        Подходящие flows получают method='allowlist' без вызова модели.
+        """
+        if isinstance(rules, str) and os.path.exists(rules):
+            self.allowlist = Allowlist.from_file(rules)
+        else:
+            self.allowlist = Allowlist(json.loads(rules) if isinstance(rules, str) else rules)
+        print(f"[HybridIDS] Allowlist enabled: {len(self.allowlist.rules)} правил")
+        return self.allowlist_stats()
+
+    def disable_allowlist(self):
+        self.allowlist = None
+
+    def allowlist_stats(self) -> str:
+        if self.allowlist is None:
+            return json.dumps({'enabled': False})
+        return json.dumps({'enabled': True, **self.allowlist.stats()})
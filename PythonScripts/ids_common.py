@@ -0,0 +1,475 @@
+"""
+PythonScripts/ids_common.py
+
+Общие куски инференса для hybrid_ids.py и catboost_ids.py.
+
+Обе модели одинаково:
+  - собирают матрицу признаков из списка flow-словарей (PascalCase / camelCase);
+  - превращают (pred, proba, isAnomaly) в один и тот же JSON-ответ,
+    который читает FlowMLPredictionDto на стороне C#.
+
+Раньше этот код был скопирован в оба модуля; вынесен сюда, чтобы
+новые режимы инференса (micro-batching, кеш предсказаний, потоковый режим)
+работали с обеими моделями через один и тот же `predict_items`.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from profiling import NULL_TIMER
+from inference_scheduler import inference_slot
+
+
+# Сколько строк за раз скейлить через float64-буфер (см. scale_features)
+SCALE_BLOCK_ROWS = 8192
+
+
+def extract_feature_matrix(items: List[Dict], feature_names: List[str],
+                           dtype=np.float32, scaler=None) -> np.ndarray:
+    """
+    Матрица (n, len(feature_names)) из списка flows, C-contiguous float32.
+    Отсутствующие/нечисловые значения -> 0.0, NaN/inf -> 0.0.
+
+    float32 — потому что деревья sklearn всё равно сравнивают признаки
+    в float32 (и IsolationForest, и RandomForest сами приводят вход к float32),
+    а CatBoost принимает float32 в Pool. Строки собираются блоками по
+    SCALE_BLOCK_ROWS в float64-буфер, чистка NaN/inf — in place.
+
+    scaler — StandardScaler: блок скейлится ещё в float64 (те же операции,
+    что в StandardScaler.transform), и в dtype приводится только результат.
+    Это ровно путь scaler.transform(X64) -> приведение к float32 внутри
+    деревьев, поэтому предсказания по такой матрице совпадают бит в бит
+    с float64-инференсом. Без scaler матрица сырая.
+    """
+    n, m = len(items), len(feature_names)
+    camel_names = [feat[0].lower() + feat[1:] if feat else feat for feat in feature_names]
+    X = np.empty((n, m), dtype=dtype)
+    block = np.empty((min(n, SCALE_BLOCK_ROWS), m), dtype=np.float64)
+
+    for start in range(0, n, SCALE_BLOCK_ROWS):
+        chunk = items[start:start + SCALE_BLOCK_ROWS]
+        rows = block[:len(chunk)]
+        for i, item in enumerate(chunk):
+            vec = []
+            for feat, camel in zip(feature_names, camel_names):
+                val = item.get(feat)
+                if val is None:
+                    val = item.get(camel, 0.0)
+                try:
+                    vec.append(float(val) if val is not None else 0.0)
+                except (TypeError, ValueError):
+                    vec.append(0.0)
+            rows[i] = vec
+
+        np.nan_to_num(rows, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+        if scaler is not None:
+            _scale_block(rows, scaler)
+        X[start:start + len(chunk)] = rows
+    return X
+
+
+def scale_features(X: np.ndarray, scaler, inplace: bool = False) -> np.ndarray:
+    """
+    StandardScaler.transform для уже собранной матрицы без float64-копии
+    всей матрицы: блоки по SCALE_BLOCK_ROWS строк поднимаются в float64,
+    скейлятся и пишутся в float32.
+
+    Для float64-входа результат совпадает с scaler.transform(X) -> float32
+    бит в бит. Для float32-входа сырые значения уже округлены до float32
+    (счётчики байт выше 2^24, длительности в мкс): сдвиг до |x|·2^-24 / scale_
+    после центрирования может превысить шаг float32 у результата и
+    изредка перевести строку через порог дерева. Поэтому путь инференса
+    HybridIDS скейлит при сборке (extract_feature_matrix(..., scaler=...)),
+    а здесь остаются CatBoost-IF, объяснения и матрицы обучения.
+
+    inplace=True — результат пишется в сам X (вызывающий владеет матрицей).
+    """
+    out = X if inplace else np.empty_like(X, dtype=np.float32)
+    for start in range(0, X.shape[0], SCALE_BLOCK_ROWS):
+        stop = start + SCALE_BLOCK_ROWS
+        block = X[start:stop].astype(np.float64)
+        _scale_block(block, scaler)
+        out[start:stop] = block
+    return out
+
+
+def _scale_block(block: np.ndarray, scaler):
+    """StandardScaler.transform на месте для float64-блока."""
+    if getattr(scaler, 'with_mean', True):
+        block -= scaler.mean_
+    if getattr(scaler, 'with_std', True):
+        block /= scaler.scale_
+
+
+def threat_level(proba: float, is_anomaly: int, pred: int) -> str:
+    if proba >= 0.8:
+        threat = 'Critical'
+    elif proba >= 0.6:
+        threat = 'High'
+    elif proba >= 0.4:
+        threat = 'Medium'
+    else:
+        threat = 'Low'
+
+    if is_anomaly == 1 and pred == 0 and threat == 'Low':
+        threat = 'Medium'
+    return threat
+
+
+def detection_method(pred: int, is_anomaly: int) -> str:
+    if is_anomaly == 1 and pred == 0:
+        return 'unsupervised'
+    if is_anomaly == 1 and pred == 1:
+        return 'both'
+    if pred == 1:
+        return 'supervised'
+    return 'none'
+
+
+def format_predictions(items: List[Dict], preds, probas, if_raw,
+                       stages=None) -> List[Dict]:
+    """
+    Формирует ответ predict_batch: по одному словарю на flow.
+    preds / probas / if_raw — результаты supervised-модели и IsolationForest.
+    stages — номер ступени каскада, решившей строку (только в режиме
+    каскада; без него ключа 'stage' в ответе нет). Flows из allow-list
+    в режиме каскада получают allowlist.ALLOWLIST_STAGE.
+    """
+    results = []
+    for i, item in enumerate(items):
+        pred = int(preds[i])
+        proba = float(probas[i])
+        is_anomaly = 1 if int(if_raw[i]) == -1 else 0
+
+        results.append({
+            'isAttack': bool(pred == 1 or is_anomaly == 1),
+            'confidence': round(proba, 4),
+            'threatLevel': threat_level(proba, is_anomaly, pred),
+            'method': detection_method(pred, is_anomaly),
+            # имя "rfPrediction" оставляем и для CatBoost — совместимость DTO
+            'rfPrediction': pred,
+            'isAnomaly': bool(is_anomaly),
+            'sourceIP': item.get('SourceIP', item.get('sourceIP', '')),
+            'destinationIP': item.get('DestinationIP',
+                                      item.get('destinationIP', '')),
+            'destinationPort': int(
+                item.get('DestinationPort',
+                         item.get('destinationPort', 0)) or 0),
+            'protocol': item.get('Protocol', item.get('protocol', '')),
+        })
+        if stages is not None:
+            results[-1]['stage'] = int(stages[i])
+    return results
+
+
+# ============================================================
+# КАСКАДНЫЙ ИНФЕРЕНС
+# ============================================================
+
+def make_cascade_config(first_stage_trees: int, low: float, high: float,
+                        anomaly_on_all: bool) -> Dict:
+    """
+    Параметры каскада:
+      first_stage_trees — сколько первых деревьев/итераций даёт дешёвая оценка;
+      [low, high]       — полоса неуверенности по proba первой ступени:
+                          строки с proba <= low или >= high решаются сразу,
+                          остальные идут в полный ансамбль;
+      anomaly_on_all    — гнать ли IsolationForest по всем строкам
+                          (False — только по неуверенным).
+    """
+    if not 0.0 <= low < high <= 1.0:
+        raise ValueError(f"Нужно 0 <= low < high <= 1, получено low={low}, high={high}")
+    if first_stage_trees < 1:
+        raise ValueError("first_stage_trees должно быть >= 1")
+    return {
+        'first_stage_trees': int(first_stage_trees),
+        'low': float(low),
+        'high': float(high),
+        'anomaly_on_all': bool(anomaly_on_all),
+    }
+
+
+# ============================================================
+# ПОТОКОВЫЙ ИНФЕРЕНС ПО ЧАНКАМ
+# ============================================================
+
+DEFAULT_STREAM_CHUNK = 10_000
+
+
+def iter_item_chunks(source, chunk_size: int = DEFAULT_STREAM_CHUNK) -> Iterator[List[Dict]]:
+    """
+    Превращает источник flows в поток списков по chunk_size штук.
+
+    source — итерируемое, элементы которого:
+      - dict                 — один flow;
+      - list[dict]           — готовый чанк;
+      - str / bytes          — строка NDJSON (один flow) или JSON-массив;
+    либо строка с NDJSON-текстом целиком. Открытый файл тоже подходит —
+    он итерируется по строкам, и в память одновременно попадает
+    только текущий чанк.
+    """
+    chunk_size = max(1, int(chunk_size))
+    if isinstance(source, (str, bytes)):
+        source = source.splitlines()
+
+    buf: List[Dict] = []
+    for element in source:
+        if isinstance(element, (str, bytes)):
+            element = element.strip()
+            if not element:
+                continue
+            element = json.loads(element)
+
+        for item in ((element,) if isinstance(element, dict) else element):
+            buf.append(item)
+            if len(buf) >= chunk_size:
+                yield buf
+                buf = []
+
+    if buf:
+        yield buf
+
+
+def predict_ndjson_file(model, in_path: str, out_path: str,
+                        chunk_size: int = DEFAULT_STREAM_CHUNK) -> int:
+    """
+    NDJSON flows -> NDJSON предсказаний, чанками по chunk_size.
+    Память ~ chunk_size × ширина строки независимо от размера файла.
+    Возвращает число обработанных flows.
+    """
+    total = 0
+    with open(in_path, 'r', encoding='utf-8') as fin, \
+            open(out_path, 'w', encoding='utf-8') as fout:
+        for preds in model.predict_batch_iter(fin, chunk_size, as_json=False):
+            for p in preds:
+                fout.write(json.dumps(p))
+                fout.write('\n')
+            total += len(preds)
+    return total
+
+
+def predict_matrix(model, X: np.ndarray, timer=NULL_TIMER, scaled: bool = False,
+                   key_matrix: np.ndarray = None) -> tuple:
+    """
+    model._predict_raw для собственной (перезаписываемой) матрицы X —
+    через кеш предсказаний, если он включён.
+
+    scaled=True — X уже отскейлен при сборке (см. HybridIDS). Ключи кеша
+    у обеих моделей — сырые признаки (float32): тогда key_matrix — сырая
+    матрица тех же строк, иначе ключи берутся из самого X.
+
+    В профиле время самого кеша (ключи, поиск, раскладка) пишется
+    в стадию 'cache' — за вычетом стадий модели на промахах.
+    """
+    cache = model.prediction_cache
+    kwargs = {'scaled': True} if scaled else {}
+    if cache is None:
+        return model._predict_raw(X, inplace=True, timer=timer, **kwargs)
+
+    def predict_misses(X_miss):
+        return model._predict_raw(X_miss, inplace=True, timer=timer, **kwargs)
+
+    version = model._inference_version()
+    if not timer.enabled:
+        return cache.predict(version, X, predict_misses, key_matrix)
+
+    hits, misses = cache.hits, cache.misses
+    inner_before = sum(timer.timings.values())
+    t0 = time.perf_counter()
+    out = cache.predict(version, X, predict_misses, key_matrix)
+    inner_us = sum(timer.timings.values()) - inner_before
+    timer.add('cache', max(0.0, time.perf_counter() - t0 - inner_us / 1e6))
+    timer.count('cacheHits', cache.hits - hits)
+    timer.count('cacheMisses', cache.misses - misses)
+    return out
+
+
+# ============================================================
+# ОБЪЯСНЕНИЯ (вклады признаков) ДЛЯ ПОДОЗРИТЕЛЬНЫХ FLOWS
+# ============================================================
+
+# Размер кеша объяснений по умолчанию (строк; строка — вектор вкладов)
+DEFAULT_EXPLAIN_CACHE_SIZE = 20_000
+
+
+def explain_items(model, items: List[Dict], threshold: float = 0.5,
+                  top_k: int = 10) -> Dict:
+    """
+    Вклады признаков для flows с вероятностью атаки >= threshold —
+    одним батчем. Объяснитель — model._explain_raw(X) -> (base, contrib):
+    base — ожидаемый выход модели (по строке), contrib — матрица
+    (строки × признаки), base + contrib.sum(1) = выход модели для строки
+    в пространстве model.explain_output_space().
+
+    Объяснения кешируются в model.explanation_cache (PredictionCache)
+    по вектору признаков: повторные алерты не пересчитываются.
+    top_k — сколько признаков с наибольшим |вкладом| отдать (0 — все).
+    """
+    n = len(items)
+    out = {
+        'method': model.explain_method(),
+        'outputSpace': model.explain_output_space(),
+        'threshold': float(threshold),
+        'topK': int(top_k),
+        'totalRows': n,
+        'explainedRows': 0,
+        'cacheHits': 0,
+        'explanations': [],
+    }
+    if not n:
+        return out
+
+    X = extract_feature_matrix(items, model.feature_names)
+    cache = model.explanation_cache
+    with inference_slot():
+        proba = model.predict_proba_supervised(X)
+        rows = np.flatnonzero(proba >= threshold)
+        if not len(rows):
+            return out
+        hits = cache.hits
+        base, contrib = cache.predict(f"{model.model_version}|explain",
+                                      X[rows], model._explain_raw)
+        out['cacheHits'] = cache.hits - hits
+
+    # Top-k по |вкладу| — сразу для всех строк
+    k = contrib.shape[1] if not top_k else min(int(top_k), contrib.shape[1])
+    order = np.argsort(-np.abs(contrib), axis=1, kind='stable')[:, :k]
+    names = model.feature_names
+
+    explanations = []
+    for j, i in enumerate(rows.tolist()):
+        explanations.append({
+            'index': i,
+            'flowId': items[i].get('Id'),
+            'probability': round(float(proba[i]), 4),
+            'baseValue': round(float(base[j]), 6),
+            'contributions': [
+                {'feature': names[f],
+                 'value': round(float(X[i, f]), 6),
+                 'contribution': round(float(contrib[j, f]), 6)}
+                for f in order[j].tolist()
+            ],
+        })
+    out['explainedRows'] = len(explanations)
+    out['explanations'] = explanations
+    return out
+
+
+# ============================================================
+# КЕШ ПРЕДСКАЗАНИЙ ПО ВЕКТОРУ ПРИЗНАКОВ
+# ============================================================
+
+class PredictionCache:
+    """
+    LRU-кеш сырых предсказаний модели по строке матрицы отобранных
+    признаков. Что именно хранится — решает predict_fn: кортеж массивов
+    (pred, proba, if_raw, ...), по одному значению на строку — или
+    по вектору на строку (вклады признаков в explain_items).
+
+    В реальном трафике много повторов (DNS, health-check, NTP): тысячи
+    flows с одинаковым вектором признаков. Для попаданий лес не гоняем,
+    через модель идут только промахи (и каждый уникальный промах — один раз).
+
+    Ключ строки — байты вектора сырых (не скейленых) признаков после
+    опционального квантования (np.round до quantize_decimals знаков) —
+    у HybridIDS и CatBoostIDS одинаково: quantize_decimals округляет
+    исходные единицы признака (мкс, байты), а не z-score. Без квантования
+    кеш точный; с квантованием близкие векторы получают предсказание
+    первого встреченного из своей «ячейки».
+
+    model_version — строка версии модели (и её режима инференса);
+    при её смене кеш очищается целиком.
+
+    misses — строки, ушедшие в модель (уникальные промахи); повторы
+    промаха внутри батча считаются попаданиями.
+    """
+
+    def __init__(self, max_size: int = 100_000, quantize_decimals: int = None):
+        self.max_size = max(1, int(max_size))
+        self.quantize_decimals = quantize_decimals
+        self._entries: 'OrderedDict[bytes, tuple]' = OrderedDict()
+        self._model_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def row_keys(self, X: np.ndarray) -> List[bytes]:
+        Xq = np.round(X, self.quantize_decimals) if self.quantize_decimals is not None else X
+        # +0.0 превращает -0.0 в 0.0, иначе одинаковые векторы дали бы разные байты
+        Xq = np.ascontiguousarray(Xq) + 0.0
+        return [row.tobytes() for row in Xq]
+
+    def predict(self, model_version: str, X: np.ndarray, predict_fn,
+                key_matrix: np.ndarray = None) -> tuple:
+        """
+        predict_fn(X_subset) -> кортеж массивов длины len(X_subset) —
+        реальный инференс. Возвращает такой же кортеж для всего X.
+        key_matrix — матрица для ключей (сырые признаки тех же строк),
+        если X уже отскейлен.
+        """
+        n = X.shape[0]
+        keys = self.row_keys(X if key_matrix is None else key_matrix)
+        row_entries: List[tuple] = [None] * n
+
+        # Промахи: уникальный ключ -> список строк с этим ключом
+        pending: 'OrderedDict[bytes, List[int]]' = OrderedDict()
+        with self._lock:
+            if model_version != self._model_version:
+                self._entries.clear()
+                self._model_version = model_version
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    row_entries[i] = entry
+                    self.hits += 1
+                elif key in pending:
+                    # повтор промаха в том же батче — в модель не идёт
+                    pending[key].append(i)
+                    self.hits += 1
+                else:
+                    pending[key] = [i]
+                    self.misses += 1
+
+        if pending:
+            first_rows = np.fromiter((rows[0] for rows in pending.values()),
+                                     dtype=np.int64, count=len(pending))
+            outputs = predict_fn(X[first_rows])
+
+            with self._lock:
+                same_version = model_version == self._model_version
+                for j, (key, rows) in enumerate(pending.items()):
+                    entry = tuple(out[j].item() if out.ndim == 1 else out[j].copy()
+                                  for out in outputs)
+                    for r in rows:
+                        row_entries[r] = entry
+                    if same_version:
+                        self._entries[key] = entry
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return tuple(np.array(col) for col in zip(*row_entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxSize': self.max_size,
+                'quantizeDecimals': self.quantize_decimals,
+                'modelVersion': self._model_version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,287 @@
+"""
+PythonScripts/inference_scheduler.py
+
+Глобальный планировщик параллелизма инференса.
+
+Проблема:
+  RF создаётся с n_jobs=-1, CatBoost — с thread_count=-1. Каждый
+  конкурентный запрос (micro_batcher для rf, для catboost, predict_compare,
+  kNN) пытается занять все ядра: 8 запросов на 8 ядрах = 64 потока
+  деревьев плюс потоки BLAS/OpenMP внутри numpy. Под нагрузкой
+  переключения контекста съедают весь выигрыш от параллельности.
+
+Решение:
+  - Вызов инференса выполняется в «слоте» планировщика (inference_slot()
+    или декоратор @scheduled). Слотов не больше max_concurrent, лишние
+    запросы ждут.
+  - Бюджет потоков вызова = total_threads // (число активных слотов),
+    минимум 1: один запрос получает все ядра, восемь — по одному.
+  - Деревья sklearn внутри слота выполняются через joblib-бэкенд
+    _SharedPoolBackend: n_jobs ограничен бюджетом, а задачи всех моделей
+    идут в ОДИН общий ThreadPool на total_threads потоков. Модели не
+    меняются (n_jobs=-1 в артефакте остаётся), настройка thread-local.
+    Бэкенд наследует приватный joblib._parallel_backends; без него —
+    штатный parallel_config('threading', n_jobs=budget).
+  - CatBoost берёт thread_count из thread_budget() (см. CatBoostIDS).
+  - BLAS/OpenMP ограничиваются через threadpoolctl тем же бюджетом;
+    когда активных слотов нет — лимиты возвращаются к исходным.
+    Код, который сам делит работу между потоками бюджета (тайлы kNN в
+    similarity.py), на это время переводит BLAS в 1 поток: blas_serial().
+
+Вне слота всё работает как раньше (n_jobs / thread_count из модели).
+
+Использование:
+    from inference_scheduler import inference_slot, scheduled
+
+    with inference_slot():
+        results = model.predict_items(items)
+
+    @scheduled
+    def predict_compare(...): ...
+
+Настройка: переменные окружения IDS_INFERENCE_THREADS (total_threads)
+и IDS_MAX_CONCURRENT_INFERENCE (max_concurrent) или configure().
+"""
+
+import functools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from typing import Dict
+
+from joblib import parallel_config
+from threadpoolctl import ThreadpoolController
+
+# Бэкенды joblib — приватный модуль: версия joblib закреплена в
+# requirements.txt, а если модуль всё же изменится, слоты работают через
+# штатный 'threading' (без общего пула и лимита n_jobs по бюджету)
+try:
+    from joblib._parallel_backends import (ThreadingBackend, SequentialBackend,
+                                           FallbackToBackend)
+except ImportError:
+    ThreadingBackend = None
+
+
+# Бюджет потоков слота, в котором выполняется текущий поток
+_LOCAL = threading.local()
+
+
+def current_budget():
+    """Бюджет потоков текущего слота (None — вне слота)."""
+    return getattr(_LOCAL, 'budget', None)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+if ThreadingBackend is not None:
+    class _SharedPoolBackend(ThreadingBackend):
+        """
+        Threading-бэкенд joblib поверх общего ThreadPool планировщика:
+        n_jobs вызова не больше max_threads, пул не создаётся и не
+        закрывается на каждый Parallel.
+        """
+
+        def __init__(self, pool: ThreadPool, max_threads: int, **kwargs):
+            super().__init__(**kwargs)
+            self._shared_pool = pool
+            self._max_threads = max_threads
+
+        def effective_n_jobs(self, n_jobs):
+            return min(super().effective_n_jobs(n_jobs), self._max_threads)
+
+        def configure(self, n_jobs=1, parallel=None, **backend_kwargs):
+            n_jobs = self.effective_n_jobs(n_jobs)
+            if n_jobs == 1:
+                raise FallbackToBackend(SequentialBackend(nesting_level=self.nesting_level))
+            self.parallel = parallel
+            self._n_jobs = n_jobs
+            return n_jobs
+
+        def _get_pool(self):
+            return self._shared_pool
+
+        def terminate(self):
+            pass  # общий пул живёт вместе с планировщиком
+else:
+    _SharedPoolBackend = None
+
+
+def _slot_backend(pool: ThreadPool, budget: int):
+    """parallel_config() для слота с бюджетом budget."""
+    if pool is None or budget <= 1:
+        return parallel_config(backend='sequential')
+    if _SharedPoolBackend is not None:
+        return parallel_config(backend=_SharedPoolBackend(pool, budget))
+    return parallel_config(backend='threading', n_jobs=budget)
+
+
+class InferenceScheduler:
+    """Слоты инференса + общий пул потоков + лимиты BLAS/OpenMP."""
+
+    def __init__(self, total_threads: int = None, max_concurrent: int = None):
+        self.total_threads = max(1, int(total_threads or
+                                        _env_int('IDS_INFERENCE_THREADS', os.cpu_count() or 1)))
+        self.max_concurrent = max(1, int(max_concurrent or
+                                         _env_int('IDS_MAX_CONCURRENT_INFERENCE',
+                                                  self.total_threads)))
+
+        self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock = threading.Lock()
+        self._pool = ThreadPool(self.total_threads) if self.total_threads > 1 else None
+
+        self._active = 0
+        self._peak = 0
+        self._calls = 0
+        self._controller = None
+        self._blas_limit = None
+        self._blas_limiter = None   # первый limiter хранит исходные лимиты
+        self._serial_blas = 0       # активные blas_serial(): BLAS в 1 поток
+
+    # ------------------------------------------------------------------
+    def budget_for(self, active: int) -> int:
+        return max(1, self.total_threads // max(1, active))
+
+    @contextmanager
+    def slot(self):
+        """Выполнить блок как один вызов инференса. Вложенные слоты не считаются."""
+        budget = current_budget()
+        if budget is not None:
+            yield budget
+            return
+
+        self._slots.acquire()
+        with self._lock:
+            self._active += 1
+            self._calls += 1
+            self._peak = max(self._peak, self._active)
+            budget = self.budget_for(self._active)
+            self._apply_blas_limit()
+        _LOCAL.budget = budget
+        try:
+            with _slot_backend(self._pool, budget):
+                yield budget
+        finally:
+            _LOCAL.budget = None
+            with self._lock:
+                self._active -= 1
+                self._apply_blas_limit()
+            self._slots.release()
+
+    @contextmanager
+    def blas_serial(self):
+        """
+        Внутри слота, когда вызов сам раскладывает работу по потокам
+        бюджета (тайлы similarity): BLAS/OpenMP на это время — 1 поток,
+        иначе budget воркеров × budget потоков BLAS. Лимит процессный,
+        поэтому на это время он действует и на соседние слоты.
+        """
+        with self._lock:
+            self._serial_blas += 1
+            self._apply_blas_limit()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._serial_blas -= 1
+                self._apply_blas_limit()
+
+    def _apply_blas_limit(self):
+        """Под self._lock: лимит BLAS/OpenMP по текущему числу активных слотов."""
+        if self._controller is None:
+            self._controller = ThreadpoolController()
+        if self._active == 0:
+            if self._blas_limiter is not None:
+                self._blas_limiter.restore_original_limits()
+            self._blas_limiter = self._blas_limit = None
+            return
+
+        limit = 1 if self._serial_blas else self.budget_for(self._active)
+        if limit == self._blas_limit:
+            return
+        limiter = self._controller.limit(limits=limit)
+        if self._blas_limiter is None:
+            self._blas_limiter = limiter
+        self._blas_limit = limit
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'totalThreads': self.total_threads,
+                'maxConcurrent': self.max_concurrent,
+                'active': self._active,
+                'peakActive': self._peak,
+                'calls': self._calls,
+                'blasLimit': self._blas_limit,
+            }
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+
+# ============================================================
+# Модульный планировщик (живёт между вызовами из C#)
+# ============================================================
+_SCHEDULER: InferenceScheduler = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler() -> InferenceScheduler:
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = InferenceScheduler()
+            print(f"[InferenceScheduler] threads={_SCHEDULER.total_threads}, "
+                  f"max_concurrent={_SCHEDULER.max_concurrent}")
+        return _SCHEDULER
+
+
+def configure(total_threads: int = None, max_concurrent: int = None) -> str:
+    """Пересоздаёт планировщик с новыми лимитами (активные слоты доработают на старом)."""
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        _SCHEDULER = InferenceScheduler(total_threads, max_concurrent)
+        print(f"[InferenceScheduler] threads={_SCHEDULER.total_threads}, "
+              f"max_concurrent={_SCHEDULER.max_concurrent}")
+        return json.dumps(_SCHEDULER.stats())
+
+
+def inference_slot():
+    return get_scheduler().slot()
+
+
+def scheduled(fn):
+    """Декоратор: весь вызов fn — один слот инференса."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with inference_slot():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def blas_serial():
+    return get_scheduler().blas_serial()
+
+
+def thread_budget(default: int) -> int:
+    """
+    Число потоков для библиотек со своим пулом (CatBoost thread_count):
+    внутри слота — бюджет слота (но не больше явного default > 0),
+    вне слота — default как есть.
+    """
+    budget = current_budget()
+    if budget is None:
+        return default
+    return min(budget, default) if default and default > 0 else budget
+
+
+def scheduler_stats() -> str:
+    return json.dumps(get_scheduler().stats())
@@ -0,0 +1,539 @@
+"""
+PythonScripts/inference_server.py
+
+Пул процессов-воркеров для инференса, доступный через локальный Unix-сокет.
+
+Зачем:
+  Python.NET выполняет весь ML внутри процесса ASP.NET под одним GIL —
+  одновременно идёт только один инференс, сколько бы ядер ни было.
+  А падение нативного кода модели (segfault в CatBoost и т.п.) роняет
+  весь API.
+
+Как устроено:
+  - Сервер запускает N процессов. Каждый заранее загружает HybridIDS и
+    CatBoostIDS (joblib mmap_mode='r'). Деревья sklearn (Tree.__setstate__)
+    и модель CatBoost при загрузке копируются в память воркера — память
+    на модели растёт как N × размер деревьев. Через page cache ОС
+    делятся только обычные numpy-массивы payload (резервуар normal-
+    трафика HybridIDS и т.п.).
+  - Клиенты подключаются к Unix-сокету и шлют кадры (см. ниже).
+    Каждое соединение обслуживается потоком, который берёт свободного
+    воркера, передаёт ему запрос через Pipe и ждёт ответ. Операции с
+    состоянием сессии в памяти воркера (SESSION_BOUND_OPS — инкрементальный
+    kNN) ждут «своего» воркера: hash(sessionId) % N.
+  - Health-check поток раз в HEALTH_INTERVAL секунд проверяет воркеров
+    и перезапускает упавших. Воркер, который упал или завис во время
+    запроса, перезапускается сразу, клиент получает ответ-ошибку.
+
+Формат кадра (big-endian):
+    header  = magic b'TA' | version u8 | code u8 | payload_len u32
+    payload = args_len u32 | args (JSON) | body (UTF-8 байты)
+
+  В запросе code — операция (OP_*), в ответе — статус (STATUS_*).
+  args — маленький JSON с параметрами, body — «тяжёлая» JSON-строка
+  (flows / packets), которая передаётся воркеру как есть, без
+  повторной упаковки во вложенный JSON.
+
+Запуск:
+    python inference_server.py --socket /tmp/traffic_ids.sock --workers 4
+
+Клиент:
+    with InferenceClient('/tmp/traffic_ids.sock') as c:
+        c.ping()
+        c.predict(flows_json, model='rf')
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SOCKET = '/tmp/traffic_ids.sock'
+DEFAULT_RF_MODEL = os.path.join(SCRIPTS_DIR, 'models', 'hybrid_ids_v2.pkl')
+DEFAULT_CB_MODEL = os.path.join(SCRIPTS_DIR, 'models', 'catboost_ids_v2.pkl')
+
+MAGIC = b'TA'
+PROTOCOL_VERSION = 1
+_HEADER = struct.Struct('>2sBBI')
+_ARGS_LEN = struct.Struct('>I')
+MAX_PAYLOAD = 1 << 31
+
+# Операции
+OP_PING = 1
+OP_PREDICT = 2
+OP_BUILD_FLOWS = 3
+OP_FIND_SIMILAR = 4
+OP_KNN = 5
+OP_STATS = 6
+OP_SWEEP_WEIGHTS = 7
+OP_KNN_INCREMENTAL = 8
+
+# Операции с состоянием сессии в памяти воркера: все вызовы одной сессии
+# идут в один и тот же воркер (остальные — в любой свободный)
+SESSION_BOUND_OPS = (OP_KNN_INCREMENTAL,)
+
+# Статусы ответа
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_WORKER_FAILED = 2
+
+HEALTH_INTERVAL = 5.0          # сек между проверками воркеров
+DEFAULT_REQUEST_TIMEOUT = 120.0
+
+
+# ============================================================
+# ФРЕЙМИНГ
+# ============================================================
+
+def encode_frame(code: int, args: Optional[Dict] = None, body: bytes = b'') -> bytes:
+    args_bytes = json.dumps(args or {}).encode('utf-8')
+    payload_len = _ARGS_LEN.size + len(args_bytes) + len(body)
+    return (_HEADER.pack(MAGIC, PROTOCOL_VERSION, code, payload_len)
+            + _ARGS_LEN.pack(len(args_bytes)) + args_bytes + body)
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        chunk = sock.recv_into(view[got:], n - got)
+        if chunk == 0:
+            raise ConnectionError("Соединение закрыто посреди кадра")
+        got += chunk
+    return bytes(buf)
+
+
+def read_frame(sock: socket.socket) -> Optional[Tuple[int, Dict, bytes]]:
+    """Читает один кадр. None — если клиент закрыл соединение между кадрами."""
+    try:
+        header = _recv_exact(sock, _HEADER.size)
+    except ConnectionError:
+        return None
+    magic, version, code, payload_len = _HEADER.unpack(header)
+    if magic != MAGIC or version != PROTOCOL_VERSION:
+        raise ValueError(f"Неверный заголовок кадра: {magic!r} v{version}")
+    if payload_len < _ARGS_LEN.size or payload_len > MAX_PAYLOAD:
+        raise ValueError(f"Неверная длина кадра: {payload_len}")
+
+    payload = _recv_exact(sock, payload_len)
+    (args_len,) = _ARGS_LEN.unpack_from(payload, 0)
+    args_end = _ARGS_LEN.size + args_len
+    args = json.loads(payload[_ARGS_LEN.size:args_end].decode('utf-8')) if args_len else {}
+    return code, args, payload[args_end:]
+
+
+# ============================================================
+# ВОРКЕР (отдельный процесс)
+# ============================================================
+
+def _load_models(model_paths: Dict[str, str]) -> Dict:
+    models = {}
+    for model_type, path in model_paths.items():
+        if not path or not os.path.exists(path):
+            print(f"[InferenceWorker {os.getpid()}] {model_type}: модель не найдена ({path})")
+            continue
+        try:
+            if model_type == 'catboost':
+                from catboost_ids import CatBoostIDS
+                models[model_type] = CatBoostIDS.load(path, mmap_mode='r')
+            else:
+                from hybrid_ids import HybridIDS
+                models[model_type] = HybridIDS.load(path, mmap_mode='r')
+        except Exception as ex:
+            print(f"[InferenceWorker {os.getpid()}] {model_type}: ошибка загрузки: {ex}")
+            continue
+
+        # Параллелизм даёт пул процессов; внутри воркера модели работают
+        # в один поток, иначе N воркеров × n_jobs=-1 перегружают ядра
+        model = models[model_type]
+        for est in (model.supervised, model.anomaly_detector):
+            if hasattr(est, 'n_jobs'):
+                est.n_jobs = 1
+        if hasattr(model, 'thread_count'):
+            model.thread_count = 1
+    return models
+
+
+def _dispatch(op: int, args: Dict, body: str, models: Dict) -> str:
+    if op == OP_PING:
+        return json.dumps({'pid': os.getpid(), 'models': sorted(models)})
+
+    if op == OP_PREDICT:
+        model_type = (args.get('model') or 'rf').lower()
+        model = models.get(model_type)
+        if model is None:
+            raise RuntimeError(f"Модель '{model_type}' не загружена в воркере")
+        return model.predict_batch(body)
+
+    if op == OP_BUILD_FLOWS:
+        import flow_features
+        return flow_features.build_flows_from_packets(body)
+
+    if op == OP_FIND_SIMILAR:
+        import similarity
+        if 'targetFlowIds' in args:
+            return similarity.find_similar_flows_multi(
+                body, json.dumps(args['targetFlowIds']),
+                args.get('w1', 1.0), args.get('w2', 1.0), args.get('w3', 1.0),
+                args.get('k', 10), session_id=args.get('sessionId'))
+        return similarity.find_similar_flows(
+            body, args['targetFlowId'],
+            args.get('w1', 1.0), args.get('w2', 1.0), args.get('w3', 1.0),
+            args.get('k', 10), session_id=args.get('sessionId'))
+
+    if op == OP_KNN:
+        import similarity
+        return similarity.knn_classify_flows(
+            body, json.dumps(args.get('labels', {})),
+            args.get('w1', 1.0), args.get('w2', 1.0), args.get('w3', 1.0),
+            args.get('k', 5), session_id=args.get('sessionId'))
+
+    if op == OP_SWEEP_WEIGHTS:
+        import similarity
+        weights = args.get('weights')
+        return similarity.sweep_weights(
+            body, json.dumps(args.get('labels', {})),
+            json.dumps(weights) if weights else None,
+            json.dumps(args.get('kValues', [5])),
+            args.get('gridStep', 0.1), session_id=args.get('sessionId'))
+
+    if op == OP_KNN_INCREMENTAL:
+        # Состояние сессии — в памяти этого воркера (см. similarity_incremental);
+        # WorkerPool.execute шлёт сюда все вызовы этой сессии
+        import similarity_incremental
+        return similarity_incremental.knn_classify_incremental(
+            body, json.dumps(args.get('labels', {})),
+            args.get('w1', 1.0), args.get('w2', 1.0), args.get('w3', 1.0),
+            args.get('k', 5), session_id=args.get('sessionId'),
+            refresh=bool(args.get('refresh', False)),
+            is_delta=bool(args.get('isDelta', False)))
+
+    raise ValueError(f"Неизвестная операция: {op}")
+
+
+def _worker_main(conn, model_paths: Dict[str, str]):
+    sys.path.insert(0, SCRIPTS_DIR)
+    models = _load_models(model_paths)
+    print(f"[InferenceWorker {os.getpid()}] Готов, модели: {sorted(models)}")
+
+    while True:
+        try:
+            op, args, body = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            result = _dispatch(op, args, body, models)
+            conn.send((STATUS_OK, result))
+        except Exception as ex:
+            conn.send((STATUS_ERROR, f"{type(ex).__name__}: {ex}\n"
+                                     f"{traceback.format_exc(limit=5)}"))
+
+
+class _WorkerSlot:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[mp.Process] = None
+        self.conn = None
+        self.busy = False
+        self.waiting = 0           # запросов, привязанных к этому воркеру, в ожидании
+        self.restarts = 0
+        self.served = 0
+
+
+# ============================================================
+# ПУЛ ВОРКЕРОВ
+# ============================================================
+
+class WorkerPool:
+    def __init__(self, n_workers: int, model_paths: Dict[str, str],
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        # spawn, а не fork: воркеры перезапускаются из потоков сервера,
+        # fork многопоточного процесса небезопасен
+        self._ctx = mp.get_context('spawn')
+        self.model_paths = model_paths
+        self.request_timeout = request_timeout
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._slots = [_WorkerSlot(i) for i in range(n_workers)]
+        self._stop = threading.Event()
+
+        for slot in self._slots:
+            self._spawn(slot)
+
+        self._health = threading.Thread(
+            target=self._health_loop, name='inference-health', daemon=True)
+        self._health.start()
+
+    def _spawn(self, slot: _WorkerSlot):
+        parent_conn, child_conn = self._ctx.Pipe(duplex=True)
+        proc = self._ctx.Process(
+            target=_worker_main, args=(child_conn, self.model_paths),
+            name=f'inference-worker-{slot.index}', daemon=True)
+        proc.start()
+        child_conn.close()
+        slot.process = proc
+        slot.conn = parent_conn
+
+    def _restart(self, slot: _WorkerSlot, reason: str):
+        print(f"[InferenceServer] Перезапуск воркера #{slot.index} "
+              f"(pid={slot.process.pid if slot.process else None}): {reason}")
+        try:
+            if slot.process is not None and slot.process.is_alive():
+                slot.process.kill()
+            if slot.process is not None:
+                slot.process.join(timeout=2.0)
+            if slot.conn is not None:
+                slot.conn.close()
+        except Exception:
+            pass
+        slot.restarts += 1
+        self._spawn(slot)
+
+    def _health_loop(self):
+        while not self._stop.wait(HEALTH_INTERVAL):
+            with self._lock:
+                for slot in self._slots:
+                    if not slot.busy and not slot.process.is_alive():
+                        self._restart(slot, f"процесс завершился (exitcode={slot.process.exitcode})")
+
+    def _bound_slot(self, op: int, args: Dict) -> Optional[_WorkerSlot]:
+        """Воркер, за которым закреплена сессия запроса (для SESSION_BOUND_OPS)."""
+        session_id = args.get('sessionId')
+        if op not in SESSION_BOUND_OPS or session_id is None:
+            return None
+        return self._slots[hash(str(session_id)) % len(self._slots)]
+
+    def _acquire(self, bound: Optional[_WorkerSlot]) -> _WorkerSlot:
+        """Ждёт воркер bound (или любой свободный) и помечает его занятым."""
+        with self._released:
+            if bound is not None:
+                bound.waiting += 1
+                while bound.busy:
+                    self._released.wait()
+                bound.waiting -= 1
+                slot = bound
+            else:
+                free = [s for s in self._slots if not s.busy]
+                while not free:
+                    self._released.wait()
+                    free = [s for s in self._slots if not s.busy]
+                # свободный воркер, которого не ждут привязанные запросы
+                slot = min(free, key=lambda s: s.waiting)
+            slot.busy = True
+            if not slot.process.is_alive():
+                self._restart(slot, "процесс мёртв перед запросом")
+            return slot
+
+    def execute(self, op: int, args: Dict, body: str) -> Tuple[int, str]:
+        slot = self._acquire(self._bound_slot(op, args))
+        try:
+            slot.conn.send((op, args, body))
+            if not slot.conn.poll(self.request_timeout):
+                with self._lock:
+                    self._restart(slot, f"таймаут {self.request_timeout}с")
+                return STATUS_WORKER_FAILED, "Worker timed out and was restarted"
+            status, result = slot.conn.recv()
+            slot.served += 1
+            return status, result
+        except (EOFError, OSError, BrokenPipeError) as ex:
+            with self._lock:
+                self._restart(slot, f"воркер упал во время запроса: {ex!r}")
+            return STATUS_WORKER_FAILED, "Worker crashed and was restarted"
+        finally:
+            with self._released:
+                slot.busy = False
+                self._released.notify_all()
+
+    def health(self) -> Dict:
+        with self._lock:
+            return {
+                'workers': len(self._slots),
+                'alive': sum(1 for s in self._slots if s.process.is_alive()),
+                'busy': sum(1 for s in self._slots if s.busy),
+                'restarts': sum(s.restarts for s in self._slots),
+                'served': sum(s.served for s in self._slots),
+                'slots': [{'index': s.index, 'pid': s.process.pid,
+                           'alive': s.process.is_alive(), 'busy': s.busy,
+                           'restarts': s.restarts, 'served': s.served}
+                          for s in self._slots],
+            }
+
+    def shutdown(self):
+        self._stop.set()
+        with self._lock:
+            for slot in self._slots:
+                try:
+                    slot.conn.close()
+                    slot.process.kill()
+                    slot.process.join(timeout=2.0)
+                except Exception:
+                    pass
+
+
+# ============================================================
+# СЕРВЕР
+# ============================================================
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        pool: WorkerPool = self.server.pool
+        while True:
+            try:
+                frame = read_frame(self.request)
+            except (ValueError, ConnectionError) as ex:
+                self.request.sendall(encode_frame(STATUS_ERROR, body=str(ex).encode('utf-8')))
+                return
+            if frame is None:
+                return
+            op, args, body = frame
+
+            if op == OP_STATS or (op == OP_PING and not args.get('worker')):
+                result = json.dumps(pool.health())
+                reply = encode_frame(STATUS_OK, body=result.encode('utf-8'))
+            else:
+                status, result = pool.execute(op, args, body.decode('utf-8'))
+                reply = encode_frame(status, body=result.encode('utf-8'))
+            self.request.sendall(reply)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, pool: WorkerPool):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.pool = pool
+        super().__init__(socket_path, _ConnectionHandler)
+        os.chmod(socket_path, 0o660)
+
+
+def serve(socket_path: str = DEFAULT_SOCKET, n_workers: int = None,
+          rf_model: str = DEFAULT_RF_MODEL, cb_model: str = DEFAULT_CB_MODEL,
+          request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
+    n_workers = n_workers or os.cpu_count() or 1
+    pool = WorkerPool(n_workers, {'rf': rf_model, 'catboost': cb_model},
+                      request_timeout=request_timeout)
+    server = InferenceServer(socket_path, pool)
+    print(f"[InferenceServer] Слушаю {socket_path}, воркеров: {n_workers}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        print("[InferenceServer] Остановлен")
+
+
+# ============================================================
+# КЛИЕНТ
+# ============================================================
+
+class InferenceClient:
+    """Синхронный клиент. Одно соединение, запросы идут последовательно."""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, timeout: float = None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def call(self, op: int, args: Dict = None, body: str = '') -> str:
+        self.sock.sendall(encode_frame(op, args, body.encode('utf-8')))
+        frame = read_frame(self.sock)
+        if frame is None:
+            raise ConnectionError("Сервер закрыл соединение")
+        status, _, result = frame
+        text = result.decode('utf-8')
+        if status != STATUS_OK:
+            raise RuntimeError(f"[InferenceServer] status={status}: {text}")
+        return text
+
+    def ping(self, worker: bool = False) -> Dict:
+        return json.loads(self.call(OP_PING, {'worker': worker}))
+
+    def stats(self) -> Dict:
+        return json.loads(self.call(OP_STATS))
+
+    def predict(self, flows_json: str, model: str = 'rf') -> str:
+        return self.call(OP_PREDICT, {'model': model}, flows_json)
+
+    def build_flows(self, packets_json: str) -> str:
+        return self.call(OP_BUILD_FLOWS, body=packets_json)
+
+    def find_similar(self, flows_json: str, target_flow_id: int,
+                     w1: float, w2: float, w3: float, k: int = 10,
+                     session_id: Optional[int] = None) -> str:
+        return self.call(OP_FIND_SIMILAR, {'targetFlowId': target_flow_id,
+                                           'w1': w1, 'w2': w2, 'w3': w3, 'k': k,
+                                           'sessionId': session_id},
+                         flows_json)
+
+    def find_similar_multi(self, flows_json: str, target_flow_ids: List[int],
+                           w1: float, w2: float, w3: float, k: int = 10,
+                           session_id: Optional[int] = None) -> str:
+        return self.call(OP_FIND_SIMILAR, {'targetFlowIds': list(target_flow_ids),
+                                           'w1': w1, 'w2': w2, 'w3': w3, 'k': k,
+                                           'sessionId': session_id},
+                         flows_json)
+
+    def knn_classify(self, flows_json: str, labels: Dict, w1: float, w2: float,
+                     w3: float, k: int = 5, session_id: Optional[int] = None) -> str:
+        return self.call(OP_KNN, {'labels': labels, 'w1': w1, 'w2': w2,
+                                  'w3': w3, 'k': k, 'sessionId': session_id}, flows_json)
+
+    def knn_classify_incremental(self, flows_json: str, labels: Dict, w1: float,
+                                 w2: float, w3: float, k: int, session_id: int,
+                                 refresh: bool = False, is_delta: bool = False) -> str:
+        return self.call(OP_KNN_INCREMENTAL, {'labels': labels, 'w1': w1, 'w2': w2,
+                                              'w3': w3, 'k': k, 'sessionId': session_id,
+                                              'refresh': refresh, 'isDelta': is_delta},
+                         flows_json)
+
+    def sweep_weights(self, flows_json: str, labels: Dict,
+                      weights: Optional[List[List[float]]] = None,
+                      k_values: Optional[List[int]] = None,
+                      grid_step: float = 0.1, session_id: Optional[int] = None) -> str:
+        return self.call(OP_SWEEP_WEIGHTS, {'labels': labels, 'weights': weights,
+                                            'kValues': k_values or [5],
+                                            'gridStep': grid_step,
+                                            'sessionId': session_id}, flows_json)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default=DEFAULT_SOCKET)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Число процессов (по умолчанию — число ядер)')
+    parser.add_argument('--rf_model', default=DEFAULT_RF_MODEL)
+    parser.add_argument('--cb_model', default=DEFAULT_CB_MODEL)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                        help='Таймаут одного запроса, сек')
+    args = parser.parse_args()
+
+    serve(args.socket, args.workers, args.rf_model, args.cb_model, args.timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+PythonScripts/micro_batcher.py
+
+Динамический micro-batching для конкурентных запросов к predict_batch.
+
+Проблема:
+  Каждый HTTP-запрос /api/ml/flow-analyze захватывает GIL и вызывает
+  predict_batch сам по себе. Много мелких сессий одновременно ->
+  запросы выполняются строго по очереди, и каждый платит фиксированную
+  стоимость вызова (scaler, обход 200 деревьев RF, IsolationForest).
+
+Решение:
+  Вызывающий кладёт свой список flows в очередь и получает Future.
+  Фоновый поток-воркер забирает из очереди запросы, пока суммарное
+  число строк < max_batch_rows или пока не прошло max_wait_ms с момента
+  появления первого запроса в батче, склеивает их, делает ОДИН проход
+  модели и раскладывает результаты обратно по Future.
+
+  Пока C#-поток ждёт future.result(), GIL отпущен — остальные запросы
+  успевают встать в очередь и попасть в тот же батч.
+
+  Проход модели идёт в слоте inference_scheduler: батчеры rf и catboost,
+  работающие одновременно, делят ядра, а не занимают каждый все.
+
+Использование из C#:
+    micro_batcher.predict_batch('rf', pkl_path, flows_json)
+
+С profile=True ответ — {"predictions": [...], "profile": {...}}:
+parse/serialize и queueWait (ожидание в очереди) — этого запроса,
+load/matrix/scale/supervised/anomaly/format — всего батча, в который
+он попал (batchRows/batchRequests — его размер).
+
+Для каждой пары (тип модели, путь к .pkl) создаётся свой батчер.
+Модель берётся через HybridIDS.load / CatBoostIDS.load на каждом батче,
+так что переобученная модель подхватывается как обычно (по mtime).
+"""
+
+import importlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from profiling import make_timer, profiled_response
+from inference_scheduler import inference_slot
+
+
+DEFAULT_MAX_BATCH_ROWS = 4096
+DEFAULT_MAX_WAIT_MS = 5.0
+
+# Тип модели -> (модуль, класс). Модули импортируются лениво,
+# чтобы отсутствие catboost не ломало работу с RF.
+_MODEL_CLASSES = {
+    'rf': ('hybrid_ids', 'HybridIDS'),
+    'catboost': ('catboost_ids', 'CatBoostIDS'),
+}
+
+# Сколько последних задержек хранить для p50/p99
+_LATENCY_WINDOW = 2000
+
+
+class _Request:
+    __slots__ = ('items', 'future', 'enqueued_at', 'started_at',
+                 'profile_top', 'batch_profile')
+
+    def __init__(self, items: List[Dict], profile_top: int = None):
+        self.items = items
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        # None — профиль не нужен; иначе — cProfile top-N для батча (0 — без cProfile)
+        self.profile_top = profile_top
+        self.batch_profile = None
+
+
+class MicroBatcher:
+    """
+    Очередь запросов + один поток-воркер, который склеивает запросы
+    в батчи и прогоняет их через model.predict_items().
+
+    model_loader — функция без аргументов, возвращающая модель
+    (объект с методом predict_items(items) -> List[Dict]).
+    """
+
+    def __init__(self, model_loader: Callable, max_batch_rows: int = DEFAULT_MAX_BATCH_ROWS,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS, name: str = 'batcher'):
+        self.model_loader = model_loader
+        self.max_batch_rows = max(1, int(max_batch_rows))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._batches = 0
+        self._requests = 0
+        self._rows = 0
+        self._latencies = deque(maxlen=_LATENCY_WINDOW)
+
+        self._worker = threading.Thread(
+            target=self._run, name=f'micro-batcher-{name}', daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------------------------------
+    def submit(self, items: List[Dict], profile_top: int = None) -> Future:
+        """
+        Ставит список flows в очередь. Future вернёт список предсказаний.
+        profile_top не None — воркер профилирует батч с этим запросом
+        (результат — в future.request.batch_profile).
+        """
+        req = _Request(items, profile_top)
+        req.future.request = req
+        if not items:
+            req.future.set_result([])
+            return req.future
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"[MicroBatcher:{self.name}] closed")
+            self._queue.append(req)
+            self._cond.notify()
+        return req.future
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout=1.0)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            lat = np.array(self._latencies, dtype=float) * 1000.0
+            batches = self._batches
+            return {
+                'batches': batches,
+                'requests': self._requests,
+                'rows': self._rows,
+                'queued': len(self._queue),
+                'avgRequestsPerBatch': round(self._requests / batches, 2) if batches else 0.0,
+                'avgRowsPerBatch': round(self._rows / batches, 1) if batches else 0.0,
+                'latencyP50Ms': round(float(np.percentile(lat, 50)), 3) if len(lat) else None,
+                'latencyP99Ms': round(float(np.percentile(lat, 99)), 3) if len(lat) else None,
+            }
+
+    # ------------------------------------------------------------------
+    def _collect_batch(self) -> List[_Request]:
+        """
+        Ждёт первый запрос, затем добирает следующие, пока не наберётся
+        max_batch_rows строк или не истечёт max_wait от первого запроса.
+        Запрос, который не влезает по строкам, остаётся на следующий батч
+        (кроме случая, когда он первый — тогда идёт один).
+        """
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return []
+
+            first = self._queue.popleft()
+            batch = [first]
+            rows = len(first.items)
+            deadline = first.enqueued_at + self.max_wait
+
+            while rows < self.max_batch_rows:
+                if self._queue:
+                    nxt = self._queue[0]
+                    if rows + len(nxt.items) > self.max_batch_rows:
+                        break
+                    batch.append(self._queue.popleft())
+                    rows += len(nxt.items)
+                    continue
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if not batch:
+                return  # closed и очередь пуста
+
+            # Future, отменённые вызывающим, пропускаем
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            started_at = time.perf_counter()
+            merged: List[Dict] = []
+            offsets = [0]
+            for req in batch:
+                req.started_at = started_at
+                merged.extend(req.items)
+                offsets.append(len(merged))
+
+            # Профиль снимается с батча целиком, если его попросил хоть один запрос
+            tops = [r.profile_top for r in batch if r.profile_top is not None]
+            timer = make_timer(bool(tops), max(tops, default=0))
+
+            try:
+                with timer.stage('load'):
+                    model = self.model_loader()
+                # Слот планировщика: потоки модели делятся с другими батчерами
+                with inference_slot():
+                    results = model.predict_items(merged, timer)
+            except BaseException as ex:
+                for req in batch:
+                    req.future.set_exception(ex)
+                continue
+
+            if tops:
+                timer.count('batchRows', len(merged))
+                timer.count('batchRequests', len(batch))
+                batch_profile = timer.result()
+                for req in batch:
+                    if req.profile_top is not None:
+                        req.batch_profile = batch_profile
+
+            done_at = time.perf_counter()
+            for i, req in enumerate(batch):
+                req.future.set_result(results[offsets[i]:offsets[i + 1]])
+
+            with self._cond:
+                self._batches += 1
+                self._requests += len(batch)
+                self._rows += len(merged)
+                self._latencies.extend(done_at - r.enqueued_at for r in batch)
+
+
+# ============================================================
+# Модульный реестр батчеров (живёт между вызовами из C#)
+# ============================================================
+_BATCHERS: Dict[Tuple[str, str], MicroBatcher] = {}
+_BATCHERS_LOCK = threading.Lock()
+
+
+def _make_loader(model_type: str, model_path: str) -> Callable:
+    if model_type not in _MODEL_CLASSES:
+        raise ValueError(f"Неизвестный тип модели: {model_type}. "
+                         f"Ожидается один из {list(_MODEL_CLASSES)}")
+    module_name, class_name = _MODEL_CLASSES[model_type]
+
+    def loader():
+        module = importlib.import_module(module_name)
+        return getattr(module, class_name).load(model_path)
+    return loader
+
+
+def get_batcher(model_type: str, model_path: str,
+                max_batch_rows: int = DEFAULT_MAX_BATCH_ROWS,
+                max_wait_ms: float = DEFAULT_MAX_WAIT_MS) -> MicroBatcher:
+    """Возвращает (создаёт при первом вызове) батчер для модели."""
+    model_type = (model_type or 'rf').lower()
+    key = (model_type, os.path.abspath(model_path))
+    with _BATCHERS_LOCK:
+        batcher = _BATCHERS.get(key)
+        if batcher is None:
+            batcher = MicroBatcher(
+                _make_loader(model_type, model_path),
+                max_batch_rows=max_batch_rows, max_wait_ms=max_wait_ms,
+                name=f"{model_type}:{os.path.basename(model_path)}")
+            _BATCHERS[key] = batcher
+            print(f"[MicroBatcher] Создан батчер {batcher.name} "
+                  f"(max_rows={batcher.max_batch_rows}, "
+                  f"max_wait={batcher.max_wait * 1000:.1f}ms)")
+        return batcher
+
+
+def predict_batch(model_type: str, model_path: str, json_data: str,
+                  timeout: float = None, profile: bool = False,
+                  profile_top: int = 0) -> str:
+    """
+    Drop-in замена model.predict_batch(json) с micro-batching.
+    JSON in -> JSON out, формат ответа тот же
+    (с profile=True — {"predictions": [...], "profile": {...}}).
+    """
+    # cProfile снимается в потоке-воркере (см. _run), здесь — только стадии
+    timer = make_timer(profile)
+    with timer.stage('parse'):
+        items = json.loads(json_data)
+    future = get_batcher(model_type, model_path).submit(
+        items, profile_top if profile else None)
+    predictions = future.result(timeout=timeout)
+
+    with timer.stage('serialize'):
+        out = json.dumps(predictions)
+    if not profile:
+        return out
+
+    req = future.request
+    if req.started_at is not None:
+        timer.add('queueWait', req.started_at - req.enqueued_at)
+    if req.batch_profile is not None:
+        timer.merge(req.batch_profile)
+    return profiled_response('predictions', out, timer)
+
+
+def batcher_stats() -> str:
+    with _BATCHERS_LOCK:
+        return json.dumps({b.name: b.stats() for b in _BATCHERS.values()})
+
+
+def clear_batchers():
+    """Останавливает все батчеры. Полезно для тестов/после переобучения."""
+    with _BATCHERS_LOCK:
+        for batcher in _BATCHERS.values():
+            batcher.close()
+        _BATCHERS.clear()
+    print("[MicroBatcher] Batchers cleared")
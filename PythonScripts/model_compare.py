@@ -0,0 +1,235 @@
+"""
+PythonScripts/model_compare.py
+
+Совместный инференс RF и CatBoost на одной матрице признаков
+(для POST /api/ml/compare).
+
+Раньше compare вызывал PredictFlowsBatch дважды: каждый раз flows
+заново сериализовались в JSON и парсились, матрица собиралась заново,
+скейлилась и заново прогонялся IsolationForest. Обе модели обучаются
+на одном и том же split'е и одном наборе признаков — общая у них вся
+предобработка.
+
+Здесь:
+  1. JSON парсится один раз; allow-list каждой модели применяется, как в
+     её predict_items (такие flows получают ответ allow-list, через модель
+     идут только остальные);
+  2. матрица собирается один раз по объединению признаков обеих моделей,
+     в float64 — каждый scaler видит точные значения, как при
+     extract_feature_matrix(..., scaler=...) в HybridIDS;
+  3. если списки признаков и параметры scaler'ов совпадают — скейлинг
+     общий. IsolationForest общий, только если IF обеих моделей совпадают
+     (те же деревья и offset_: после update() у RF-модели он свой) и ни у
+     одной не включён каскад;
+  4. каждая модель предсказывает своим _predict_raw — с её каскадом, если
+     он настроен (как в flow-analyze); кеш предсказаний не используется;
+  5. статистика согласия считается в NumPy.
+
+Ответ:
+  {
+    "rf":        [ ...как predict_batch... ],
+    "catBoost":  [ ...как predict_batch... ],
+    "agreement": { bothAttack, bothNormal, disagree, agreementRate, ... },
+    "sharedPreprocessing": true,
+    "sharedAnomalyDetector": true,
+    "allowlisted": { "rf": 12, "catBoost": 12 },
+    "cascade": { "rf": false, "catBoost": false },
+    "timingsMs": { parse, allowlist, matrix, scale, rf, catBoost, format }
+  }
+"""
+
+import json
+import time
+from typing import Dict
+
+import numpy as np
+
+from allowlist import allowlisted_prediction
+from ids_common import extract_feature_matrix, format_predictions, scale_features
+from inference_scheduler import scheduled, thread_budget
+
+
+def _same_preprocessing(rf_model, cb_model) -> bool:
+    if list(rf_model.feature_names) != list(cb_model.feature_names):
+        return False
+    s1, s2 = rf_model.scaler, cb_model.scaler
+    return (np.allclose(s1.mean_, s2.mean_, rtol=0, atol=1e-12)
+            and np.allclose(s1.scale_, s2.scale_, rtol=0, atol=1e-12))
+
+
+def _same_anomaly_detector(if1, if2) -> bool:
+    """IF обеих моделей — один и тот же лес: те же параметры, деревья и offset_."""
+    if if1 is if2:
+        return True
+    if (type(if1) is not type(if2) or if1.get_params() != if2.get_params()
+            or if1.offset_ != if2.offset_ or len(if1.estimators_) != len(if2.estimators_)):
+        return False
+    for e1, e2, f1, f2 in zip(if1.estimators_, if2.estimators_,
+                              if1.estimators_features_, if2.estimators_features_):
+        t1, t2 = e1.tree_, e2.tree_
+        if not (np.array_equal(f1, f2) and np.array_equal(t1.feature, t2.feature)
+                and np.array_equal(t1.threshold, t2.threshold)
+                and np.array_equal(t1.n_node_samples, t2.n_node_samples)):
+            return False
+    return True
+
+
+def _allowed(model, items) -> np.ndarray:
+    if model.allowlist is None:
+        return np.zeros(len(items), dtype=bool)
+    return model.allowlist.match(items)
+
+
+def _model_predictions(items, rows, allowed, preds, proba, if_raw, stages):
+    """
+    Ответ модели для всех items: строки rows — её предсказания,
+    flows из её allow-list — allowlisted_prediction. Возвращает
+    (список предсказаний, isAttack, proba) — массивы длины len(items).
+    """
+    n = len(items)
+    full_pred = np.zeros(n, dtype=np.int64)
+    full_proba = np.zeros(n)
+    full_if = np.ones(n, dtype=np.int64)
+    full_stages = None if stages is None else np.full(n, 2, dtype=np.int64)
+    full_pred[rows], full_proba[rows], full_if[rows] = preds, proba, if_raw
+    if stages is not None:
+        full_stages[rows] = stages
+
+    predictions = format_predictions(items, full_pred, full_proba, full_if, full_stages)
+    attack = (full_pred == 1) | (full_if == -1)
+    for i in np.flatnonzero(allowed).tolist():
+        predictions[i] = allowlisted_prediction(items[i], stages is not None)
+    attack[allowed] = False
+    full_proba[allowed] = 0.0
+    return predictions, attack, full_proba
+
+
+def agreement_stats(rf_attack: np.ndarray, cb_attack: np.ndarray,
+                    rf_proba: np.ndarray, cb_proba: np.ndarray) -> Dict:
+    """Согласие двух моделей по итоговому isAttack и по вероятностям."""
+    n = len(rf_attack)
+    both_attack = int(np.count_nonzero(rf_attack & cb_attack))
+    both_normal = int(np.count_nonzero(~rf_attack & ~cb_attack))
+    rf_only = int(np.count_nonzero(rf_attack & ~cb_attack))
+    cb_only = int(np.count_nonzero(~rf_attack & cb_attack))
+    agree = both_attack + both_normal
+
+    # Каппа Коэна: согласие с поправкой на случайное
+    p_o = agree / n if n else 0.0
+    p_rf, p_cb = (rf_attack.mean(), cb_attack.mean()) if n else (0.0, 0.0)
+    p_e = p_rf * p_cb + (1 - p_rf) * (1 - p_cb)
+    kappa = (p_o - p_e) / (1 - p_e) if p_e < 1 else 1.0
+
+    if n > 1 and rf_proba.std() > 0 and cb_proba.std() > 0:
+        corr = float(np.corrcoef(rf_proba, cb_proba)[0, 1])
+    else:
+        corr = None
+
+    return {
+        'bothAttack': both_attack,
+        'bothNormal': both_normal,
+        'disagree': rf_only + cb_only,
+        'agreementRate': round(p_o, 4),
+        'rfOnlyAttack': rf_only,
+        'catBoostOnlyAttack': cb_only,
+        'cohenKappa': round(float(kappa), 4),
+        'meanAbsConfidenceDiff': round(float(np.abs(rf_proba - cb_proba).mean()), 4) if n else 0.0,
+        'confidenceCorrelation': round(corr, 4) if corr is not None else None,
+    }
+
+
+@scheduled
+def predict_compare(rf_model_path: str, cb_model_path: str, json_data: str) -> str:
+    """Предсказания обеих моделей + статистика согласия, за один проход."""
+    from hybrid_ids import HybridIDS
+    from catboost_ids import CatBoostIDS
+
+    timings = {}
+    t = time.perf_counter()
+
+    def lap(name):
+        nonlocal t
+        now = time.perf_counter()
+        timings[name] = round((now - t) * 1000.0, 3)
+        t = now
+
+    rf_model = HybridIDS.load(rf_model_path)
+    cb_model = CatBoostIDS.load(cb_model_path)
+    t = time.perf_counter()
+
+    items = json.loads(json_data)
+    lap('parse')
+    if not items:
+        empty_flags, empty_proba = np.zeros(0, dtype=bool), np.zeros(0)
+        return json.dumps({
+            'rf': [], 'catBoost': [],
+            'agreement': agreement_stats(empty_flags, empty_flags, empty_proba, empty_proba),
+            'sharedPreprocessing': False,
+            'sharedAnomalyDetector': False,
+            'allowlisted': {'rf': 0, 'catBoost': 0},
+            'cascade': {'rf': rf_model.cascade is not None,
+                        'catBoost': cb_model.cascade is not None},
+            'timingsMs': timings,
+        })
+
+    # Через модели идут flows, которые не в allow-list хотя бы одной из них
+    rf_allowed, cb_allowed = _allowed(rf_model, items), _allowed(cb_model, items)
+    rows = np.flatnonzero(~(rf_allowed & cb_allowed))
+    model_items = [items[i] for i in rows.tolist()] if len(rows) < len(items) else items
+    lap('allowlist')
+
+    shared = _same_preprocessing(rf_model, cb_model)
+    shared_if = (shared and rf_model.cascade is None and cb_model.cascade is None
+                 and _same_anomaly_detector(rf_model.anomaly_detector, cb_model.anomaly_detector))
+
+    rf_out = cb_out = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), None)
+    if model_items:
+        # Матрица по объединению признаков (float64), каждая модель берёт свои столбцы
+        union = list(rf_model.feature_names)
+        union += [f for f in cb_model.feature_names if f not in set(union)]
+        col = {name: i for i, name in enumerate(union)}
+        X = extract_feature_matrix(model_items, union, dtype=np.float64)
+        X_rf = X[:, [col[f] for f in rf_model.feature_names]]
+        X_cb = np.ascontiguousarray(X[:, [col[f] for f in cb_model.feature_names]],
+                                    dtype=np.float32)
+        lap('matrix')
+
+        X_rf_scaled = scale_features(X_rf, rf_model.scaler)
+        del X, X_rf
+        lap('scale')
+
+        # RF — своим _predict_raw (каскад, IF), как в predict_items
+        rf_out = rf_model._predict_raw(X_rf_scaled, scaled=True)
+        lap('rf')
+
+        if shared_if:
+            # Тот же IF на тех же scaled-признаках — его ответ уже есть.
+            # CatBoost v2.1 работает на сырых признаках; старые v2 — на scaled
+            cb_pool = cb_model._supervised_pool(X_cb, X_rf_scaled)
+            cb_proba = cb_model.supervised.predict_proba(
+                cb_pool, thread_count=thread_budget(cb_model.thread_count))[:, 1]
+            cb_out = ((cb_proba > 0.5).astype(np.int64), cb_proba, rf_out[2], None)
+        else:
+            cb_out = cb_model._predict_raw(X_cb, inplace=True)
+        lap('catBoost')
+
+    rf_stages = rf_out[3] if rf_model.cascade is not None else None
+    cb_stages = cb_out[3] if cb_model.cascade is not None else None
+    rf_predictions, rf_attack, rf_proba = _model_predictions(
+        items, rows, rf_allowed, *rf_out[:3], rf_stages)
+    cb_predictions, cb_attack, cb_proba = _model_predictions(
+        items, rows, cb_allowed, *cb_out[:3], cb_stages)
+
+    result = {
+        'rf': rf_predictions,
+        'catBoost': cb_predictions,
+        'agreement': agreement_stats(rf_attack, cb_attack, rf_proba, cb_proba),
+        'sharedPreprocessing': shared,
+        'sharedAnomalyDetector': shared_if,
+        'allowlisted': {'rf': int(rf_allowed.sum()), 'catBoost': int(cb_allowed.sum())},
+        'cascade': {'rf': rf_model.cascade is not None,
+                    'catBoost': cb_model.cascade is not None},
+    }
+    lap('format')
+    result['timingsMs'] = timings
+    return json.dumps(result)
@@ -0,0 +1,154 @@
+"""
+PythonScripts/profiling.py
+
+Разбивка времени одного вызова по стадиям — для profile=True
+в predict_batch, find_similar_flows / knn_classify_flows и
+build_flows_from_packets.
+
+Когда /api/ml/flow-analyze тормозит, по общему ElapsedMs не видно,
+что виновато: парсинг JSON, сборка матрицы, скейлинг, RF, IF или
+сериализация ответа. StageTimer копит время по именованным стадиям
+(в микросекундах) и счётчики строк; опционально — cProfile top-N.
+
+Без profile=True используется NULL_TIMER: stage() у него — пустой
+контекстный менеджер, ответ и его форма не меняются.
+
+Пример:
+    timer = StageTimer(cprofile_top=20)
+    with timer.stage('parse'):
+        items = json.loads(payload)
+    timer.count('rows', len(items))
+    ...
+    timer.result()  # {'timingsUs': {...}, 'totalUs': ..., 'rows': {...}, 'cprofileTop': [...]}
+"""
+
+import cProfile
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class StageTimer:
+    """Время по стадиям (мкс, повторные входы в стадию суммируются) + счётчики."""
+
+    enabled = True
+
+    def __init__(self, cprofile_top: int = 0):
+        self.timings: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.cprofile_top = int(cprofile_top or 0)
+        self._profiler = cProfile.Profile() if self.cprofile_top > 0 else None
+        self._merged_cprofile = None
+        self._started = self._last_lap = time.perf_counter()
+        if self._profiler is not None:
+            self._profiler.enable()
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds * 1e6
+
+    def lap(self, name: str = None):
+        """Время с предыдущего lap() (или создания таймера) — в стадию name.
+        Для длинных линейных функций, где with-блоки пришлось бы вкладывать.
+        name=None — только сдвинуть отметку (время уже учтено через stage())."""
+        now = time.perf_counter()
+        if name is not None:
+            self.add(name, now - self._last_lap)
+        self._last_lap = now
+
+    def count(self, name: str, value: int):
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def merge(self, other: Dict, prefix: str = ''):
+        """Добавляет timingsUs/rows (и cprofileTop) из result() другого таймера, например батча."""
+        if 'cprofileTop' in other:
+            self._merged_cprofile = other['cprofileTop']
+        for name, us in other.get('timingsUs', {}).items():
+            self.timings[prefix + name] = self.timings.get(prefix + name, 0.0) + us
+        for name, value in other.get('rows', {}).items():
+            self.counts[prefix + name] = self.counts.get(prefix + name, 0) + value
+
+    def result(self) -> Dict:
+        total_us = (time.perf_counter() - self._started) * 1e6
+        out = {
+            'timingsUs': {k: round(v, 1) for k, v in self.timings.items()},
+            'totalUs': round(total_us, 1),
+            'rows': dict(self.counts),
+        }
+        if self._profiler is not None:
+            self._profiler.disable()
+            out['cprofileTop'] = _cprofile_top(self._profiler, self.cprofile_top)
+        elif self._merged_cprofile is not None:
+            out['cprofileTop'] = self._merged_cprofile
+        return out
+
+
+class _NullTimer:
+    """Таймер-заглушка: profile выключен, накладные расходы — пустой with."""
+
+    enabled = False
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def add(self, name: str, seconds: float):
+        pass
+
+    def lap(self, name: str = None):
+        pass
+
+    def count(self, name: str, value: int):
+        pass
+
+    def merge(self, other: Dict, prefix: str = ''):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+def make_timer(profile: bool = False, profile_top: int = 0):
+    """StageTimer при profile=True, иначе NULL_TIMER."""
+    return StageTimer(profile_top) if profile else NULL_TIMER
+
+
+def profiled_response(key: str, payload_json: str, timer: StageTimer) -> str:
+    """
+    {"<key>": <payload>, "profile": {...}} — для ответов-списков.
+    payload_json уже сериализован (его время — стадия serialize),
+    поэтому склеиваем строки, а не сериализуем ответ второй раз.
+    """
+    return '{"%s": %s, "profile": %s}' % (key, payload_json, json.dumps(timer.result()))
+
+
+def append_profile(obj_json: str, timer: StageTimer) -> str:
+    """Добавляет "profile" последним ключом в уже сериализованный JSON-объект."""
+    return '%s, "profile": %s}' % (obj_json[:-1], json.dumps(timer.result()))
+
+
+def _cprofile_top(profiler: cProfile.Profile, top_n: int) -> List[Dict]:
+    """Top-N функций по cumulative time. Под cProfile сами стадии идут медленнее."""
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    rows = []
+    for func in stats.fcn_list[:top_n]:
+        cc, ncalls, tottime, cumtime, _ = stats.stats[func]
+        filename, line, name = func
+        rows.append({
+            'function': f"{filename}:{line}({name})" if line else name,
+            'ncalls': ncalls,
+            'tottimeUs': round(tottime * 1e6, 1),
+            'cumtimeUs': round(cumtime * 1e6, 1),
+        })
+    return rows
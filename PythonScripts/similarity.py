@@ -11,16 +11,40 @@ similarity.py
     B (numeric)   — Z-score нормализация + евклидово расстояние → exp(-d)
     C (binary)    — Simple Matching Coefficient по бинарным TCP-флагам
 
-Два режима:
-    1. find_similar_flows() — top-K похожих на target (быстро, циклом)
+Режимы:
+    1. find_similar_flows() — top-K похожих на target; все кандидаты
+       считаются векторно (тот же тайловый движок), top-K — через
+       argpartition. find_similar_flows_multi() — сразу для списка target
+       (например, кластера алертов).
     2. knn_classify_flows() — kNN-классификация всех flows
-       Использует векторизацию NumPy: вся sim-матрица вычисляется
-       за O(n²) numpy-операций вместо Python-циклов. Ускорение ~30x.
+       Векторизация NumPy по тайлам: sim считается блоками строк против
+       всех flows (float32-буферы тайла переиспользуются), от каждого
+       тайла остаётся только top-k. Память O(tile·n + n·k) вместо
+       нескольких n×n float64-матриц — 50k flows больше не OOM.
+       Тайлы считаются параллельно потоками бюджета inference_scheduler.
+    3. sweep_weights() — agreement/F1 kNN сразу для сетки весов (w1, w2, w3)
+       и значений k: компоненты sim считаются один раз, каждая точка сетки
+       пересчитывает только веса ~54·k кандидатов на строку.
+
+profile=True во всех режимах добавляет в ответ ключ "profile":
+время стадий в мкс (parse, normalize, sim, topk, serialize; у kNN
+ещё blocks и format, у sweep_weights — sweep) и число flows — см. profiling.py.
+
+session_id=... во всех режимах берёт блоки A/B/C из кеша сессии
+(similarity_store.py): определение полей, z-score, коды A и упаковка C
+считаются один раз на версию сессии, а не на каждый вызов.
 """
 
 import json
 import math
+import queue
+import time
 import numpy as np
+from joblib import Parallel, delayed
+
+from profiling import NULL_TIMER, make_timer, append_profile
+from inference_scheduler import scheduled, current_budget, blas_serial
+import similarity_store
 
 
 # ============================================================
@@ -53,13 +77,20 @@ EXCLUDED_NUMERIC = {
     'IsAttack', 'Confidence', 'ThreatLevel',
 }
 
+# Число единичных бит в байте: SMC блока C по упакованным флагам
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+_bitwise_count = getattr(np, 'bitwise_count', None)   # NumPy 2.0+, иначе — таблица
+
 
 # ============================================================
 # РЕЖИМ 1: find_similar_flows
 # ============================================================
 
-def find_similar_flows(flows_json, target_flow_id, w1, w2, w3, k=10):
+def find_similar_flows(flows_json, target_flow_id, w1, w2, w3, k=10,
+                       profile=False, profile_top=0, session_id=None, session_version=None):
+    timer = make_timer(profile, profile_top)
     flows = json.loads(flows_json)
+    timer.lap('parse')
     if not flows:
         return json.dumps({"error": "Empty flows list", "results": []})
 
@@ -72,64 +103,94 @@ def find_similar_flows(flows_json, target_flow_id, w1, w2, w3, k=10):
             "results": []
         })
 
-    numeric_fields = _detect_numeric_fields(flows)
-    norm_data = _zscore_normalize(flows, numeric_fields)
-    target_idx = next(i for i, f in enumerate(flows) if f.get('Id') == target_flow_id)
-    target_norm = norm_data[target_idx]
+    blocks = _similarity_blocks(flows, timer, session_id, session_version)
+    timer.lap('blocks')
+    results = _similar_to_targets(flows, blocks, (w1, w2, w3), [target_flow_id], k, timer)[0]
+    timer.lap()
 
-    results = []
-    for i, flow in enumerate(flows):
-        if flow.get('Id') == target_flow_id:
-            continue
-        sim_a = _block_a_similarity(target, flow)
-        sim_b = _block_b_similarity_single(target_norm, norm_data[i])
-        sim_c = _block_c_similarity(target, flow)
-        sim = w1 * sim_a + w2 * sim_b + w3 * sim_c
-
-        results.append({
-            "flowId": flow.get('Id'),
-            "sourceIP": flow.get('SourceIP', ''),
-            "destinationIP": flow.get('DestinationIP', ''),
-            "sourcePort": flow.get('SourcePort', 0),
-            "destinationPort": flow.get('DestinationPort', 0),
-            "protocol": flow.get('Protocol', ''),
-            "isAttack": bool(flow.get('IsAttack', False)),
-            "threatLevel": flow.get('ThreatLevel', 'Low'),
-            "simA": round(sim_a, 4),
-            "simB": round(sim_b, 4),
-            "simC": round(sim_c, 4),
-            "sim": round(sim, 4),
-        })
-
-    results.sort(key=lambda r: r['sim'], reverse=True)
-    results = results[:k]
-
-    return json.dumps({
+    out = json.dumps({
         "targetFlow": _flow_summary(target),
         "weights": {"w1": round(w1, 4), "w2": round(w2, 4), "w3": round(w3, 4)},
         "blocks": {
             "A": BLOCK_A_FIELDS,
-            "B": numeric_fields,
+            "B": blocks['numeric_fields'],
             "C": BLOCK_C_FIELDS,
         },
         "totalCandidates": len(flows) - 1,
         "k": k,
         "results": results,
     })
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
+
+
+def find_similar_flows_multi(flows_json, target_flow_ids_json, w1, w2, w3, k=10,
+                             profile=False, profile_top=0, session_id=None,
+                             session_version=None):
+    """
+    find_similar_flows для нескольких target сразу (например, весь кластер
+    алертов): блоки A/B/C строятся один раз, sim всех target против всех
+    flows — тайлами. Ответ: {"targets": [{"targetFlow", "results"}, ...],
+    "missingTargetIds": [...]} + общие weights/blocks/k.
+    """
+    timer = make_timer(profile, profile_top)
+    flows = json.loads(flows_json)
+    target_ids = json.loads(target_flow_ids_json)
+    timer.lap('parse')
+    if not flows:
+        return json.dumps({"error": "Empty flows list", "targets": []})
+
+    w1, w2, w3 = _normalize_weights(w1, w2, w3)
+
+    by_id = {}
+    for f in flows:
+        by_id.setdefault(f.get('Id'), f)
+    found = [tid for tid in dict.fromkeys(target_ids) if tid in by_id]
+    missing = [tid for tid in dict.fromkeys(target_ids) if tid not in by_id]
+
+    blocks = _similarity_blocks(flows, timer, session_id, session_version)
+    timer.lap('blocks')
+    per_target = _similar_to_targets(flows, blocks, (w1, w2, w3), found, k, timer)
+    timer.lap()
+
+    out = json.dumps({
+        "weights": {"w1": round(w1, 4), "w2": round(w2, 4), "w3": round(w3, 4)},
+        "blocks": {
+            "A": BLOCK_A_FIELDS,
+            "B": blocks['numeric_fields'],
+            "C": BLOCK_C_FIELDS,
+        },
+        "totalCandidates": len(flows) - 1,
+        "k": k,
+        "targets": [{"targetFlow": _flow_summary(by_id[tid]), "results": results}
+                    for tid, results in zip(found, per_target)],
+        "missingTargetIds": missing,
+    })
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
 
 
 # ============================================================
 # РЕЖИМ 2: knn_classify_flows (ВЕКТОРИЗОВАННАЯ ВЕРСИЯ)
 # ============================================================
 
-def knn_classify_flows(flows_json, labels_json, w1, w2, w3, k=5):
+@scheduled
+def knn_classify_flows(flows_json, labels_json, w1, w2, w3, k=5,
+                       profile=False, profile_top=0, tile_rows=None,
+                       session_id=None, session_version=None):
     """
     kNN-классификатор на мере сходства.
-    Все попарные sim считаются векторизованно через numpy за O(n²)
-    matrix-операций вместо Python-циклов. Ускорение ~30x.
+    Попарные sim считаются векторизованно по тайлам: блок из tile_rows
+    строк против всех n flows, от тайла остаётся только top-k каждой
+    строки. Полная n×n матрица не строится — память O(tile_rows·n + n·k)
+    (tile_rows=None — по бюджету SIM_TILE_BYTES).
+    Выполняется в слоте inference_scheduler: тайлы делятся между
+    потоками бюджета слота (IDS_INFERENCE_THREADS).
     """
+    timer = make_timer(profile, profile_top)
     flows = json.loads(flows_json)
     labels = json.loads(labels_json)
+    timer.lap('parse')
 
     if not flows or len(flows) < k + 1:
         return json.dumps({
@@ -141,78 +202,17 @@ def knn_classify_flows(flows_json, labels_json, w1, w2, w3, k=5):
     n = len(flows)
 
     # ============================================================
-    # ШАГ 1: ПОДГОТОВКА МАТРИЦ
+    # ШАГ 1: ПОДГОТОВКА БЛОКОВ
     # ============================================================
-
-    # Блок B — числовые признаки, Z-score нормализованные
-    numeric_fields = _detect_numeric_fields(flows)
-    B = _zscore_normalize(flows, numeric_fields)   # (n, m_b)
-
-    # Блок A — категориальные. Конвертируем в строки → числа через факторизацию
-    # (для каждой колонки своё мэппинг str→int)
-    A_str = np.array([
-        [str(f.get(field, '')) for field in BLOCK_A_FIELDS]
-        for f in flows
-    ])  # (n, 5)
-
-    # Блок C — бинаризованные флаги
-    C = np.zeros((n, len(BLOCK_C_FIELDS)), dtype=np.int8)
-    for i, f in enumerate(flows):
-        for j, field in enumerate(BLOCK_C_FIELDS):
-            C[i, j] = 1 if (f.get(field, 0) or 0) > 0 else 0
+    blocks = _similarity_blocks(flows, timer, session_id, session_version)
+    numeric_fields = blocks['numeric_fields']
+    timer.lap('blocks')
 
     # ============================================================
-    # ШАГ 2: ВЕКТОРИЗАЦИЯ — ВСЕ ПОПАРНЫЕ SIM СРАЗУ
-    # ============================================================
-
-    # --- Sim_A: матрица (n, n) долей совпадения по A-полям ---
-    # Для каждой A-колонки получаем (n,n) матрицу совпадений и усредняем
-    sim_a_matrix = np.zeros((n, n), dtype=np.float64)
-    for col_idx in range(len(BLOCK_A_FIELDS)):
-        col = A_str[:, col_idx]
-        # equals[i,j] = (col[i] == col[j])
-        equals = (col[:, None] == col[None, :]).astype(np.float64)
-        sim_a_matrix += equals
-    sim_a_matrix /= len(BLOCK_A_FIELDS)
-
-    # --- Sim_B: матрица (n, n) — exp(-d / sqrt(m_b)) ---
-    # Через сумму квадратов разностей: ||a-b||² = ||a||² + ||b||² - 2·a·b
-    if B.shape[1] > 0:
-        sq_norms = (B * B).sum(axis=1)            # (n,)
-        dot = B @ B.T                              # (n, n)
-        dist_sq = sq_norms[:, None] + sq_norms[None, :] - 2 * dot
-        dist_sq = np.maximum(dist_sq, 0)           # численная защита
-        dist = np.sqrt(dist_sq)
-        scale = math.sqrt(B.shape[1])
-        sim_b_matrix = np.exp(-dist / scale)
-    else:
-        sim_b_matrix = np.zeros((n, n), dtype=np.float64)
-
-    # --- Sim_C: SMC через AND/XOR на бинарной матрице ---
-    # SMC = (matches) / total. matches = total - hamming_distance
-    m_c = C.shape[1]
-    if m_c > 0:
-        # Для каждой пары: число совпадающих бит
-        # XOR: 1 если разные, 0 если одинаковые. Сумма по фичам = #разных
-        # m_c - #разных = #одинаковых
-        # Используем: matches = m_c - hamming
-        # hamming(i,j) = sum over k of |C[i,k] - C[j,k]| (для бинарных = XOR)
-        # Вычислим через C·C.T для одинаковых единиц + (1-C)·(1-C).T для одинаковых нулей
-        ones_match = C @ C.T                                    # (n,n) — оба = 1
-        zeros_match = (1 - C) @ (1 - C).T                       # оба = 0
-        sim_c_matrix = (ones_match + zeros_match).astype(np.float64) / m_c
-    else:
-        sim_c_matrix = np.zeros((n, n), dtype=np.float64)
-
-    # --- Итоговая sim-матрица ---
-    sim_matrix = w1 * sim_a_matrix + w2 * sim_b_matrix + w3 * sim_c_matrix
-
-    # На диагонали обнуляем (сам с собой не сравниваем)
-    np.fill_diagonal(sim_matrix, -1)  # -1 чтобы не попасть в top-k
-
-    # ============================================================
-    # ШАГ 3: kNN — для каждой строки находим top-k по sim
+    # ШАГ 2-3: ПОПАРНЫЕ SIM ПО ТАЙЛАМ + top-k КАЖДОЙ СТРОКИ
     # ============================================================
+    top_k_idx, top_k_sim = _knn_topk_tiled(blocks, (w1, w2, w3), k, tile_rows, timer)
+    timer.lap()
 
     # labels: {str(id): bool}, приведём к {int: bool}
     labels_map = {int(k_): bool(v) for k_, v in labels.items()}
@@ -222,58 +222,22 @@ def knn_classify_flows(flows_json, labels_json, w1, w2, w3, k=5):
         dtype=bool
     )
 
-    # argsort по убыванию по каждой строке, берём первые k
-    # (быстрее использовать argpartition + потом сортировать только k)
-    if k < n:
-        top_k_idx = np.argpartition(-sim_matrix, k, axis=1)[:, :k]
-        # Эти k индексов не отсортированы — отсортируем по sim каждую строку
-        for i in range(n):
-            row_sims = sim_matrix[i, top_k_idx[i]]
-            order = np.argsort(-row_sims)
-            top_k_idx[i] = top_k_idx[i, order]
-    else:
-        top_k_idx = np.argsort(-sim_matrix, axis=1)[:, :k]
-
     # ============================================================
     # ШАГ 4: формируем результат
     # ============================================================
 
-    predictions = []
-    for i in range(n):
-        target_id = flow_ids[i]
-        flow_i = flows[i]
-
-        neighbors = []
-        for j_idx in top_k_idx[i]:
-            neighbors.append({
-                "flowId": flow_ids[j_idx],
-                "sim": round(float(sim_matrix[i, j_idx]), 4),
-                "isAttack": bool(labels_arr[j_idx])
-            })
-
-        attack_votes = sum(1 for n_ in neighbors if n_['isAttack'])
-        knn_confidence = attack_votes / k if k > 0 else 0.0
-        knn_is_attack = knn_confidence > 0.5
-
-        predictions.append({
-            "flowId": target_id,
-            "sourceIP": flow_i.get('SourceIP', ''),
-            "destinationIP": flow_i.get('DestinationIP', ''),
-            "destinationPort": flow_i.get('DestinationPort', 0),
-            "protocol": flow_i.get('Protocol', ''),
-            "knnIsAttack": knn_is_attack,
-            "knnConfidence": round(knn_confidence, 4),
-            "neighbors": neighbors,
-            "originalLabel": bool(labels_arr[i]),
-        })
+    predictions = [_knn_prediction(flows[i], flow_ids, labels_arr, top_k_idx[i], top_k_sim[i],
+                                   k, labels_arr[i])
+                   for i in range(n)]
 
     knn_attacks = sum(1 for p in predictions if p['knnIsAttack'])
     original_attacks = int(labels_arr.sum())
     agree = sum(1 for p in predictions
                 if p['knnIsAttack'] == p['originalLabel'])
     agreement = agree / n if n > 0 else 0.0
+    timer.lap('format')
 
-    return json.dumps({
+    out = json.dumps({
         "totalFlows": n,
         "knnAttackFlows": knn_attacks,
         "originalAttackFlows": original_attacks,
@@ -287,6 +251,733 @@ def knn_classify_flows(flows_json, labels_json, w1, w2, w3, k=5):
         },
         "predictions": predictions,
     })
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
+
+
+# ============================================================
+# РЕЖИМ 3: sweep_weights — подбор w1/w2/w3 и k для kNN
+# ============================================================
+
+@scheduled
+def sweep_weights(flows_json, labels_json, weights_json=None, k_values_json=None,
+                  grid_step=0.1, profile=False, profile_top=0, tile_rows=None,
+                  session_id=None, session_version=None):
+    """
+    Оценка knn_classify_flows сразу для сетки весов и значений k.
+
+    weights_json — список троек [w1, w2, w3] (нормируются, как в
+    knn_classify_flows); без него — симплекс w1+w2+w3=1 с шагом grid_step
+    (0.1 -> 66 точек). k_values_json — список k (по умолчанию [5]).
+
+    Блоки A/B/C и их попарные компоненты считаются один раз (по тайлам);
+    на каждую тройку весов пересчитываются только веса кандидатов — см.
+    _sweep_confusion_tiled. Для каждой комбинации — agreement с метками
+    (как agreementWithOriginal в knn_classify_flows) и precision/recall/F1
+    по классу «атака»; best — комбинация с наибольшим F1.
+
+    При w2 > 0 метрики совпадают с отдельными вызовами knn_classify_flows:
+    оба при равных sim берут соседа с меньшим индексом. Исключение — sim,
+    различающиеся меньше погрешности float64 (точные дубликаты строк
+    Block B): здесь sim_b считается через ||a||² + ||b||² - 2·a·b
+    (погрешность ~1e-8), и порядок таких соседей может отличаться.
+    При w2 = 0 у соседей одной группы sim в точности равны, и
+    knn_classify_flows берёт среди них меньшие индексы: для таких точек
+    сетки отбирается второй набор кандидатов — первые k_max каждой группы
+    по индексу, и метрики совпадают с knn_classify_flows.
+    """
+    timer = make_timer(profile, profile_top)
+    flows = json.loads(flows_json)
+    labels = json.loads(labels_json)
+    raw_weights = json.loads(weights_json) if weights_json else None
+    k_values = sorted({int(k) for k in json.loads(k_values_json)}) if k_values_json else [5]
+    timer.lap('parse')
+
+    if raw_weights is not None and any(min(w) < 0 or len(w) != 3 for w in raw_weights):
+        return json.dumps({"error": "Weights must be non-negative triples [w1, w2, w3]",
+                           "results": []})
+    if raw_weights is None and not 0 < grid_step <= 1:
+        return json.dumps({"error": "grid_step must be in (0, 1]", "results": []})
+    weight_grid = ([_normalize_weights(*w) for w in raw_weights] if raw_weights is not None
+                   else _weight_simplex(grid_step))
+    if not weight_grid or not k_values or k_values[0] < 1:
+        return json.dumps({"error": "Need at least one weight triple and k >= 1",
+                           "results": []})
+    k_max = k_values[-1]
+    if not flows or len(flows) < k_max + 1:
+        return json.dumps({
+            "error": f"Need at least {k_max+1} flows, got {len(flows) if flows else 0}",
+            "results": []
+        })
+
+    n = len(flows)
+    blocks = _similarity_blocks(flows, timer, session_id, session_version)
+    timer.lap('blocks')
+
+    labels_map = {int(k_): bool(v) for k_, v in labels.items()}
+    labels_arr = np.array([labels_map.get(f.get('Id'), False) for f in flows], dtype=bool)
+
+    confusion = _sweep_confusion_tiled(blocks, weight_grid, k_values, labels_arr,
+                                       tile_rows, timer)
+    timer.lap()
+    timer.count('combinations', len(weight_grid) * len(k_values))
+
+    results = []
+    for w_idx, (w1, w2, w3) in enumerate(weight_grid):
+        for k_idx, k in enumerate(k_values):
+            tp, fp, fn, tn = (int(v) for v in confusion[w_idx, k_idx])
+            precision = tp / (tp + fp) if tp + fp else 0.0
+            recall = tp / (tp + fn) if tp + fn else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+            results.append({
+                "weights": {"w1": round(w1, 4), "w2": round(w2, 4), "w3": round(w3, 4)},
+                "k": k,
+                "knnAttackFlows": tp + fp,
+                "agreement": round((tp + tn) / n, 4),
+                "precision": round(precision, 4),
+                "recall": round(recall, 4),
+                "f1": round(f1, 4),
+            })
+    best = max(results, key=lambda r: (r['f1'], r['agreement']))
+    timer.lap('format')
+
+    out = json.dumps({
+        "totalFlows": n,
+        "originalAttackFlows": int(labels_arr.sum()),
+        "combinations": len(results),
+        "kValues": k_values,
+        "best": best,
+        "blocks": {
+            "A": BLOCK_A_FIELDS,
+            "B": blocks['numeric_fields'],
+            "C": BLOCK_C_FIELDS,
+        },
+        "results": results,
+    })
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
+
+
+def _knn_prediction(flow, flow_ids, labels_arr, neighbors_idx, neighbors_sim, k, original_label):
+    """Элемент predictions: соседи строки и голосование большинством."""
+    neighbors = []
+    for j_idx, sim_ij in zip(neighbors_idx, neighbors_sim):
+        neighbors.append({
+            "flowId": flow_ids[j_idx],
+            "sim": round(float(sim_ij), 4),
+            "isAttack": bool(labels_arr[j_idx])
+        })
+
+    attack_votes = sum(1 for n_ in neighbors if n_['isAttack'])
+    knn_confidence = attack_votes / k if k > 0 else 0.0
+    knn_is_attack = knn_confidence > 0.5
+
+    return {
+        "flowId": flow.get('Id'),
+        "sourceIP": flow.get('SourceIP', ''),
+        "destinationIP": flow.get('DestinationIP', ''),
+        "destinationPort": flow.get('DestinationPort', 0),
+        "protocol": flow.get('Protocol', ''),
+        "knnIsAttack": knn_is_attack,
+        "knnConfidence": round(knn_confidence, 4),
+        "neighbors": neighbors,
+        "originalLabel": bool(original_label),
+    }
+
+
+def _weight_simplex(step):
+    """Тройки (w1, w2, w3) с шагом step на симплексе w1 + w2 + w3 = 1."""
+    parts = max(1, int(round(1.0 / step)))
+    return [(i / parts, j / parts, (parts - i - j) / parts)
+            for i in range(parts + 1) for j in range(parts + 1 - i)]
+
+
+# ============================================================
+# Тайловый движок kNN
+# ============================================================
+
+# Бюджет памяти на один тайл: float32 sim и временный, float64 буфер под
+# dot/расстояния, uint8/bool-буферы блоков A и C и int64-индексы
+# argpartition — ~27 байт на ячейку tile_rows × n
+SIM_TILE_BYTES = 64 * 1024 * 1024
+_TILE_BYTES_PER_CELL = 27
+# Запас при отборе кандидатов из float32-тайла: округление до 4 знаков
+# (±5e-5) + погрешность float32
+SIM_TIE_EPS = 1e-4
+# sweep_weights: к буферам тайла добавляются int64-перестановка
+# сортировки, int64-ранги и номера групп — ~50 байт на ячейку
+_SWEEP_BYTES_PER_CELL = 50
+# + группа int8 и её argsort int64 — для точек сетки с w2 = 0
+_SWEEP_FLAT_BYTES_PER_CELL = 9
+
+
+def _similarity_blocks(flows, timer, session_id=None, session_version=None):
+    """
+    Матрицы блоков A/B/C для тайлового движка. С session_id — через
+    similarity_store: повторные вызовы по той же сессии (те же Id flows,
+    значения Block B и session_version) берут готовые блоки из памяти
+    процесса или с диска. Сырая матрица Block B собирается всегда — она
+    входит в fingerprint (flow-analyze переписывает ThreatScore).
+    """
+    timer.count('rows', len(flows))
+    if session_id is None:
+        return _build_similarity_blocks(flows, timer)
+    numeric_fields = _detect_numeric_fields(flows)
+    raw = _numeric_matrix(flows, numeric_fields)
+    timer.lap('fingerprint')
+    blocks, source = similarity_store.load_or_build(
+        session_id, flows, lambda: _build_similarity_blocks(flows, timer, numeric_fields, raw),
+        session_version, content=('\x1f'.join(numeric_fields), raw))
+    timer.count('blockCacheHit', int(source != 'built'))
+    return blocks
+
+
+def _build_similarity_blocks(flows, timer, numeric_fields=None, raw=None):
+    # Блок B — числовые признаки, Z-score нормализованные
+    if numeric_fields is None:
+        numeric_fields = _detect_numeric_fields(flows)
+    B = _zscore_normalize(flows, numeric_fields, raw)   # (n, m_b)
+    timer.lap('normalize')
+
+    return {
+        'numeric_fields': numeric_fields,
+        'A': _factorize_a(flows),                  # (n, 5) int32
+        'B': B,
+        'B_sq': (B * B).sum(axis=1),
+        'C': _pack_c(flows),                       # (n, ceil(m_c/8)) uint8
+    }
+
+
+def _factorize_a(flows, vocabs=None):
+    """
+    Блок A -> int32-коды: каждая колонка факторизуется один раз
+    (str(значение) -> номер первого появления). Равенство кодов ==
+    равенство строк, но сравнивать int32 на порядок дешевле, чем
+    (n, 5)-массив unicode. Хранится по колонкам (order='F'): тайл
+    сравнивает колонку целиком, и непрерывная колонка — в разы быстрее
+    страйдовой. vocabs — словари колонок для дозаписи строк в уже
+    закодированную сессию (similarity_incremental), дополняются на месте.
+    """
+    A = np.empty((len(flows), len(BLOCK_A_FIELDS)), dtype=np.int32, order='F')
+    for col_idx, field in enumerate(BLOCK_A_FIELDS):
+        codes = vocabs[col_idx] if vocabs is not None else {}
+        A[:, col_idx] = [codes.setdefault(str(f.get(field, '')), len(codes))
+                         for f in flows]
+    return A
+
+
+def _pack_c(flows):
+    """
+    Блок C -> биты флагов (значение > 0), упакованные по 8 в байт:
+    (n, ceil(m_c/8)), по колонкам, как и A.
+    """
+    bits = np.array([[1 if (f.get(field, 0) or 0) > 0 else 0 for field in BLOCK_C_FIELDS]
+                     for f in flows], dtype=np.uint8).reshape(len(flows), len(BLOCK_C_FIELDS))
+    return np.asfortranarray(np.packbits(bits, axis=1))
+
+
+def _tile_buffers(rows, n):
+    """Буферы одного тайла rows × n (переиспользуются между тайлами)."""
+    return {
+        'out': np.empty((rows, n), dtype=np.float32),
+        'work': np.empty((rows, n), dtype=np.float64),
+        'tmp': np.empty((rows, n), dtype=np.float32),
+        'count': np.empty((rows, n), dtype=np.uint8),
+        'bytes': np.empty((rows, n), dtype=np.uint8),
+        'mask': np.empty((rows, n), dtype=bool),
+    }
+
+
+def _similarity_tile(blocks, rows, weights, bufs, col_blocks=None):
+    """
+    bufs['out'][:] = sim(flows[rows], все flows) в float32, без промежуточных
+    n×n матриц. rows — slice или массив индексов; bufs — _tile_buffers(),
+    обрезанные до числа строк тайла. col_blocks — блоки столбцов тайла,
+    закодированные так же (по умолчанию — те же blocks).
+    """
+    w1, w2, w3 = weights
+    col_blocks = blocks if col_blocks is None else col_blocks
+    A, B, C = blocks['A'], blocks['B'], blocks['C']
+    out, work, tmp, count, mask = (bufs['out'], bufs['work'], bufs['tmp'],
+                                   bufs['count'], bufs['mask'])
+
+    # --- Sim_A: доля совпавших A-полей ---
+    _tile_a_matches(A, rows, count, mask, col_blocks['A'])
+    np.multiply(count, np.float32(w1 / A.shape[1]), out=out)
+
+    # --- Sim_B ---
+    if B.shape[1] > 0:
+        _tile_b_similarity(blocks, rows, work, col_blocks)
+        work *= w2
+        out += work
+
+    # --- Sim_C: SMC = (m_c - mismatches) / m_c ---
+    m_c = len(BLOCK_C_FIELDS)
+    if m_c > 0:
+        _tile_c_mismatches(C, rows, count, bufs['bytes'], col_blocks['C'])
+        np.multiply(count, np.float32(-w3 / m_c), out=tmp)
+        tmp += np.float32(w3)
+        out += tmp
+
+
+def _tile_a_matches(A, rows, count, mask, A_cols=None):
+    """count[:] = число совпавших A-полей: сравнение int32-кодов, счёт в uint8."""
+    A_cols = A if A_cols is None else A_cols
+    count.fill(0)
+    for col_idx in range(A.shape[1]):
+        np.equal(A[rows, col_idx, None], A_cols[None, :, col_idx], out=mask)
+        count += mask
+
+
+def _tile_b_similarity(blocks, rows, work, col_blocks=None):
+    """work[:] = exp(-||a-b|| / sqrt(m_b)), ||a-b||² = ||a||² + ||b||² - 2·a·b (float64)."""
+    col_blocks = blocks if col_blocks is None else col_blocks
+    B, sq = blocks['B'], blocks['B_sq']
+    np.dot(B[rows], col_blocks['B'].T, out=work)
+    work *= -2.0
+    work += sq[rows, None]
+    work += col_blocks['B_sq'][None, :]
+    np.maximum(work, 0, out=work)              # численная защита
+    np.sqrt(work, out=work)
+    work *= -1.0 / math.sqrt(B.shape[1])
+    np.exp(work, out=work)
+
+
+def _tile_c_mismatches(C, rows, mismatches, scratch, C_cols=None):
+    """mismatches[:] = число несовпавших флагов C: popcount(a ^ b) по упакованным байтам."""
+    C_cols = C if C_cols is None else C_cols
+    for byte_idx in range(C.shape[1]):
+        xor = mismatches if byte_idx == 0 else scratch
+        np.bitwise_xor(C[rows, byte_idx, None], C_cols[None, :, byte_idx], out=xor)
+        _popcount(xor, out=xor)
+        if byte_idx > 0:
+            mismatches += xor
+
+
+def _popcount(x, out=None):
+    """Число единичных бит каждого байта: np.bitwise_count (NumPy 2.0+) или таблица _POPCOUNT."""
+    if _bitwise_count is not None:
+        return _bitwise_count(x, out=out)
+    return np.take(_POPCOUNT, x, out=out)
+
+
+def _pair_components(blocks, rows, cols, col_blocks=None):
+    """
+    Точные (float64) sim_a, sim_b, sim_c для пар (rows[i], cols[i, j]) —
+    как в полной матрице. Тайл в float32 нужен только для отбора кандидатов.
+    cols — индексы в col_blocks (по умолчанию — в тех же blocks).
+    """
+    col_blocks = blocks if col_blocks is None else col_blocks
+    A, B, C = blocks['A'], blocks['B'], blocks['C']
+
+    sim_a = (A[rows][:, None, :] == col_blocks['A'][cols]).sum(axis=2) / A.shape[1]
+    if B.shape[1] > 0:
+        diff = B[rows][:, None, :] - col_blocks['B'][cols]
+        dist = np.sqrt(np.maximum((diff * diff).sum(axis=2), 0))
+        sim_b = np.exp(-dist / math.sqrt(B.shape[1]))
+    else:
+        sim_b = np.zeros(cols.shape, dtype=np.float64)
+    m_c = len(BLOCK_C_FIELDS)
+    if m_c > 0:
+        mismatches = _popcount(C[rows][:, None, :] ^ col_blocks['C'][cols]).sum(axis=2)
+        sim_c = (m_c - mismatches) / m_c
+    else:
+        sim_c = np.zeros(cols.shape, dtype=np.float64)
+    return sim_a, sim_b, sim_c
+
+
+def _pair_similarity(blocks, weights, rows, cols, col_blocks=None):
+    w1, w2, w3 = weights
+    sim_a, sim_b, sim_c = _pair_components(blocks, rows, cols, col_blocks)
+    return w1 * sim_a + w2 * sim_b + w3 * sim_c
+
+
+def _tile_rows_for(n, tile_rows=None, workers=1, bytes_per_cell=_TILE_BYTES_PER_CELL,
+                   width=None):
+    """Строк в тайле из n строк шириной width столбцов (по умолчанию n)."""
+    if tile_rows:
+        return max(1, min(int(tile_rows), n))
+    width = n if width is None else width
+    return max(1, min(n, SIM_TILE_BYTES // (bytes_per_cell * max(width, 1) * workers)))
+
+
+def _knn_topk_tiled(blocks, weights, k, tile_rows=None, timer=NULL_TIMER):
+    """
+    top-k соседей каждой строки: (idx (n, k), sim (n, k)), по убыванию sim,
+    при равных sim — меньший индекс.
+
+    Тайлы по tile_rows строк раздаются потокам бюджета слота
+    inference_scheduler (joblib поверх общего пула планировщика): NumPy
+    отпускает GIL в dot/exp/сравнениях/argpartition, у каждого потока свои
+    буферы тайла. Каждый тайл пишет только свои строки результата —
+    ответ не зависит от числа потоков и порядка выполнения.
+    """
+    n = blocks['B'].shape[0]
+    k = max(0, min(int(k), n - 1))
+    top_idx = np.zeros((n, k), dtype=np.int64)
+    top_sim = np.zeros((n, k), dtype=np.float64)
+    if k == 0:
+        return top_idx, top_sim
+
+    workers = max(1, min(current_budget() or 1, n))
+    # Бюджет памяти SIM_TILE_BYTES делится между потоками
+    step = _tile_rows_for(n, tile_rows, workers)
+    timer.count('tileRows', step)
+    timer.count('tileWorkers', min(workers, -(-n // step)))
+
+    def run_tile(start, stop, bufs):
+        t0 = time.perf_counter()
+        _similarity_tile(blocks, slice(start, stop), weights, bufs)
+        t1 = time.perf_counter()
+        top_idx[start:stop], top_sim[start:stop] = _tile_topk(blocks, weights, k, start, stop,
+                                                              bufs['out'])
+        return t1 - t0, time.perf_counter() - t1
+
+    spent = _map_tiles(n, step, workers, lambda: _tile_buffers(step, n), run_tile)
+
+    # При нескольких потоках — суммарное время потоков, не wall-clock
+    timer.add('sim', sum(t for t, _ in spent))
+    timer.add('topk', sum(t for _, t in spent))
+    return top_idx, top_sim
+
+
+def _tile_topk(blocks, weights, k, start, stop, out, col_blocks=None):
+    """
+    top-k строк [start, stop) по их float32-тайлу out (rows × n): кандидаты —
+    все столбцы не ниже k-го значения строки минус SIM_TIE_EPS (float32
+    мог переставить почти равные sim), затем точные sim и порядок —
+    убывание sim, при равных — меньший индекс. Без col_blocks (тайл flows
+    против них же) диагональ тайла затирается.
+    """
+    n = out.shape[1]
+    rows = np.arange(start, stop)
+    if col_blocks is None:
+        # Сам с собой не сравниваем: -1, чтобы не попасть в top-k
+        out[rows - start, rows] = -1.0
+    # argpartition по n-k даёт k наибольших в хвосте строки
+    part = np.argpartition(out, n - k, axis=1)[:, n - k:]
+    threshold = np.take_along_axis(out, part, axis=1).min(axis=1) - np.float32(SIM_TIE_EPS)
+    wide = np.count_nonzero(out >= threshold[:, None], axis=1) > k
+
+    top_idx = np.empty((len(rows), k), dtype=np.int64)
+    top_sim = np.empty((len(rows), k), dtype=np.float64)
+    narrow = ~wide
+    top_idx[narrow], top_sim[narrow] = _exact_topk(
+        blocks, weights, k, rows[narrow], part[narrow], None, col_blocks)
+
+    # В запас попали ещё столбцы: кандидаты — все они, порциями строк,
+    # чтобы (строки × кандидаты × m_b) точных разностей влезали в SIM_TILE_BYTES
+    wide = np.flatnonzero(wide)
+    if wide.size:
+        r, c = np.nonzero(out[wide] >= threshold[wide, None])
+        per_row = np.bincount(r, minlength=wide.size)
+        chunk = max(1, SIM_TILE_BYTES // (int(per_row.max()) * (blocks['B'].shape[1] + 8) * 8))
+        first = np.cumsum(per_row) - per_row
+        for lo in range(0, wide.size, chunk):
+            hi = min(lo + chunk, wide.size)
+            sel = slice(first[lo], first[hi - 1] + per_row[hi - 1])
+            counts = per_row[lo:hi]
+            slot = np.arange(sel.stop - sel.start) - np.repeat(first[lo:hi] - first[lo], counts)
+            cand = np.zeros((hi - lo, int(counts.max())), dtype=np.int64)
+            valid = np.zeros(cand.shape, dtype=bool)
+            cand[r[sel] - lo, slot] = c[sel]
+            valid[r[sel] - lo, slot] = True
+            top_idx[wide[lo:hi]], top_sim[wide[lo:hi]] = _exact_topk(
+                blocks, weights, k, rows[wide[lo:hi]], cand, valid, col_blocks)
+    return top_idx, top_sim
+
+
+def _exact_topk(blocks, weights, k, rows, cand, valid, col_blocks=None):
+    """
+    Первые k кандидатов cand (rows × m) каждой строки по точным sim:
+    убывание sim, при равных — меньший индекс. valid — маска настоящих
+    кандидатов (None — все).
+    """
+    exact = _pair_similarity(blocks, weights, rows, cand, col_blocks)
+    if valid is not None:
+        exact[~valid] = -np.inf
+    order = np.lexsort((cand, -exact), axis=1)[:, :k]
+    return np.take_along_axis(cand, order, axis=1), np.take_along_axis(exact, order, axis=1)
+
+
+def _map_tiles(n, step, workers, make_buffers, run_tile, first_row=0):
+    """
+    run_tile(start, stop, bufs) по тайлам [start, stop) из step строк
+    (начиная с first_row) — в workers потоках (joblib поверх пула
+    inference_scheduler, BLAS на это время однопоточный). У каждого потока
+    свои буферы make_buffers(), обрезанные до числа строк тайла.
+    Результаты — в порядке тайлов.
+    """
+    tiles = [(start, min(start + step, n)) for start in range(first_row, n, step)]
+    workers = min(workers, len(tiles))
+
+    buffers = queue.SimpleQueue()
+    for _ in range(workers):
+        buffers.put(make_buffers())
+
+    def run(start, stop):
+        tile_bufs = buffers.get()
+        try:
+            return run_tile(start, stop, {name: buf[:stop - start] for name, buf in tile_bufs.items()})
+        finally:
+            buffers.put(tile_bufs)
+
+    if workers == 1:
+        return [run(start, stop) for start, stop in tiles]
+    with blas_serial():
+        return Parallel(n_jobs=workers, prefer='threads')(
+            delayed(run)(start, stop) for start, stop in tiles)
+
+
+def _sweep_confusion_tiled(blocks, weight_grid, k_values, labels, tile_rows=None,
+                           timer=NULL_TIMER):
+    """
+    Матрица ошибок kNN (tp, fp, fn, tn) для каждой тройки весов и k:
+    массив (len(weight_grid), len(k_values), 4).
+
+    Компоненты тайла (число совпавших A-полей, sim_b, число несовпавших
+    флагов C) считаются один раз. A и C дискретны: пар (совпадения A,
+    несовпадения C) не больше (m_a+1)·(m_c+1), и внутри такой группы при
+    любых неотрицательных весах порядок по sim — это порядок по sim_b.
+    Значит, top-k при любых весах лежит среди top-k_max каждой группы:
+    одна сортировка тайла по (группа, -sim_b, индекс) даёт не больше
+    54·k_max кандидатов на строку, и каждая тройка весов стоит проход по
+    ним вместо n. Сортируются не индексы, а упакованные uint64-ключи
+    (группа | квантованный 1 - sim_b | индекс) — np.sort по значениям в
+    разы быстрее argsort, а при равных sim порядок — по индексу.
+    """
+    A, B, C = blocks['A'], blocks['B'], blocks['C']
+    n = B.shape[0]
+    m_a, m_c = A.shape[1], len(BLOCK_C_FIELDS)
+    k_max = max(k_values)
+    n_groups = (m_a + 1) * (m_c + 1)
+    k_cols = np.array(k_values) - 1
+
+    # Раскладка ключа: [группа | q = (1 - sim_b)·q_scale | индекс колонки]
+    col_bits = max(1, (n - 1).bit_length())
+    q_bits = min(52, 64 - col_bits - n_groups.bit_length())
+    q_scale = float((1 << q_bits) - 1)
+    group_shift = np.uint64(q_bits + col_bits)
+    col_mask = np.uint64((1 << col_bits) - 1)
+    q_mask = np.uint64((1 << q_bits) - 1)
+    cols = np.arange(n, dtype=np.uint64)
+    # sim_a и sim_c каждой группы; последняя «группа» — пустой слот
+    group_a = np.append(np.repeat(np.arange(m_a + 1) / m_a, m_c + 1), 0.0)
+    group_c = np.append(np.tile((m_c - np.arange(m_c + 1)) / max(m_c, 1), m_a + 1), 0.0)
+
+    # Точки с w2 = 0: sim внутри группы одинаковы, и точный top-k — это
+    # меньшие индексы каждой группы, а не лучшие по sim_b. Для них второй
+    # набор кандидатов — первые k_max колонок каждой группы.
+    flat = any(w2 == 0 for _, w2, _ in weight_grid)
+    group_dtype = np.int8 if n_groups < 127 else np.int16
+    workers = max(1, min(current_budget() or 1, n))
+    step = _tile_rows_for(n, tile_rows, workers,
+                          _SWEEP_BYTES_PER_CELL + (_SWEEP_FLAT_BYTES_PER_CELL if flat else 0))
+    timer.count('tileRows', step)
+    timer.count('tileWorkers', min(workers, -(-n // step)))
+
+    def run_tile(start, stop, bufs):
+        rows = stop - start
+        work, count, mism = bufs['work'], bufs['count'], bufs['bytes']
+        diag = np.arange(rows)
+        t0 = time.perf_counter()
+
+        # --- компоненты тайла: один раз на все тройки весов ---
+        _tile_a_matches(A, slice(start, stop), count, bufs['mask'])
+        if m_c > 0:
+            _tile_c_mismatches(C, slice(start, stop), mism, bufs['mask'].view(np.uint8))
+        else:
+            mism.fill(0)
+        if B.shape[1] > 0:
+            _tile_b_similarity(blocks, slice(start, stop), work)
+        else:
+            work.fill(0.0)
+
+        # --- ключи и сортировка тайла ---
+        key = np.multiply(count, m_c + 1, dtype=np.uint64)
+        key += mism
+        key[diag, start + diag] = n_groups          # сам с собой — после всех групп
+        group = key.astype(group_dtype) if flat else None
+        key <<= group_shift
+        np.subtract(1.0, work, out=work)
+        work *= q_scale
+        quant = work.astype(np.uint64)
+        quant <<= np.uint64(col_bits)
+        key |= quant
+        del quant
+        key |= cols
+        key.sort(axis=1)
+        sorted_group = (key >> group_shift).astype(np.int16)
+
+        # --- кандидаты: первые k_max каждой группы по sim_b ---
+        # (r_idx, c_idx) — позиции в строках, отсортированных по группе
+        r_idx, c_idx = _group_heads(sorted_group, k_max, n_groups)
+        heads_group = sorted_group[r_idx, c_idx]
+        del sorted_group
+        packed = key[r_idx, c_idx]
+        del key
+        cand_cols = (packed & col_mask).astype(np.int64)
+        cand_b = 1.0 - ((packed >> np.uint64(col_bits)) & q_mask) / q_scale
+        candidates = {False: _candidate_matrix(r_idx, cand_cols, heads_group, cand_b,
+                                               rows, n, n_groups)}
+
+        # --- кандидаты точек w2 = 0: первые k_max каждой группы по индексу ---
+        # Стабильная сортировка по группе даёт те же границы групп, что и
+        # ключ выше, — позиции первых k_max в строке те же
+        if flat:
+            by_group = np.argsort(group, axis=1, kind='stable')   # radix sort
+            del group
+            candidates[True] = _candidate_matrix(r_idx, by_group[r_idx, c_idx], heads_group,
+                                                 None, rows, n, n_groups)
+            del by_group
+        t1 = time.perf_counter()
+
+        # --- каждая тройка весов: k_max лучших кандидатов и голоса ---
+        # w1·sim_a + w3·sim_c зависит только от группы — таблица на n_groups.
+        # В младшие биты мантиссы sim кладётся номер слота: np.sort по
+        # значениям (SIMD) вместо argpartition, слот top-k — из хвоста строки.
+        # Номер записан обратным (width-1-слот): при равных sim в хвост
+        # уходит меньший слот, то есть меньший индекс колонки.
+        truth = labels[start:stop, None]
+        confusion = np.zeros((len(weight_grid), len(k_values), 4), dtype=np.int64)
+        for w_idx, (w1, w2, w3) in enumerate(weight_grid):
+            cand, cand_group, cand_b = candidates[flat and w2 == 0]
+            width = cand.shape[1]
+            slot_bits = np.uint64(max(1, width.bit_length()))
+            slot_mask = (np.uint64(1) << slot_bits) - np.uint64(1)
+            group_sim = w1 * group_a + w3 * group_c
+            group_sim[n_groups] = -1.0               # sim >= 0: пустой слот — в начало
+            sim = group_sim[cand_group]
+            if cand_b is not None:
+                sim += cand_b * w2
+            sim_bits = sim.view(np.uint64)
+            sim_bits >>= slot_bits
+            sim_bits <<= slot_bits
+            sim_bits |= np.arange(width - 1, -1, -1, dtype=np.uint64)
+            sim.sort(axis=1)
+            top_slots = (width - 1) - (sim_bits[:, width - k_max:][:, ::-1] & slot_mask)
+            top = np.take_along_axis(cand, top_slots.astype(np.intp), axis=1)
+            votes = np.cumsum(labels[top], axis=1)[:, k_cols]
+            pred = 2 * votes > k_cols + 1          # attack_votes / k > 0.5
+            confusion[w_idx, :, 0] = (pred & truth).sum(axis=0)
+            confusion[w_idx, :, 1] = (pred & ~truth).sum(axis=0)
+            confusion[w_idx, :, 2] = (~pred & truth).sum(axis=0)
+            confusion[w_idx, :, 3] = (~pred & ~truth).sum(axis=0)
+        return confusion, t1 - t0, time.perf_counter() - t1
+
+    spent = _map_tiles(n, step, workers, lambda: _tile_buffers(step, n), run_tile)
+    timer.add('sim', sum(t for _, t, _ in spent))
+    timer.add('sweep', sum(t for _, _, t in spent))
+    return sum(c for c, _, _ in spent)
+
+
+def _group_heads(sorted_group, k_max, n_groups):
+    """
+    Позиции (строка, столбец) первых k_max элементов каждой группы в
+    строках sorted_group, отсортированных по группе (n_groups — пропуск).
+    """
+    rows, n = sorted_group.shape
+    is_start = np.empty((rows, n), dtype=bool)
+    is_start[:, 0] = True
+    np.not_equal(sorted_group[:, 1:], sorted_group[:, :-1], out=is_start[:, 1:])
+    is_start &= sorted_group < n_groups
+    start_r, start_c = np.nonzero(is_start)
+    r_idx = np.repeat(start_r, k_max)
+    c_idx = (start_c[:, None] + np.arange(k_max)).ravel()
+    in_group = c_idx < n
+    c_idx = np.minimum(c_idx, n - 1)
+    in_group &= sorted_group[r_idx, c_idx] == np.repeat(sorted_group[start_r, start_c], k_max)
+    return r_idx[in_group], c_idx[in_group]
+
+
+def _candidate_matrix(r_idx, cand_cols, cand_group, cand_b, rows, n, n_groups):
+    """
+    Кандидаты тайла по слотам строк: (cand, cand_group, cand_b) шириной
+    с самую длинную строку; пустой слот — группа n_groups. В строке
+    кандидаты по возрастанию индекса колонки — при равных sim побеждает
+    меньший индекс, как в knn_classify_flows. cand_b=None — без sim_b.
+    """
+    order = np.argsort(r_idx * n + cand_cols, kind='stable')
+    r_idx = r_idx[order]
+    per_row = np.bincount(r_idx, minlength=rows)
+    width = int(per_row.max())
+    slot = np.arange(len(order)) - np.repeat(np.cumsum(per_row) - per_row, per_row)
+    cand = np.zeros((rows, width), dtype=np.int64)
+    group = np.full((rows, width), n_groups, dtype=np.intp)
+    cand[r_idx, slot] = cand_cols[order]
+    group[r_idx, slot] = cand_group[order]
+    if cand_b is not None:
+        sim_b = np.zeros((rows, width))
+        sim_b[r_idx, slot] = cand_b[order]
+        cand_b = sim_b
+    return cand, group, cand_b
+
+
+def _similar_to_targets(flows, blocks, weights, target_ids, k, timer=NULL_TIMER):
+    """
+    top-k похожих для каждого target_id (без flows с тем же Id): список
+    результатов find_similar_flows на каждый target. Порядок — как у
+    сортировки по округлённому sim (при равенстве — порядок во flows):
+    из float32-тайла берутся все кандидаты не ниже k-го значения минус
+    SIM_TIE_EPS, их sim пересчитываются точно и сортируются.
+    """
+    w1, w2, w3 = weights
+    n = len(flows)
+    k = max(0, int(k))
+    positions = {}
+    for i, f in enumerate(flows):
+        positions.setdefault(f.get('Id'), []).append(i)
+    timer.count('targets', len(target_ids))
+
+    step = min(_tile_rows_for(n), max(1, len(target_ids)))
+    tile_bufs = _tile_buffers(step, n)
+
+    all_results = []
+    for chunk_start in range(0, len(target_ids), step):
+        chunk = target_ids[chunk_start:chunk_start + step]
+        rows = np.array([positions[tid][0] for tid in chunk], dtype=np.int64)
+        bufs = {name: buf[:len(chunk)] for name, buf in tile_bufs.items()}
+        out = bufs['out']
+        with timer.stage('sim'):
+            _similarity_tile(blocks, rows, weights, bufs)
+            for j, tid in enumerate(chunk):
+                out[j, positions[tid]] = -np.inf
+
+        with timer.stage('topk'):
+            for j, row in enumerate(rows):
+                sims = out[j]
+                n_valid = n - len(positions[chunk[j]])
+                take = min(k, n_valid)
+                if take == 0:
+                    all_results.append([])
+                    continue
+                kth = np.partition(sims, n - take)[n - take]
+                cand = np.flatnonzero(sims >= kth - SIM_TIE_EPS)
+                sim_a, sim_b, sim_c = (c[0] for c in _pair_components(blocks, row[None], cand[None, :]))
+                sim = w1 * sim_a + w2 * sim_b + w3 * sim_c
+                order = np.lexsort((cand, -np.round(sim, 4)))[:take]
+                all_results.append([
+                    _similar_result(flows[cand[o]], sim_a[o], sim_b[o], sim_c[o], sim[o])
+                    for o in order
+                ])
+    return all_results
+
+
+def _similar_result(flow, sim_a, sim_b, sim_c, sim):
+    return {
+        "flowId": flow.get('Id'),
+        "sourceIP": flow.get('SourceIP', ''),
+        "destinationIP": flow.get('DestinationIP', ''),
+        "sourcePort": flow.get('SourcePort', 0),
+        "destinationPort": flow.get('DestinationPort', 0),
+        "protocol": flow.get('Protocol', ''),
+        "isAttack": bool(flow.get('IsAttack', False)),
+        "threatLevel": flow.get('ThreatLevel', 'Low'),
+        "simA": round(float(sim_a), 4),
+        "simB": round(float(sim_b), 4),
+        "simC": round(float(sim_c), 4),
+        "sim": round(float(sim), 4),
+    }
 
 
 # ============================================================
@@ -315,55 +1006,37 @@ def _detect_numeric_fields(flows):
     return numeric
 
 
-def _zscore_normalize(flows, numeric_fields):
-    n = len(flows)
-    m = len(numeric_fields)
-    data = np.zeros((n, m), dtype=np.float64)
-
-    for i, flow in enumerate(flows):
-        for j, field in enumerate(numeric_fields):
-            v = flow.get(field, 0)
-            if v is None:
-                v = 0
-            try:
-                data[i, j] = float(v)
-            except (TypeError, ValueError):
-                data[i, j] = 0.0
-
-    data[~np.isfinite(data)] = 0.0
+def _zscore_normalize(flows, numeric_fields, data=None):
+    if data is None:
+        data = _numeric_matrix(flows, numeric_fields)
     means = data.mean(axis=0)
     stds = data.std(axis=0)
     stds[stds < 1e-9] = 1.0
     return (data - means) / stds
 
 
-def _block_a_similarity(target, other):
-    matches = 0
-    total = len(BLOCK_A_FIELDS)
-    for field in BLOCK_A_FIELDS:
-        if str(target.get(field, '')) == str(other.get(field, '')):
-            matches += 1
-    return matches / total if total > 0 else 0.0
-
-
-def _block_b_similarity_single(target_norm, other_norm):
-    if len(target_norm) == 0:
-        return 0.0
-    diff = target_norm - other_norm
-    d = np.sqrt(np.sum(diff * diff))
-    d_scaled = d / math.sqrt(len(target_norm))
-    return float(math.exp(-d_scaled))
-
-
-def _block_c_similarity(target, other):
-    matches = 0
-    total = len(BLOCK_C_FIELDS)
-    for field in BLOCK_C_FIELDS:
-        t = 1 if (target.get(field, 0) or 0) > 0 else 0
-        o = 1 if (other.get(field, 0) or 0) > 0 else 0
-        if t == o:
-            matches += 1
-    return matches / total if total > 0 else 0.0
+def _numeric_matrix(flows, numeric_fields):
+    """Сырые значения Block-B полей (n, m); None/нечисловое/inf -> 0."""
+    n = len(flows)
+    m = len(numeric_fields)
+    try:
+        # Быстрый путь: одна конвертация списка строк (None -> nan -> 0 ниже)
+        data = np.array([[flow.get(field, 0) for field in numeric_fields] for flow in flows],
+                        dtype=np.float64).reshape(n, m)
+    except (TypeError, ValueError):
+        data = np.zeros((n, m), dtype=np.float64)
+        for i, flow in enumerate(flows):
+            for j, field in enumerate(numeric_fields):
+                v = flow.get(field, 0)
+                if v is None:
+                    v = 0
+                try:
+                    data[i, j] = float(v)
+                except (TypeError, ValueError):
+                    data[i, j] = 0.0
+
+    data[~np.isfinite(data)] = 0.0
+    return data
 
 
 def _flow_summary(flow):
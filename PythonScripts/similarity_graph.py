@@ -0,0 +1,391 @@
+"""
+PythonScripts/similarity_graph.py
+
+Кластеризация flows по графу сходства — «кампании»: группы flows,
+попарно похожих по мере w1·Sim_A + w2·Sim_B + w3·Sim_C (similarity.py).
+clustering.py кластеризует источники по агрегированным метрикам;
+здесь единица — отдельный flow.
+
+Граф (scipy.sparse, без плотной n×n матрицы):
+  вершины — flows; ребро i–j, если j среди k ближайших соседей i (или
+  наоборот) и sim ≥ tau; вес ребра — sim. Соседи:
+    exact — тайловый движок similarity._knn_topk_tiled: точный top-k,
+            время O(n²), память O(tile_rows·n + n·k);
+    lsh   — кандидаты из окрестностей в нескольких сортировках flows:
+            по ключам random-projection LSH Block B (как в
+            similarity_index) и по (DestinationIP, DestinationPort,
+            Protocol); для каждого flow — LSH_WINDOW соседей по каждую
+            сторону в каждой сортировке, top-k по точной sim среди них.
+            O(n·log n + n·C), C — кандидатов на flow; для сотен тысяч flows.
+    auto  — exact до EXACT_GRAPH_ROWS flows, дальше lsh.
+
+Кластеры:
+  components — компоненты связности (scipy.sparse.csgraph);
+  louvain    — сообщества Louvain: локальные перемещения вершин по
+               приросту модулярности, затем свёртка сообществ в вершины
+               (S^T·W·S), пока модулярность растёт. Перемещения идут
+               пачками вершин одновременно (sparse-операции, без цикла
+               Python по вершинам): O(проходов·рёбер), на 200k flows
+               с k=10 — около 7 с против долей секунды у components.
+  Кластеры меньше min_cluster_size получают clusterId = -1 (шум).
+
+Ответ: clusterId каждого flow (в порядке flows_json) и по кластерам —
+размер, доля атак (метки labels_json или поле IsAttack), средний вес
+внутренних рёбер, частые источники и назначения.
+"""
+
+import json
+from collections import Counter
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from inference_scheduler import scheduled
+from profiling import make_timer, append_profile
+from similarity import (BLOCK_A_FIELDS, BLOCK_C_FIELDS, SIM_TILE_BYTES,
+                        _normalize_weights, _similarity_blocks, _knn_topk_tiled,
+                        _pair_similarity)
+from similarity_index import _lsh_keys, _akeys
+
+
+EXACT_GRAPH_ROWS = 20_000
+LSH_TABLES = 6
+LSH_PLANES = 16
+LSH_WINDOW = 8
+LOUVAIN_MAX_LEVELS = 10
+LOUVAIN_MAX_PASSES = 10
+LOUVAIN_BATCHES = 16
+LOUVAIN_BATCH_ROWS = 2048
+CLUSTER_METHODS = ('components', 'louvain')
+EDGE_MODES = ('auto', 'exact', 'lsh')
+
+
+@scheduled
+def cluster_flows(flows_json, w1, w2, w3, k=10, tau=0.75, method='louvain', edges='auto',
+                  labels_json=None, min_cluster_size=2, max_clusters=200, resolution=1.0,
+                  seed=0, tile_rows=None, profile=False, profile_top=0,
+                  session_id=None, session_version=None):
+    """
+    Кластеры flows по графу сходства (см. описание модуля).
+
+    k, tau — рёбра: k ближайших соседей каждого flow с sim ≥ tau.
+    method — 'components' или 'louvain' (resolution — параметр
+    модулярности, больше — мельче сообщества). edges — 'auto' / 'exact' /
+    'lsh'. labels_json {id: bool} — метки для доли атак (без него — поле
+    IsAttack flows). max_clusters — сколько крупнейших кластеров описать
+    подробно (clusterId есть у всех).
+    """
+    timer = make_timer(profile, profile_top)
+    flows = json.loads(flows_json)
+    labels_map = ({int(k_): bool(v) for k_, v in json.loads(labels_json).items()}
+                  if labels_json else None)
+    timer.lap('parse')
+
+    if method not in CLUSTER_METHODS:
+        return json.dumps({"error": f"Unknown method '{method}', expected one of "
+                                    f"{list(CLUSTER_METHODS)}", "clusters": []})
+    if edges not in EDGE_MODES:
+        return json.dumps({"error": f"Unknown edges '{edges}', expected one of "
+                                    f"{list(EDGE_MODES)}", "clusters": []})
+    if not flows or len(flows) < 2:
+        return json.dumps({"error": f"Need at least 2 flows, got {len(flows) if flows else 0}",
+                           "clusters": []})
+
+    weights = _normalize_weights(w1, w2, w3)
+    n = len(flows)
+    k = max(1, min(int(k), n - 1))
+    if edges == 'auto':
+        edges = 'exact' if n <= EXACT_GRAPH_ROWS else 'lsh'
+
+    blocks = _similarity_blocks(flows, timer, session_id, session_version)
+    timer.lap('blocks')
+
+    if edges == 'exact':
+        top_idx, top_sim = _knn_topk_tiled(blocks, weights, k, tile_rows, timer)
+        timer.lap()
+    else:
+        top_idx, top_sim = _lsh_topk(blocks, weights, k, seed, timer)
+    graph = _neighbour_graph(top_idx, top_sim, tau)
+    timer.lap('graph')
+    timer.count('edges', graph.nnz // 2)
+
+    if method == 'components':
+        _, labels_raw = connected_components(graph, directed=False)
+    else:
+        labels_raw = _louvain(graph, resolution, seed)
+    timer.lap('cluster')
+
+    if labels_map is not None:
+        attack = np.array([labels_map.get(f.get('Id'), False) for f in flows], dtype=bool)
+    else:
+        attack = np.array([bool(f.get('IsAttack', False)) for f in flows], dtype=bool)
+    cluster_ids = _renumber_by_size(labels_raw, min_cluster_size)
+    clusters = _describe_clusters(flows, cluster_ids, attack, graph, max_clusters)
+    timer.lap('format')
+
+    n_clusters = int(cluster_ids.max()) + 1 if n else 0
+    clustered = cluster_ids >= 0
+    out = json.dumps({
+        "totalFlows": n,
+        "method": method,
+        "edgeMode": edges,
+        "edges": int(graph.nnz // 2),
+        "k": k,
+        "tau": tau,
+        "weights": {"w1": round(weights[0], 4), "w2": round(weights[1], 4),
+                    "w3": round(weights[2], 4)},
+        "modularity": round(_modularity(graph, labels_raw, resolution), 4),
+        "clusterCount": n_clusters,
+        "clusteredFlows": int(clustered.sum()),
+        "noiseFlows": int((~clustered).sum()),
+        "attackFlows": int(attack.sum()),
+        "clusters": clusters,
+        "clusterIds": cluster_ids.tolist(),
+        "flowIds": [f.get('Id') for f in flows],
+        "blocks": {
+            "A": BLOCK_A_FIELDS,
+            "B": blocks['numeric_fields'],
+            "C": BLOCK_C_FIELDS,
+        },
+    })
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
+
+
+# ============================================================
+# РЁБРА
+# ============================================================
+
+def _lsh_topk(blocks, weights, k, seed, timer):
+    """
+    Приближённый top-k: кандидаты — соседи по позиции в сортировках по
+    ключам LSH и по A-ключу, ранжирование — точной sim. (idx (n, k),
+    sim (n, k)); если кандидатов меньше k, в хвосте sim = -inf
+    (отсекается tau).
+    """
+    n, m_b = blocks['B'].shape
+    akeys = _akeys(np.asarray(blocks['A']))
+    orders = []
+    if m_b > 0:
+        rng = np.random.default_rng(seed)
+        Z = np.asarray(blocks['B'], dtype=np.float32)
+        planes = rng.standard_normal((LSH_TABLES, m_b, LSH_PLANES)).astype(np.float32)
+        keys = _lsh_keys(Z, planes)
+        # Внутри бакета — по случайной проекции, своей в каждой таблице:
+        # иначе равные ключи идут по номеру строки и окна таблиц совпадают
+        proj = Z @ rng.standard_normal((m_b, LSH_TABLES + 1)).astype(np.float32)
+        orders.extend(np.lexsort((proj[:, t], keys[t])) for t in range(LSH_TABLES))
+        orders.append(np.lexsort((proj[:, LSH_TABLES], akeys)))
+    else:
+        orders.append(np.argsort(akeys, kind='stable'))
+
+    offsets = np.concatenate([np.arange(-LSH_WINDOW, 0), np.arange(1, LSH_WINDOW + 1)])
+    cands = np.empty((n, len(orders) * len(offsets)), dtype=np.int64)
+    for o_idx, order in enumerate(orders):
+        pos = np.empty(n, dtype=np.int64)
+        pos[order] = np.arange(n)
+        shifted = np.clip(pos[:, None] + offsets[None, :], 0, n - 1)
+        cands[:, o_idx * len(offsets):(o_idx + 1) * len(offsets)] = order[shifted]
+    # Повторы кандидата в строке и сама строка — не кандидаты
+    cands.sort(axis=1)
+    invalid = np.zeros(cands.shape, dtype=bool)
+    invalid[:, 1:] = cands[:, 1:] == cands[:, :-1]
+    invalid |= cands == np.arange(n)[:, None]
+    timer.lap('candidates')
+    timer.count('candidatesPerRow', cands.shape[1])
+
+    m = cands.shape[1]
+    k = min(k, m)
+    top_idx = np.empty((n, k), dtype=np.int64)
+    top_sim = np.empty((n, k), dtype=np.float64)
+    # _pair_components держит (rows, m, m_b) float64 разностей Block B
+    chunk = max(1, SIM_TILE_BYTES // (m * (blocks['B'].shape[1] + 8) * 8))
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        sim = _pair_similarity(blocks, weights, np.arange(start, stop), cands[start:stop])
+        sim[invalid[start:stop]] = -np.inf
+        # Тот же порядок, что у _knn_topk_tiled: убывание sim, при равных — меньший индекс
+        order = np.lexsort((cands[start:stop], -sim), axis=1)[:, :k]
+        top_idx[start:stop] = np.take_along_axis(cands[start:stop], order, axis=1)
+        top_sim[start:stop] = np.take_along_axis(sim, order, axis=1)
+    timer.lap('sim')
+    return top_idx, top_sim
+
+
+def _neighbour_graph(top_idx, top_sim, tau):
+    """Симметричный CSR: ребро i–j, если j в top-k i или i в top-k j, и sim ≥ tau."""
+    n, k = top_idx.shape
+    rows = np.repeat(np.arange(n), k)
+    cols = top_idx.ravel()
+    sims = top_sim.ravel()
+    keep = (sims >= tau) & (cols != rows)
+    graph = sp.coo_matrix((sims[keep], (rows[keep], cols[keep])), shape=(n, n)).tocsr()
+    # sim симметрична — у пары, найденной с обеих сторон, вес тот же
+    return graph.maximum(graph.T).tocsr()
+
+
+# ============================================================
+# LOUVAIN
+# ============================================================
+
+def _louvain(graph, resolution=1.0, seed=0):
+    """
+    Сообщества Louvain на симметричном взвешенном графе: номер
+    сообщества каждой вершины. Уровень — проходы локальных перемещений
+    (вершина уходит в соседнее сообщество с наибольшим приростом
+    модулярности), затем сообщества сворачиваются в вершины нового графа.
+    """
+    rng = np.random.default_rng(seed)
+    n = graph.shape[0]
+    membership = np.arange(n)
+    W = graph.tocsr().astype(np.float64)
+    if W.sum() <= 0:
+        return membership
+
+    for _ in range(LOUVAIN_MAX_LEVELS):
+        comm, moved = _louvain_level(W, resolution, rng)
+        if not moved:
+            break
+        _, comm = np.unique(comm, return_inverse=True)
+        membership = comm[membership]
+        S = sp.csr_matrix((np.ones(len(comm)), (np.arange(len(comm)), comm)))
+        W = (S.T @ W @ S).tocsr()
+    return membership
+
+
+def _louvain_level(W, resolution, rng):
+    """
+    Локальные перемещения до стабилизации. Возвращает (сообщества, были ли перемещения).
+
+    Проход — случайная перестановка вершин, разбитая на пачки по
+    LOUVAIN_BATCH_ROWS (не меньше LOUVAIN_BATCHES пачек): вершины пачки
+    выбирают сообщество одновременно по состоянию после предыдущей пачки
+    (_louvain_moves, sparse-операции без цикла по вершинам).
+    """
+    n = W.shape[0]
+    two_m = W.sum()
+    degree = np.asarray(W.sum(axis=1)).ravel()
+    # петля вершины не тянет её ни в одно сообщество — в связях её нет
+    links = (W - sp.diags(W.diagonal())).tocsr()
+    links.eliminate_zeros()
+    comm = np.arange(n)
+    tot = degree.copy()            # сумма степеней сообщества
+    scale = resolution / two_m
+    n_batches = min(n, max(LOUVAIN_BATCHES, -(-n // LOUVAIN_BATCH_ROWS)))
+    moved_any = False
+
+    for _ in range(LOUVAIN_MAX_PASSES):
+        moves = 0
+        for batch in np.array_split(rng.permutation(n), n_batches):
+            moves += _louvain_moves(links, batch, comm, tot, degree, scale)
+        if moves == 0:
+            break
+        moved_any = True
+    return comm, moved_any
+
+
+def _louvain_moves(links, batch, comm, tot, degree, scale):
+    """
+    Одновременное перемещение вершин batch в соседнее сообщество с
+    наибольшим приростом модулярности; comm и tot обновляются на месте.
+    Возвращает число перемещённых вершин.
+    """
+    sub = links[batch]
+    rows = np.repeat(np.arange(len(batch)), np.diff(sub.indptr))
+    # вес связей вершина -> сообщество (дубликаты по сообществу суммируются)
+    to_comm = sp.csr_matrix((sub.data, (rows, comm[sub.indices])),
+                            shape=(len(batch), len(tot)))
+    to_comm.sum_duplicates()
+    counts = np.diff(to_comm.indptr)
+    nonempty = np.flatnonzero(counts)
+    if not len(nonempty):
+        return 0
+    rows = np.repeat(np.arange(len(batch)), counts)
+    cand = to_comm.indices
+    k_i = degree[batch]
+    own = comm[batch]
+    # своё сообщество считается без самой вершины
+    is_own = cand == own[rows]
+    tot_c = tot[cand] - np.where(is_own, k_i[rows], 0.0)
+    gain = to_comm.data - scale * tot_c * k_i[rows]
+    stay = -scale * (tot[own] - k_i) * k_i
+    stay[rows[is_own]] = gain[is_own]
+
+    best_gain = np.maximum.reduceat(gain, to_comm.indptr[nonempty])
+    hit = np.flatnonzero(gain == np.repeat(best_gain, counts[nonempty]))
+    first = hit[np.r_[True, rows[hit][1:] != rows[hit][:-1]]]
+    move = best_gain > stay[nonempty]
+    if not move.any():
+        return 0
+    vertices = batch[nonempty[move]]
+    target = cand[first[move]]
+    np.subtract.at(tot, comm[vertices], degree[vertices])
+    np.add.at(tot, target, degree[vertices])
+    comm[vertices] = target
+    return len(vertices)
+
+
+def _modularity(graph, labels, resolution=1.0):
+    two_m = graph.sum()
+    if two_m <= 0:
+        return 0.0
+    coo = graph.tocoo()
+    internal = coo.data[labels[coo.row] == labels[coo.col]].sum()
+    degree = np.asarray(graph.sum(axis=1)).ravel()
+    comm_degree = np.bincount(labels, weights=degree)
+    return float(internal / two_m - resolution * ((comm_degree / two_m) ** 2).sum())
+
+
+# ============================================================
+# ОПИСАНИЕ КЛАСТЕРОВ
+# ============================================================
+
+def _renumber_by_size(labels, min_cluster_size):
+    """Кластеры по убыванию размера -> 0, 1, ...; меньше min_cluster_size -> -1."""
+    _, inverse, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.lexsort((np.arange(len(sizes)), -sizes))
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[order] = np.arange(len(sizes))
+    rank[sizes < min_cluster_size] = -1
+    return rank[inverse]
+
+
+def _describe_clusters(flows, cluster_ids, attack, graph, max_clusters):
+    """Размер, доля атак и средний вес внутренних рёбер max_clusters крупнейших кластеров."""
+    clustered = cluster_ids >= 0
+    if not clustered.any():
+        return []
+    n_clusters = int(cluster_ids.max()) + 1
+    sizes = np.bincount(cluster_ids[clustered], minlength=n_clusters)
+    attacks = np.bincount(cluster_ids[clustered], weights=attack[clustered],
+                          minlength=n_clusters)
+
+    coo = graph.tocoo()
+    same = (cluster_ids[coo.row] == cluster_ids[coo.col]) & (cluster_ids[coo.row] >= 0)
+    edge_sum = np.bincount(cluster_ids[coo.row[same]], weights=coo.data[same],
+                           minlength=n_clusters)
+    edge_cnt = np.bincount(cluster_ids[coo.row[same]], minlength=n_clusters)
+
+    shown = min(n_clusters, max_clusters)
+    members = [[] for _ in range(shown)]
+    for i in np.flatnonzero((cluster_ids >= 0) & (cluster_ids < shown)).tolist():
+        members[cluster_ids[i]].append(i)
+
+    clusters = []
+    for c in range(shown):
+        rows = members[c]
+        sources = Counter(flows[i].get('SourceIP', '') for i in rows)
+        targets = Counter(f"{flows[i].get('DestinationIP', '')}:{flows[i].get('DestinationPort', 0)}"
+                          f"/{flows[i].get('Protocol', '')}" for i in rows)
+        clusters.append({
+            "clusterId": c,
+            "size": int(sizes[c]),
+            "attackFlows": int(attacks[c]),
+            "attackRatio": round(float(attacks[c] / sizes[c]), 4),
+            "avgEdgeSim": round(float(edge_sum[c] / edge_cnt[c]), 4) if edge_cnt[c] else None,
+            "topSources": [{"ip": ip, "flows": cnt} for ip, cnt in sources.most_common(3)],
+            "topDestinations": [{"target": t, "flows": cnt} for t, cnt in targets.most_common(3)],
+            "sampleFlowIds": [flows[i].get('Id') for i in rows[:10]],
+        })
+    return clusters
@@ -0,0 +1,400 @@
+"""
+PythonScripts/similarity_incremental.py
+
+Инкрементальный kNN (как similarity.knn_classify_flows) для сессии, в
+которую дописываются flows: живой захват, догрузка pcap по частям.
+
+Зачем:
+  knn_classify_flows на каждый вызов считает все n² пар. После того как
+  в сессию из n flows добавилось Δn, это снова O(n²), хотя изменились
+  только пары с новыми flows.
+
+Состояние сессии (в памяти процесса, последние MAX_SESSIONS сессий):
+  блоки A/B/C, сырые значения Block B и z-score статистики, по которым
+  нормализован B (заморожены до полного пересчёта), словари кодов
+  Block A, top-k соседей каждой строки (idx/sim, точные) и метки.
+
+Добавление Δn flows (flows с уже известными Id пропускаются, поэтому
+можно передавать и только новую порцию, и всю сессию целиком):
+  1. новые строки кодируются замороженными статистиками и словарями;
+  2. тайлы «новые строки × все n» — O(Δn·n) — дают top-k новых строк, а
+     их столбцы (sim симметрична) — кандидатов в top-k старых строк;
+  3. кандидаты, которые могут войти в top-k (float32 sim не ниже k-го
+     соседа минус SIM_TIE_EPS), сливаются с top-k старых строк по точным
+     sim с тем же порядком, что и в knn_classify_flows (убывание sim, при
+     равных — меньший индекс);
+  4. в ответе — предсказания только изменившихся строк: новых, строк с
+     новым набором соседей и строк, у соседей которых сменилась метка.
+
+Дрейф: по накопленным суммам (относительно замороженного среднего)
+считаются текущие среднее и σ каждого поля Block B. Если среднее
+сдвинулось больше чем на DRIFT_THRESHOLD·σ или σ изменилась больше чем
+в 1 ± DRIFT_THRESHOLD раз — полный пересчёт: новые статистики, B заново,
+_knn_topk_tiled по всем строкам. Полный пересчёт и при первом вызове,
+смене весов или k и по refresh=True.
+
+Между пересчётами результат совпадает с knn_classify_flows над теми же
+flows с замороженными z-score статистиками, сразу после пересчёта — с
+knn_classify_flows. Оговорка: sim новых пар считается по другим
+слагаемым (другой порядок float-операций), поэтому среди соседей, чьи
+sim на границе k-го места совпадают до ~1e-12, выбор может отличаться —
+на предсказание это почти никогда не влияет. Поле drift в ответе после
+полного пересчёта считается по новым статистикам (≈0); дрейф, который
+вызвал пересчёт, — в driftBeforeRefresh.
+
+Состояние живёт в процессе и теряется при перезапуске или вытеснении
+из LRU. inference_server шлёт вызовы одной сессии всегда в один и тот
+же воркер. Вызов с is_delta=True без состояния возвращает ошибку
+sessionStateMissing — тогда нужно прислать всю сессию (is_delta=False):
+пересчёт по одной новой порции дал бы kNN только внутри неё.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from inference_scheduler import scheduled, current_budget
+from profiling import make_timer, append_profile
+from similarity import (BLOCK_A_FIELDS, BLOCK_C_FIELDS, SIM_TIE_EPS,
+                        _detect_numeric_fields, _numeric_matrix, _factorize_a, _pack_c,
+                        _normalize_weights, _knn_topk_tiled, _map_tiles, _tile_buffers,
+                        _tile_rows_for, _similarity_tile, _tile_topk, _pair_similarity,
+                        _knn_prediction)
+
+
+DRIFT_THRESHOLD = 0.1
+MAX_SESSIONS = 8
+
+# Поля flow, нужные для predictions (сами flows в состоянии не хранятся)
+_PREDICTION_FIELDS = ('Id', 'SourceIP', 'DestinationIP', 'DestinationPort', 'Protocol')
+
+_SESSIONS: 'OrderedDict[str, dict]' = OrderedDict()
+_LOCK = threading.Lock()
+
+
+@scheduled
+def knn_classify_incremental(flows_json, labels_json, w1, w2, w3, k=5, session_id=None,
+                             refresh=False, is_delta=False, profile=False, profile_top=0,
+                             tile_rows=None):
+    """
+    kNN-классификация сессии session_id с дозаписью flows.
+
+    flows_json — новые flows сессии (или вся сессия: известные Id
+    пропускаются), labels_json — {id: bool} для новых flows; метки уже
+    известных flows из labels_json заменяют сохранённые. Ответ — как у
+    knn_classify_flows, но predictions только для изменившихся строк, плюс
+    mode ('incremental' / 'full'), refreshReason, newFlows, changedFlows,
+    drift (после пересчёта — относительно новых статистик, т.е. ~0) и
+    driftBeforeRefresh (дрейф, вызвавший пересчёт, при refreshReason
+    'drift'). Сводные метрики (knnAttackFlows, agreementWithOriginal) — по
+    всем flows сессии.
+
+    is_delta=True — flows_json содержит только новую порцию. Если
+    состояния сессии в процессе нет (перезапуск, вытеснение из LRU,
+    другой воркер), считать по одной порции нельзя: ответ — ошибка
+    sessionStateMissing, вызывающий должен прислать всю сессию.
+    """
+    timer = make_timer(profile, profile_top)
+    flows = json.loads(flows_json)
+    labels_map = {int(k_): bool(v) for k_, v in json.loads(labels_json).items()}
+    timer.lap('parse')
+
+    if session_id is None:
+        return json.dumps({"error": "session_id is required", "predictions": []})
+    weights = _normalize_weights(w1, w2, w3)
+    k = int(k)
+
+    entry = _session_entry(session_id)
+    with entry['lock']:
+        state = entry['state']
+        if state is None and is_delta:
+            return json.dumps({"error": "sessionStateMissing",
+                               "sessionStateMissing": True, "predictions": []})
+        known = state['pos'] if state is not None else {}
+        new_flows, seen = [], set()
+        for flow in flows:
+            fid = flow.get('Id')
+            if fid not in known and fid not in seen:
+                seen.add(fid)
+                new_flows.append(flow)
+        n_old = len(known)
+        n = n_old + len(new_flows)
+        if n < k + 1:
+            return json.dumps({"error": f"Need at least {k+1} flows, got {n}",
+                               "predictions": []})
+
+        if state is None:
+            state = _new_state(new_flows)
+            entry['state'] = state
+        _append_rows(state, new_flows, labels_map)
+        relabeled = _apply_labels(state, labels_map, n_old)
+        drift = _stat_drift(state)
+        timer.lap('append')
+        timer.count('rows', n)
+        timer.count('newRows', n - n_old)
+
+        reason = _refresh_reason(state, n_old, weights, k, drift, refresh)
+        if reason is not None:
+            _full_refresh(state, weights, k, tile_rows, timer)
+            changed = np.arange(n)
+            # Статистики пересчитаны: дрейф относительно новых (~0), а не
+            # заглушек нового состояния или старых статистик
+            drift_before = drift if reason == 'drift' else None
+            drift = _stat_drift(state)
+        else:
+            drift_before = None
+            changed = _append_neighbors(state, n_old, tile_rows, timer)
+            if relabeled.size:
+                # Сменилась метка: у самой строки — originalLabel, у тех,
+                # кто её сосед, — голосование
+                changed = np.union1d(changed, relabeled)
+                changed = np.union1d(changed, np.flatnonzero(
+                    np.isin(state['top_idx'], relabeled).any(axis=1)))
+        timer.lap()
+        timer.count('changedRows', len(changed))
+
+        result = _format_result(state, changed, reason, n - n_old, drift, drift_before)
+    timer.lap('format')
+
+    out = json.dumps(result)
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
+
+
+def reset_session(session_id):
+    """Забывает состояние сессии (например, после пересчёта её flows)."""
+    with _LOCK:
+        _SESSIONS.pop(str(session_id), None)
+
+
+def _session_entry(session_id):
+    """Запись сессии в LRU; свой lock — дозаписи одной сессии идут по очереди."""
+    key = str(session_id)
+    with _LOCK:
+        entry = _SESSIONS.get(key)
+        if entry is None:
+            entry = _SESSIONS[key] = {'lock': threading.Lock(), 'state': None}
+        _SESSIONS.move_to_end(key)
+        while len(_SESSIONS) > MAX_SESSIONS:
+            _SESSIONS.popitem(last=False)
+        return entry
+
+
+def _new_state(flows):
+    numeric_fields = _detect_numeric_fields(flows)
+    m_b = len(numeric_fields)
+    return {
+        'numeric_fields': numeric_fields,
+        'vocabs': [{} for _ in BLOCK_A_FIELDS],
+        'pos': {},
+        'meta': [],
+        'labels': np.zeros(0, dtype=bool),
+        'raw': np.zeros((0, m_b), dtype=np.float64),
+        # Замороженные статистики и суммы отклонений от замороженного среднего
+        'mean': np.zeros(m_b), 'std': np.ones(m_b),
+        'dev_sum': np.zeros(m_b), 'dev_sq': np.zeros(m_b),
+        'blocks': {
+            'numeric_fields': numeric_fields,
+            'A': np.zeros((0, len(BLOCK_A_FIELDS)), dtype=np.int32, order='F'),
+            'B': np.zeros((0, m_b), dtype=np.float64),
+            'B_sq': np.zeros(0, dtype=np.float64),
+            'C': np.zeros((0, -(-len(BLOCK_C_FIELDS) // 8)), dtype=np.uint8, order='F'),
+        },
+        'top_idx': None, 'top_sim': None, 'weights': None, 'k': None,
+    }
+
+
+def _append_rows(state, flows, labels_map):
+    """Кодирует новые flows замороженными статистиками и дописывает в блоки."""
+    blocks = state['blocks']
+    raw = _numeric_matrix(flows, state['numeric_fields'])
+    B = (raw - state['mean']) / state['std']
+    dev = raw - state['mean']
+
+    state['raw'] = np.concatenate([state['raw'], raw])
+    state['dev_sum'] += dev.sum(axis=0)
+    state['dev_sq'] += (dev * dev).sum(axis=0)
+    blocks['A'] = np.asfortranarray(np.concatenate(
+        [blocks['A'], _factorize_a(flows, state['vocabs'])]))
+    blocks['B'] = np.concatenate([blocks['B'], B])
+    blocks['B_sq'] = np.concatenate([blocks['B_sq'], (B * B).sum(axis=1)])
+    blocks['C'] = np.asfortranarray(np.concatenate([blocks['C'], _pack_c(flows)]))
+
+    start = len(state['meta'])
+    for offset, flow in enumerate(flows):
+        state['pos'][flow.get('Id')] = start + offset
+        state['meta'].append({field: flow.get(field) for field in _PREDICTION_FIELDS
+                              if field in flow})
+    state['labels'] = np.concatenate([
+        state['labels'],
+        np.array([labels_map.get(flow.get('Id'), False) for flow in flows], dtype=bool)])
+
+
+def _apply_labels(state, labels_map, n_old):
+    """Новые метки уже известных flows; возвращает номера строк, где метка сменилась."""
+    rows = [(state['pos'][fid], label) for fid, label in labels_map.items()
+            if state['pos'].get(fid, n_old) < n_old]
+    relabeled = np.array([row for row, label in rows if state['labels'][row] != label],
+                         dtype=np.int64)
+    for row, label in rows:
+        state['labels'][row] = label
+    return relabeled
+
+
+def _stat_drift(state):
+    """
+    Наибольший сдвиг z-score статистик всех flows относительно
+    замороженных: max(|Δmean| / σ, |σ_now / σ - 1|) по полям Block B.
+    """
+    n = state['raw'].shape[0]
+    if n == 0 or state['raw'].shape[1] == 0:
+        return 0.0
+    shift = state['dev_sum'] / n
+    std_now = np.sqrt(np.maximum(state['dev_sq'] / n - shift * shift, 0))
+    std_now[std_now < 1e-9] = 1.0
+    return float(max(np.abs(shift / state['std']).max(),
+                     np.abs(std_now / state['std'] - 1.0).max()))
+
+
+def _refresh_reason(state, n_old, weights, k, drift, refresh):
+    if state['top_idx'] is None or n_old < k + 1:
+        return 'initial'
+    if refresh:
+        return 'requested'
+    if state['weights'] != weights or state['k'] != k:
+        return 'parameters'
+    if drift > DRIFT_THRESHOLD:
+        return 'drift'
+    return None
+
+
+def _full_refresh(state, weights, k, tile_rows, timer):
+    """Новые z-score статистики по всем строкам и top-k заново (как knn_classify_flows)."""
+    raw, blocks = state['raw'], state['blocks']
+    means = raw.mean(axis=0)
+    stds = raw.std(axis=0)
+    stds[stds < 1e-9] = 1.0
+    B = (raw - means) / stds
+    dev = raw - means
+    state.update(mean=means, std=stds, dev_sum=dev.sum(axis=0), dev_sq=(dev * dev).sum(axis=0))
+    blocks['B'] = B
+    blocks['B_sq'] = (B * B).sum(axis=1)
+    timer.lap('normalize')
+
+    state['top_idx'], state['top_sim'] = _knn_topk_tiled(blocks, weights, k, tile_rows, timer)
+    state['weights'], state['k'] = weights, k
+
+
+def _append_neighbors(state, n_old, tile_rows, timer):
+    """
+    Тайлы строк [n_old, n) против всех n: top-k новых строк и слияние
+    кандидатов в top-k старых. Возвращает номера изменившихся строк.
+    """
+    blocks, weights, k = state['blocks'], state['weights'], state['k']
+    n = blocks['B'].shape[0]
+    if n == n_old:
+        return np.zeros(0, dtype=np.int64)
+    top_idx, top_sim = state['top_idx'], state['top_sim']
+    new_idx = np.zeros((n - n_old, k), dtype=np.int64)
+    new_sim = np.zeros((n - n_old, k), dtype=np.float64)
+    # Старая строка примет нового соседа, только если его sim не ниже её k-го
+    threshold = (top_sim[:, -1] - SIM_TIE_EPS).astype(np.float32)
+
+    workers = max(1, min(current_budget() or 1, n - n_old))
+    step = min(_tile_rows_for(n, tile_rows, workers), n - n_old)
+    timer.count('tileRows', step)
+
+    def run_tile(start, stop, bufs):
+        out = bufs['out']
+        _similarity_tile(blocks, slice(start, stop), weights, bufs)
+        # Столбцы старых строк — до _tile_topk, который затирает диагональ
+        cols = out[:, :n_old]
+        hit = np.flatnonzero((cols >= threshold).any(axis=0))
+        # Кандидаты старой строки из тайла: не ниже её порога и kk-го
+        # значения столбца минус SIM_TIE_EPS (как в _tile_topk)
+        kk = min(k, stop - start)
+        sub = cols[:, hit]
+        kth = np.partition(sub, stop - start - kk, axis=0)[stop - start - kk]
+        floor = np.maximum(threshold[hit], kth - np.float32(SIM_TIE_EPS))
+        cand_row, cand_col = np.nonzero(sub >= floor)
+        new_idx[start - n_old:stop - n_old], new_sim[start - n_old:stop - n_old] = \
+            _tile_topk(blocks, weights, k, start, stop, out)
+        return hit[cand_col], start + cand_row
+
+    parts = _map_tiles(n, step, workers, lambda: _tile_buffers(step, n), run_tile,
+                       first_row=n_old)
+    timer.lap('neighbors')
+
+    rows = np.concatenate([r for r, _ in parts])
+    cands = np.concatenate([c for _, c in parts])
+    changed = _merge_candidates(blocks, weights, top_idx, top_sim, rows, cands, k)
+    state['top_idx'] = np.concatenate([top_idx, new_idx])
+    state['top_sim'] = np.concatenate([top_sim, new_sim])
+    timer.lap('merge')
+    timer.count('mergedRows', len(np.unique(rows)))
+    return np.concatenate([changed, np.arange(n_old, n)])
+
+
+def _merge_candidates(blocks, weights, top_idx, top_sim, rows, cands, k):
+    """
+    Сливает пары (строка, кандидат) с top-k строк на месте: точные sim
+    кандидатов, сортировка по (строка, -sim, индекс), первые k в каждой
+    строке. Возвращает строки, у которых сменился набор соседей.
+    """
+    if rows.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    cand_sim = _pair_similarity(blocks, weights, rows, cands[:, None])[:, 0]
+    affected = np.unique(rows)
+
+    row = np.concatenate([np.repeat(affected, k), rows])
+    nbr = np.concatenate([top_idx[affected].ravel(), cands])
+    sim = np.concatenate([top_sim[affected].ravel(), cand_sim])
+    order = np.lexsort((nbr, -sim, row))
+    row, nbr, sim = row[order], nbr[order], sim[order]
+
+    # Ранг пары внутри своей строки; в каждой строке не меньше k пар
+    first = np.searchsorted(row, affected)
+    rank = np.arange(len(row)) - np.repeat(first, np.diff(np.append(first, len(row))))
+    keep = rank < k
+    merged_idx = nbr[keep].reshape(-1, k)
+    merged_sim = sim[keep].reshape(-1, k)
+
+    changed = (merged_idx != top_idx[affected]).any(axis=1)
+    top_idx[affected] = merged_idx
+    top_sim[affected] = merged_sim
+    return affected[changed]
+
+
+def _format_result(state, changed, reason, new_rows, drift, drift_before=None):
+    top_idx, top_sim, labels, k = state['top_idx'], state['top_sim'], state['labels'], state['k']
+    meta = state['meta']
+    flow_ids = [m.get('Id') for m in meta]
+    n = len(meta)
+
+    knn_is_attack = labels[top_idx].sum(axis=1) / k > 0.5
+    predictions = [_knn_prediction(meta[i], flow_ids, labels, top_idx[i], top_sim[i],
+                                   k, labels[i])
+                   for i in changed]
+    w1, w2, w3 = state['weights']
+    return {
+        "mode": 'incremental' if reason is None else 'full',
+        "refreshReason": reason,
+        "totalFlows": n,
+        "newFlows": new_rows,
+        "changedFlows": len(predictions),
+        "drift": round(drift, 4),
+        "driftBeforeRefresh": round(drift_before, 4) if drift_before is not None else None,
+        "knnAttackFlows": int(knn_is_attack.sum()),
+        "originalAttackFlows": int(labels.sum()),
+        "agreementWithOriginal": round(float((knn_is_attack == labels).mean()), 4),
+        "weights": {"w1": round(w1, 4), "w2": round(w2, 4), "w3": round(w3, 4)},
+        "k": k,
+        "blocks": {
+            "A": BLOCK_A_FIELDS,
+            "B": state['numeric_fields'],
+            "C": BLOCK_C_FIELDS,
+        },
+        "predictions": predictions,
+    }
@@ -0,0 +1,624 @@
+"""
+PythonScripts/similarity_index.py
+
+Персистентный индекс сходства по ВСЕМ историческим flows — поиск
+похожих за пределами текущей сессии (find_similar_flows видит только
+flows, переданные в вызов, и перебирает их циклом).
+
+Что хранится (каталог индекса, по умолчанию models/similarity_index):
+  meta.json   — поля Block B, замороженные mean/std для z-score, параметры
+                LSH, список сегментов и какой сегмент актуален для сессии;
+  planes.npy  — случайные гиперплоскости LSH (n_tables, m_b, n_planes);
+  vocab.json  — словари Block A: значение -> код (код = позиция в списке);
+  seg_XXXXXX/ — сегмент (одна добавленная сессия или результат compact()):
+      B.npy        float32 (r, m_b)  z-score признаки
+      A.npy        int32   (r, 5)    коды Block A
+      C.npy        uint8   (r,)      8 TCP-флагов, упакованных в байт
+      ids.npy, sessions.npy int64, attack.npy / threat.npy int8
+      lsh_keys.npy uint32 (T, r) + lsh_rows.npy int32 (T, r) — по каждой
+                   таблице ключи отсортированы, поиск бакета — searchsorted
+      akey_keys.npy uint64 + akey_rows.npy int32 — точный ключ
+                   (DestinationIP, DestinationPort, Protocol)
+  Все массивы открываются через np.load(mmap_mode='r'): в память попадают
+  только страницы, которых коснулся запрос.
+
+Запрос:
+  1. Кандидаты: LSH по Block B (random projection, бакет запроса + бакеты
+     на расстоянии 1 бит в каждой таблице) ∪ flows с тем же
+     (DestinationIP, DestinationPort, Protocol). Если кандидатов больше
+     max_candidates — берутся совпавшие в большем числе таблиц.
+     Индекс до EXACT_SCAN_ROWS строк перебирается целиком (точно).
+  2. Re-rank кандидатов полной мерой w1·A + w2·B + w3·C (как в
+     similarity.py, но z-score — по статистике индекса, а не сессии).
+
+Добавление: append() пишет новый сегмент; повторное добавление той же
+сессии заменяет её (старые строки скрываются и выкидываются при
+compact(); в rows / indexedFlows они не входят, stats() показывает их
+отдельно как staleRows). Мелкие сегменты автоматически сливаются, когда их больше
+MAX_SMALL_SEGMENTS.
+
+Из C#: index_session(index_dir, flows_json, session_id),
+query_index(index_dir, target_json, w1, w2, w3, k).
+
+Запуск (офлайн-построение / обслуживание):
+    cd PythonScripts
+    python similarity_index.py build --flows session_1.json session_2.json
+    python similarity_index.py append --flows session_3.json --session_id 3
+    python similarity_index.py query --flows session_3.json --target_id 42 --k 10
+    python similarity_index.py compact
+"""
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from similarity import (BLOCK_A_FIELDS, BLOCK_C_FIELDS, _detect_numeric_fields,
+                        _normalize_weights, _numeric_matrix, _flow_summary,
+                        _pack_c, _popcount)
+
+
+INDEX_FORMAT_VERSION = 1
+DEFAULT_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'models', 'similarity_index')
+DEFAULT_TABLES = 8
+DEFAULT_PLANES = 14
+DEFAULT_MAX_CANDIDATES = 5_000
+EXACT_SCAN_ROWS = 50_000      # индекс меньше — точный перебор без LSH
+SCAN_CHUNK_ROWS = 65_536
+SMALL_SEGMENT_ROWS = 200_000
+MAX_SMALL_SEGMENTS = 16
+
+THREAT_LEVELS = ['Low', 'Medium', 'High', 'Critical']
+NO_SESSION = -1
+
+_PORT_FIELDS = {'SourcePort', 'DestinationPort'}
+# Поля Block A, из которых строится точный ключ кандидатов
+_AKEY_COLS = [BLOCK_A_FIELDS.index(f) for f in ('DestinationIP', 'DestinationPort', 'Protocol')]
+
+
+# ============================================================
+# Кодирование flows
+# ============================================================
+
+def _encode_c(flows: List[Dict]) -> np.ndarray:
+    """Флаги Block C — один байт на flow (8 полей), та же упаковка, что в similarity."""
+    return np.ascontiguousarray(_pack_c(flows)[:, 0])
+
+
+def _a_strings(flows: List[Dict]) -> List[List[str]]:
+    return [[str(f.get(field, '')) for f in flows] for field in BLOCK_A_FIELDS]
+
+
+def _lsh_keys(Z: np.ndarray, planes: np.ndarray) -> np.ndarray:
+    """(T, r) uint32: бит p ключа таблицы t — знак проекции на plane[t, :, p]."""
+    weights = (np.uint32(1) << np.arange(planes.shape[2], dtype=np.uint32))
+    keys = np.empty((planes.shape[0], len(Z)), dtype=np.uint32)
+    for t in range(planes.shape[0]):
+        bits = (Z @ planes[t]) > 0
+        keys[t] = bits.astype(np.uint32) @ weights
+    return keys
+
+
+def _akeys(A: np.ndarray) -> np.ndarray:
+    dip, dport, proto = (A[:, c].astype(np.uint64) for c in _AKEY_COLS)
+    return (dip << np.uint64(32)) | (dport << np.uint64(8)) | (proto & np.uint64(0xFF))
+
+
+def _sorted_posting(keys: np.ndarray):
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order.astype(np.int32)
+
+
+def _posting_rows(sorted_keys: np.ndarray, rows: np.ndarray, probes: np.ndarray) -> np.ndarray:
+    lo = np.searchsorted(sorted_keys, probes, side='left')
+    hi = np.searchsorted(sorted_keys, probes, side='right')
+    parts = [rows[a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a]
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int32)
+
+
+def _save_atomic_json(path: str, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+# ============================================================
+# Сегмент
+# ============================================================
+
+_SEGMENT_ARRAYS = ('B', 'A', 'C', 'ids', 'sessions', 'attack', 'threat',
+                   'lsh_keys', 'lsh_rows', 'akey_keys', 'akey_rows')
+
+
+class _Segment:
+    def __init__(self, path: str, name: str):
+        self.name = name
+        self.path = os.path.join(path, name)
+        for key in _SEGMENT_ARRAYS:
+            setattr(self, key, np.load(os.path.join(self.path, key + '.npy'), mmap_mode='r'))
+        self.rows = len(self.ids)
+        self.stale_sessions = np.empty(0, dtype=np.int64)
+        self.stale_rows = 0
+
+    @staticmethod
+    def write(path: str, name: str, arrays: Dict[str, np.ndarray]):
+        """Пишет сегмент во временный каталог и переименовывает целиком."""
+        final = os.path.join(path, name)
+        tmp = final + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for key in _SEGMENT_ARRAYS:
+            np.save(os.path.join(tmp, key + '.npy'), arrays[key])
+        os.replace(tmp, final)
+
+    def live_mask(self, rows: np.ndarray) -> np.ndarray:
+        if not len(self.stale_sessions):
+            return np.ones(len(rows), dtype=bool)
+        return ~np.isin(self.sessions[rows], self.stale_sessions)
+
+
+# ============================================================
+# Индекс
+# ============================================================
+
+class SimilarityIndex:
+    """Сегменты на диске (memmap) + словари Block A + параметры LSH."""
+
+    def __init__(self, index_dir: str):
+        self.index_dir = os.path.abspath(index_dir)
+        with open(os.path.join(self.index_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(self.index_dir, 'vocab.json'), 'r', encoding='utf-8') as f:
+            self.vocab_lists: Dict[str, List[str]] = json.load(f)
+        self.vocab = {field: {v: i for i, v in enumerate(values)}
+                      for field, values in self.vocab_lists.items()}
+        self.planes = np.load(os.path.join(self.index_dir, 'planes.npy'))
+        self.numeric_fields: List[str] = self.meta['numeric_fields']
+        self.means = np.array(self.meta['means'], dtype=np.float64)
+        self.stds = np.array(self.meta['stds'], dtype=np.float64)
+        self.segments = [_Segment(self.index_dir, s['name']) for s in self.meta['segments']]
+        self._mark_stale()
+
+    # ------------------------------------------------------------------
+    @classmethod
+    def create(cls, index_dir: str, flows: List[Dict], n_tables: int = DEFAULT_TABLES,
+               n_planes: int = DEFAULT_PLANES, seed: int = 0,
+               session_id: int = NO_SESSION) -> 'SimilarityIndex':
+        """
+        Новый индекс: поля Block B и mean/std фиксируются по flows
+        (дальнейшие append() нормализуются той же статистикой).
+        """
+        if not flows:
+            raise ValueError("Для построения индекса нужен хотя бы один flow")
+        if not 1 <= n_planes <= 32:
+            raise ValueError("n_planes должен быть от 1 до 32 (ключ — uint32)")
+
+        numeric_fields = _detect_numeric_fields(flows)
+        data = _numeric_matrix(flows, numeric_fields)
+        means = data.mean(axis=0)
+        stds = data.std(axis=0)
+        stds[stds < 1e-9] = 1.0
+
+        os.makedirs(index_dir, exist_ok=True)
+        rng = np.random.default_rng(seed)
+        planes = rng.standard_normal((n_tables, len(numeric_fields), n_planes)).astype(np.float32)
+        np.save(os.path.join(index_dir, 'planes.npy'), planes)
+        _save_atomic_json(os.path.join(index_dir, 'vocab.json'),
+                          {field: [] for field in BLOCK_A_FIELDS})
+        _save_atomic_json(os.path.join(index_dir, 'meta.json'), {
+            'version': INDEX_FORMAT_VERSION,
+            'numeric_fields': numeric_fields,
+            'means': means.tolist(),
+            'stds': stds.tolist(),
+            'n_tables': n_tables,
+            'n_planes': n_planes,
+            'seed': seed,
+            'next_segment': 0,
+            'segments': [],
+            'sessions': {},
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        index = cls(index_dir)
+        index.append(flows, session_id)
+        return index
+
+    def _mark_stale(self):
+        """Для каждого сегмента — сессии, переиндексированные в более поздний сегмент."""
+        live = self.meta['sessions']
+        for seg, info in zip(self.segments, self.meta['segments']):
+            stale = [int(sid) for sid in info.get('sessions', [])
+                     if live.get(str(sid), seg.name) != seg.name]
+            seg.stale_sessions = np.array(stale, dtype=np.int64)
+            seg.stale_rows = (int(np.isin(seg.sessions, seg.stale_sessions).sum())
+                              if stale else 0)
+
+    @property
+    def total_rows(self) -> int:
+        """Живые строки: без строк заменённых сессий, ждущих compact()."""
+        return sum(seg.rows - seg.stale_rows for seg in self.segments)
+
+    @property
+    def stale_rows(self) -> int:
+        return sum(seg.stale_rows for seg in self.segments)
+
+    # ------------------------------------------------------------------
+    def _zscore(self, flows: List[Dict]) -> np.ndarray:
+        return ((_numeric_matrix(flows, self.numeric_fields) - self.means) / self.stds).astype(np.float32)
+
+    def _encode_a(self, flows: List[Dict], grow: bool) -> np.ndarray:
+        A = np.empty((len(flows), len(BLOCK_A_FIELDS)), dtype=np.int32)
+        for c, (field, column) in enumerate(zip(BLOCK_A_FIELDS, _a_strings(flows))):
+            codes, values = self.vocab[field], self.vocab_lists[field]
+            for i, value in enumerate(column):
+                code = codes.get(value)
+                if code is None:
+                    if not grow:
+                        code = -1      # значения нет в индексе — ни с чем не совпадёт
+                    else:
+                        code = codes[value] = len(values)
+                        values.append(value)
+                A[i, c] = code
+        return A
+
+    def _decode_a(self, field: str, code: int):
+        value = self.vocab_lists[field][code]
+        if field in _PORT_FIELDS:
+            return int(value) if value.lstrip('-').isdigit() else value
+        return value
+
+    # ------------------------------------------------------------------
+    def append(self, flows: List[Dict], session_id: int = NO_SESSION) -> Dict:
+        """Новый сегмент из flows; та же сессия, добавленная повторно, заменяет прежнюю."""
+        if not flows:
+            return {'rows': 0, 'segment': None}
+        session_id = NO_SESSION if session_id is None else int(session_id)
+
+        Z = self._zscore(flows)
+        A = self._encode_a(flows, grow=True)
+        lsh_keys = _lsh_keys(Z, self.planes)
+        lsh_sorted = np.empty_like(lsh_keys)
+        lsh_rows = np.empty(lsh_keys.shape, dtype=np.int32)
+        for t in range(len(lsh_keys)):
+            lsh_sorted[t], lsh_rows[t] = _sorted_posting(lsh_keys[t])
+        akey_keys, akey_rows = _sorted_posting(_akeys(A))
+
+        arrays = {
+            'B': Z,
+            'A': A,
+            'C': _encode_c(flows),
+            'ids': np.array([-1 if f.get('Id') is None else int(f['Id']) for f in flows],
+                            dtype=np.int64),
+            'sessions': np.full(len(flows), session_id, dtype=np.int64),
+            'attack': np.array([bool(f.get('IsAttack', False)) or f.get('Label') == 1
+                                for f in flows], dtype=np.int8),
+            'threat': np.array([THREAT_LEVELS.index(f.get('ThreatLevel'))
+                                if f.get('ThreatLevel') in THREAT_LEVELS else 0
+                                for f in flows], dtype=np.int8),
+            'lsh_keys': lsh_sorted,
+            'lsh_rows': lsh_rows,
+            'akey_keys': akey_keys,
+            'akey_rows': akey_rows,
+        }
+        name = f"seg_{self.meta['next_segment']:06d}"
+        _Segment.write(self.index_dir, name, arrays)
+
+        self.meta['next_segment'] += 1
+        self.meta['segments'].append({'name': name, 'rows': len(flows),
+                                      'sessions': [session_id]})
+        if session_id != NO_SESSION:
+            self.meta['sessions'][str(session_id)] = name
+        self._commit_meta()
+        self.segments.append(_Segment(self.index_dir, name))
+        self._mark_stale()
+        print(f"[SimilarityIndex] +{len(flows)} flows (session={session_id}) -> {name}")
+
+        small = [s for s in self.meta['segments'] if s['rows'] < SMALL_SEGMENT_ROWS]
+        if len(small) > MAX_SMALL_SEGMENTS:
+            self.compact([s['name'] for s in small])
+        return {'rows': len(flows), 'segment': name, 'totalRows': self.total_rows}
+
+    def compact(self, names: List[str] = None) -> Dict:
+        """Сливает сегменты (по умолчанию все) в один, выкидывая заменённые сессии."""
+        names = set(names) if names else {s.name for s in self.segments}
+        merge = [seg for seg in self.segments if seg.name in names]
+        if len(merge) < 2 and not any(len(seg.stale_sessions) for seg in merge):
+            return {'merged': 0, 'segments': len(self.segments)}
+
+        parts = {key: [] for key in ('B', 'A', 'C', 'ids', 'sessions', 'attack', 'threat')}
+        sessions = set()
+        for seg in merge:
+            keep = np.flatnonzero(seg.live_mask(np.arange(seg.rows)))
+            for key in parts:
+                parts[key].append(np.asarray(getattr(seg, key))[keep])
+            sessions.update(int(s) for s in np.unique(np.asarray(seg.sessions)[keep]))
+        arrays = {key: np.concatenate(v) for key, v in parts.items()}
+
+        lsh_keys = _lsh_keys(arrays['B'], self.planes)
+        arrays['lsh_keys'] = np.empty_like(lsh_keys)
+        arrays['lsh_rows'] = np.empty(lsh_keys.shape, dtype=np.int32)
+        for t in range(len(lsh_keys)):
+            arrays['lsh_keys'][t], arrays['lsh_rows'][t] = _sorted_posting(lsh_keys[t])
+        arrays['akey_keys'], arrays['akey_rows'] = _sorted_posting(_akeys(arrays['A']))
+
+        name = f"seg_{self.meta['next_segment']:06d}"
+        _Segment.write(self.index_dir, name, arrays)
+        self.meta['next_segment'] += 1
+        merged_names = {seg.name for seg in merge}
+        self.meta['segments'] = [s for s in self.meta['segments'] if s['name'] not in merged_names]
+        self.meta['segments'].append({'name': name, 'rows': len(arrays['ids']),
+                                      'sessions': sorted(sessions)})
+        for sid, seg_name in list(self.meta['sessions'].items()):
+            if seg_name in merged_names:
+                self.meta['sessions'][sid] = name
+        self._commit_meta()
+
+        # Старые каталоги удаляются после записи meta: открытые memmap
+        # других читателей на POSIX остаются валидными
+        self.segments = [_Segment(self.index_dir, s['name']) for s in self.meta['segments']]
+        self._mark_stale()
+        for seg_name in merged_names:
+            shutil.rmtree(os.path.join(self.index_dir, seg_name), ignore_errors=True)
+        print(f"[SimilarityIndex] compact: {len(merge)} сегментов -> {name} "
+              f"({len(arrays['ids'])} flows)")
+        return {'merged': len(merge), 'segment': name, 'rows': len(arrays['ids']),
+                'segments': len(self.segments)}
+
+    def _commit_meta(self):
+        _save_atomic_json(os.path.join(self.index_dir, 'vocab.json'), self.vocab_lists)
+        _save_atomic_json(os.path.join(self.index_dir, 'meta.json'), self.meta)
+
+    # ------------------------------------------------------------------
+    def _candidates(self, seg: _Segment, z: np.ndarray, a: np.ndarray,
+                    max_candidates: int) -> np.ndarray:
+        q_keys = _lsh_keys(z[None, :].astype(np.float32), self.planes)[:, 0]
+        flips = np.uint32(1) << np.arange(self.planes.shape[2], dtype=np.uint32)
+        found = [_posting_rows(seg.lsh_keys[t], seg.lsh_rows[t],
+                               np.concatenate(([q_keys[t]], q_keys[t] ^ flips)))
+                 for t in range(len(q_keys))]
+        if (a[_AKEY_COLS] >= 0).all():
+            found.append(_posting_rows(seg.akey_keys, seg.akey_rows, _akeys(a[None, :])))
+        found = [f for f in found if len(f)]
+        if not found:
+            return np.empty(0, dtype=np.int64)
+
+        rows, votes = np.unique(np.concatenate(found), return_counts=True)
+        if len(rows) > max_candidates:
+            rows = rows[np.argpartition(-votes, max_candidates - 1)[:max_candidates]]
+            rows.sort()   # последовательное чтение memmap
+        return rows.astype(np.int64)
+
+    def _score(self, seg: _Segment, rows: np.ndarray, z, a, c, weights):
+        w1, w2, w3 = weights
+        sim_a = (np.asarray(seg.A[rows]) == a).sum(axis=1) / len(BLOCK_A_FIELDS)
+        m_b = len(self.numeric_fields)
+        if m_b:
+            diff = np.asarray(seg.B[rows], dtype=np.float64) - z
+            sim_b = np.exp(-np.sqrt((diff * diff).sum(axis=1)) / np.sqrt(m_b))
+        else:
+            sim_b = np.zeros(len(rows))
+        sim_c = (len(BLOCK_C_FIELDS) - _popcount(np.asarray(seg.C[rows]) ^ c)) / len(BLOCK_C_FIELDS)
+        return w1 * sim_a + w2 * sim_b + w3 * sim_c, sim_a, sim_b, sim_c
+
+    def query(self, target: Dict, w1=1.0, w2=1.0, w3=1.0, k: int = 10,
+              max_candidates: int = DEFAULT_MAX_CANDIDATES, exact: bool = None) -> Dict:
+        """top-k flows индекса по полной мере сходства с target (сам target исключается)."""
+        weights = _normalize_weights(w1, w2, w3)
+        z = self._zscore([target])[0].astype(np.float64)
+        a = self._encode_a([target], grow=False)[0]
+        c = _encode_c([target])[0]
+        target_id = target.get('Id')
+        # полный перебор читает и скрытые строки — порог по всем строкам на диске
+        if exact is None:
+            exact = self.total_rows + self.stale_rows <= EXACT_SCAN_ROWS
+
+        best = []   # (sim, sim_a, sim_b, sim_c, seg, row)
+        candidates = 0
+        for seg in self.segments:
+            if exact:
+                chunks = (np.arange(s, min(s + SCAN_CHUNK_ROWS, seg.rows))
+                          for s in range(0, seg.rows, SCAN_CHUNK_ROWS))
+            else:
+                chunks = [self._candidates(seg, z, a, max_candidates)]
+            for rows in chunks:
+                rows = rows[seg.live_mask(rows)]
+                if target_id is not None:
+                    rows = rows[np.asarray(seg.ids[rows]) != target_id]
+                if not len(rows):
+                    continue
+                candidates += len(rows)
+                sim, sim_a, sim_b, sim_c = self._score(seg, rows, z, a, c, weights)
+                top = np.argsort(-sim, kind='stable')[:k]
+                best.extend((sim[j], sim_a[j], sim_b[j], sim_c[j], seg, int(rows[j])) for j in top)
+
+        best.sort(key=lambda r: -r[0])
+        results = [self._result(*entry) for entry in best[:k]]
+        return {
+            'targetFlow': _flow_summary(target),
+            'weights': {key: round(w, 4) for key, w in zip(('w1', 'w2', 'w3'), weights)},
+            'mode': 'exact' if exact else 'lsh',
+            'indexedFlows': self.total_rows,
+            'candidates': candidates,
+            'k': k,
+            'results': results,
+        }
+
+    def _result(self, sim, sim_a, sim_b, sim_c, seg: _Segment, row: int) -> Dict:
+        codes = seg.A[row]
+        fields = {field: self._decode_a(field, int(codes[i]))
+                  for i, field in enumerate(BLOCK_A_FIELDS)}
+        session = int(seg.sessions[row])
+        return {
+            'flowId': int(seg.ids[row]),
+            'sessionId': None if session == NO_SESSION else session,
+            'sourceIP': fields['SourceIP'],
+            'destinationIP': fields['DestinationIP'],
+            'sourcePort': fields['SourcePort'],
+            'destinationPort': fields['DestinationPort'],
+            'protocol': fields['Protocol'],
+            'isAttack': bool(seg.attack[row]),
+            'threatLevel': THREAT_LEVELS[int(seg.threat[row])],
+            'simA': round(float(sim_a), 4),
+            'simB': round(float(sim_b), 4),
+            'simC': round(float(sim_c), 4),
+            'sim': round(float(sim), 4),
+        }
+
+    def stats(self) -> Dict:
+        return {
+            'indexDir': self.index_dir,
+            'rows': self.total_rows,
+            'staleRows': self.stale_rows,
+            'segments': len(self.segments),
+            'sessions': len(self.meta['sessions']),
+            'numericFields': len(self.numeric_fields),
+            'tables': int(self.planes.shape[0]),
+            'planes': int(self.planes.shape[2]),
+        }
+
+
+# ============================================================
+# Модульный кеш открытых индексов (живёт между вызовами из C#)
+# ============================================================
+_INDEX_CACHE: Dict[str, tuple] = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def open_index(index_dir: str = DEFAULT_INDEX_DIR) -> SimilarityIndex:
+    """Открытый индекс из кеша; переоткрывается, если meta.json изменился."""
+    abs_dir = os.path.abspath(index_dir)
+    meta_path = os.path.join(abs_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(f"Индекс сходства не найден: {abs_dir}. "
+                                f"Постройте его: python similarity_index.py build")
+    mtime = os.path.getmtime(meta_path)
+    cached = _INDEX_CACHE.get(abs_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    index = SimilarityIndex(abs_dir)
+    _INDEX_CACHE[abs_dir] = (mtime, index)
+    print(f"[SimilarityIndex] Открыт {abs_dir}: {index.total_rows} flows, "
+          f"{len(index.segments)} сегментов")
+    return index
+
+
+def index_session(index_dir: str, flows_json: str, session_id: int = NO_SESSION) -> str:
+    """Добавляет (или переиндексирует) сессию; первый вызов создаёт индекс."""
+    flows = json.loads(flows_json)
+    with _INDEX_LOCK:
+        if not os.path.exists(os.path.join(index_dir, 'meta.json')):
+            index = SimilarityIndex.create(index_dir, flows, session_id=session_id)
+            result = {'rows': len(flows), 'created': True}
+        else:
+            index = open_index(index_dir)
+            result = index.append(flows, session_id)
+        _INDEX_CACHE[os.path.abspath(index_dir)] = (
+            os.path.getmtime(os.path.join(index_dir, 'meta.json')), index)
+        return json.dumps({**result, **index.stats()})
+
+
+def query_index(index_dir: str, target_json: str, w1, w2, w3, k=10,
+                max_candidates: int = DEFAULT_MAX_CANDIDATES) -> str:
+    """top-k похожих на target (JSON одного flow) по всему индексу."""
+    target = json.loads(target_json)
+    try:
+        index = open_index(index_dir)
+    except FileNotFoundError as e:
+        return json.dumps({"error": str(e), "results": []})
+    return json.dumps(index.query(target, w1, w2, w3, k, max_candidates))
+
+
+def index_stats(index_dir: str = DEFAULT_INDEX_DIR) -> str:
+    return json.dumps(open_index(index_dir).stats())
+
+
+# ============================================================
+# CLI
+# ============================================================
+
+def _load_flows(paths: List[str]) -> List[List[Dict]]:
+    sessions = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            sessions.append(json.load(f))
+    return sessions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['build', 'append', 'query', 'compact', 'stats'])
+    parser.add_argument('--index_dir', default=DEFAULT_INDEX_DIR)
+    parser.add_argument('--flows', nargs='*', default=[],
+                        help='JSON-файлы со списками flows (один файл — одна сессия)')
+    parser.add_argument('--session_id', type=int, default=None,
+                        help='для append; по умолчанию SessionId первого flow')
+    parser.add_argument('--tables', type=int, default=DEFAULT_TABLES)
+    parser.add_argument('--planes', type=int, default=DEFAULT_PLANES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--target_id', type=int, default=None)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--weights', default='0.10,0.60,0.30')
+    parser.add_argument('--exact', action='store_true', help='query: полный перебор')
+    args = parser.parse_args()
+
+    print("=" * 70)
+    print(f"Similarity index: {args.command} ({args.index_dir})")
+    print("=" * 70)
+
+    sessions = _load_flows(args.flows)
+
+    def session_of(flows):
+        if args.session_id is not None:
+            return args.session_id
+        return int(flows[0].get('SessionId', NO_SESSION)) if flows else NO_SESSION
+
+    if args.command == 'build':
+        if not sessions:
+            parser.error('build: нужен --flows')
+        if os.path.exists(args.index_dir):
+            shutil.rmtree(args.index_dir)
+        t0 = time.perf_counter()
+        index = SimilarityIndex.create(args.index_dir, sessions[0], args.tables,
+                                       args.planes, args.seed, session_of(sessions[0]))
+        for flows in sessions[1:]:
+            index.append(flows, session_of(flows))
+        print(f"[SimilarityIndex] Построен за {time.perf_counter() - t0:.1f}s")
+        print(json.dumps(index.stats(), indent=2, ensure_ascii=False))
+
+    elif args.command == 'append':
+        index = open_index(args.index_dir)
+        for flows in sessions:
+            index.append(flows, session_of(flows))
+        print(json.dumps(index.stats(), indent=2, ensure_ascii=False))
+
+    elif args.command == 'compact':
+        print(json.dumps(open_index(args.index_dir).compact(), indent=2, ensure_ascii=False))
+
+    elif args.command == 'stats':
+        print(json.dumps(open_index(args.index_dir).stats(), indent=2, ensure_ascii=False))
+
+    else:
+        target = next((f for flows in sessions for f in flows
+                       if f.get('Id') == args.target_id), None)
+        if target is None:
+            parser.error('query: --target_id не найден во --flows')
+        w1, w2, w3 = (float(w) for w in args.weights.split(','))
+        index = open_index(args.index_dir)
+        t0 = time.perf_counter()
+        result = index.query(target, w1, w2, w3, args.k, exact=True if args.exact else None)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        for r in result['results']:
+            print(f"  #{r['flowId']:<8} session={r['sessionId']}  sim={r['sim']:.4f}  "
+                  f"{r['sourceIP']} -> {r['destinationIP']}:{r['destinationPort']}")
+        print(f"\n[SimilarityIndex] {result['mode']}: {result['candidates']} кандидатов "
+              f"из {result['indexedFlows']}, {elapsed_ms:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,515 @@
+"""
+PythonScripts/similarity_prototypes.py
+
+Сжатая обучающая выборка (прототипы) для kNN на мере сходства similarity.py.
+
+Зачем:
+  knn_classify_flows сравнивает каждый flow со всеми размеченными — O(n²),
+  и ошибочная метка отдельного flow напрямую попадает в голосование
+  соседей. Небольшой набор прототипов каждого класса (p ≪ n) даёт
+  классификацию за O(n·p) и сглаживает шум меток.
+
+Отбор (отдельно по классам меток, на комбинированной мере sim с весами
+w1/w2/w3):
+  kmedoids — k-medoids: жадный BUILD, затем итерации «назначить flows
+             ближайшему медоиду — выбрать новый медоид кластера»,
+             максимизируется Σ max sim. Класс больше KMEDOIDS_SAMPLE flows
+             — по случайной выборке (CLARA): матрица sim выборки m×m.
+  cnn      — condensed nearest neighbour (Hart): flow становится
+             прототипом, если ближайший прототип его ошибочно
+             классифицирует; проходы до стабилизации (не больше
+             CNN_MAX_PASSES) или до MAX_PROTOTYPES.
+
+Хранение (models/similarity_prototypes или IDS_SIMILARITY_PROTOTYPES):
+  <name>/meta.json — поля Block B и z-score статистики обучающей выборки,
+                     словари Block A прототипов, веса, k, Id и метки
+                     прототипов, отчёт build_prototypes
+  <name>/A.npy, B.npy, C.npy — блоки прототипов
+  Новые flows кодируются статистиками и словарями обучающей выборки —
+  sim с прототипами та же, что была при отборе.
+
+build_prototypes сравнивает классификацию по прототипам с полным kNN
+(leave-one-out по той же выборке, как knn_classify_flows): согласие
+предсказаний, agreement с метками у обоих и время классификации.
+"""
+
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from inference_scheduler import scheduled, current_budget
+from profiling import NULL_TIMER, make_timer, append_profile
+from similarity import (BLOCK_A_FIELDS,
+                        _detect_numeric_fields, _numeric_matrix, _factorize_a, _pack_c,
+                        _normalize_weights, _knn_topk_tiled, _map_tiles, _tile_buffers,
+                        _tile_rows_for, _similarity_tile, _tile_topk, _knn_prediction)
+
+
+PROTOTYPES_FORMAT_VERSION = 1
+DEFAULT_PROTOTYPE_DIR = os.environ.get('IDS_SIMILARITY_PROTOTYPES') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'models', 'similarity_prototypes')
+
+METHODS = ('kmedoids', 'cnn')
+KMEDOIDS_SAMPLE = 3000
+KMEDOIDS_MAX_ITER = 20
+CNN_MAX_PASSES = 5
+CNN_BATCH = 512
+MAX_PROTOTYPES = 2000
+
+_BLOCK_ARRAYS = ('A', 'B', 'C')
+# Имя набора — один каталог внутри хранилища: без '/', '..' и т.п.
+_NAME_RE = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+
+# ============================================================
+# ОТБОР ПРОТОТИПОВ
+# ============================================================
+
+@scheduled
+def build_prototypes(flows_json, labels_json, w1, w2, w3, name='default',
+                     method='kmedoids', per_class=50, k=1, full_k=5, evaluate=True,
+                     seed=0, profile=False, profile_top=0, store_dir=None):
+    """
+    Отбирает прототипы flows_json (метки labels_json {id: bool}) и
+    сохраняет их под именем name. per_class — прототипов на класс для
+    kmedoids (cnn подбирает число сам). k — соседей среди прототипов при
+    классификации. evaluate — сравнить с полным kNN (full_k соседей) на
+    той же выборке: это O(n²), как knn_classify_flows.
+    """
+    timer = make_timer(profile, profile_top)
+    flows = json.loads(flows_json)
+    labels_map = {int(k_): bool(v) for k_, v in json.loads(labels_json).items()}
+    timer.lap('parse')
+
+    if method not in METHODS:
+        return json.dumps({"error": f"Unknown method '{method}', expected one of {list(METHODS)}"})
+    if not _valid_name(name):
+        return json.dumps({"error": "Invalid prototype set name (allowed: A-Z a-z 0-9 _ -)"})
+    if not flows or len(flows) < max(k, full_k) + 1:
+        return json.dumps({"error": f"Need at least {max(k, full_k) + 1} flows, "
+                                    f"got {len(flows) if flows else 0}"})
+
+    weights = _normalize_weights(w1, w2, w3)
+    n = len(flows)
+    labels = np.array([labels_map.get(f.get('Id'), False) for f in flows], dtype=bool)
+    blocks, encoding = _encode_training(flows)
+    timer.lap('blocks')
+    timer.count('rows', n)
+
+    rng = np.random.default_rng(seed)
+    if method == 'kmedoids':
+        protos = np.concatenate([
+            _kmedoids_class(blocks, np.flatnonzero(labels == cls), weights, per_class, rng)
+            for cls in (False, True)])
+    else:
+        protos = _condensed_nn(blocks, labels, weights, rng)
+    protos = np.sort(protos)
+    timer.lap('select')
+    timer.count('prototypes', len(protos))
+
+    report = {
+        "name": name,
+        "method": method,
+        "weights": {"w1": round(weights[0], 4), "w2": round(weights[1], 4),
+                    "w3": round(weights[2], 4)},
+        "k": k,
+        "totalFlows": n,
+        "prototypes": int(len(protos)),
+        "attackPrototypes": int(labels[protos].sum()),
+        "benignPrototypes": int((~labels[protos]).sum()),
+        "compression": round(len(protos) / n, 4),
+    }
+    if evaluate:
+        report["evaluation"] = _evaluate(blocks, labels, protos, weights, k, full_k, timer)
+
+    proto_flows = [flows[i] for i in protos]
+    vocabs = [{} for _ in BLOCK_A_FIELDS]
+    proto_blocks = {
+        'A': _factorize_a(proto_flows, vocabs),
+        'B': blocks['B'][protos],
+        'C': _pack_c(proto_flows),
+    }
+    meta = {
+        "formatVersion": PROTOTYPES_FORMAT_VERSION,
+        "name": name,
+        "method": method,
+        "weights": list(weights),
+        "k": k,
+        "numericFields": encoding['numeric_fields'],
+        "mean": encoding['mean'].tolist(),
+        "std": encoding['std'].tolist(),
+        "vocabs": [list(v) for v in vocabs],
+        "prototypeIds": [f.get('Id') for f in proto_flows],
+        "prototypeLabels": labels[protos].tolist(),
+        "report": report,
+    }
+    path = _prototype_path(name, store_dir)
+    _write(path, proto_blocks, meta)
+    report["path"] = path
+    timer.lap('save')
+
+    out = json.dumps(report)
+    return append_profile(out, timer) if profile else out
+
+
+def _encode_training(flows):
+    """Блоки обучающей выборки (как _build_similarity_blocks) и их кодировка."""
+    numeric_fields = _detect_numeric_fields(flows)
+    raw = _numeric_matrix(flows, numeric_fields)
+    means = raw.mean(axis=0)
+    stds = raw.std(axis=0)
+    stds[stds < 1e-9] = 1.0
+    B = (raw - means) / stds
+    blocks = {
+        'numeric_fields': numeric_fields,
+        'A': _factorize_a(flows),
+        'B': B,
+        'B_sq': (B * B).sum(axis=1),
+        'C': _pack_c(flows),
+    }
+    return blocks, {'numeric_fields': numeric_fields, 'mean': means, 'std': stds}
+
+
+def _subset(blocks, idx):
+    return {
+        'numeric_fields': blocks['numeric_fields'],
+        'A': np.asfortranarray(blocks['A'][idx]),
+        'B': blocks['B'][idx],
+        'B_sq': blocks['B_sq'][idx],
+        'C': np.asfortranarray(blocks['C'][idx]),
+    }
+
+
+def _kmedoids_class(blocks, members, weights, per_class, rng):
+    """Медоиды одного класса (индексы в blocks); выборка до KMEDOIDS_SAMPLE flows."""
+    if len(members) <= per_class:
+        return members
+    if len(members) > KMEDOIDS_SAMPLE:
+        members = np.sort(rng.choice(members, KMEDOIDS_SAMPLE, replace=False))
+    sim = _dense_similarity(_subset(blocks, members), weights)
+    return members[_kmedoids(sim, per_class)]
+
+
+def _dense_similarity(blocks, weights):
+    """Полная матрица sim (m, m) float32 — только для выборки класса."""
+    m = blocks['B'].shape[0]
+    sim = np.empty((m, m), dtype=np.float32)
+    workers = max(1, min(current_budget() or 1, m))
+    step = _tile_rows_for(m, None, workers)
+
+    def run_tile(start, stop, bufs):
+        _similarity_tile(blocks, slice(start, stop), weights, bufs)
+        sim[start:stop] = bufs['out']
+
+    _map_tiles(m, step, workers, lambda: _tile_buffers(step, m), run_tile)
+    return sim
+
+
+def _kmedoids(sim, p):
+    """
+    p медоидов по матрице sim (m, m): жадный BUILD (на каждом шаге —
+    точка с наибольшим приростом Σ max sim), затем чередование
+    назначения и пересчёта медоида (член кластера с наибольшей суммой sim
+    к остальным) до стабилизации.
+    """
+    m = sim.shape[0]
+    medoids = [int(np.argmax(sim.sum(axis=1, dtype=np.float64)))]
+    best = sim[medoids[0]].copy()
+    for _ in range(1, p):
+        gain = np.maximum(sim - best[None, :], 0).sum(axis=1, dtype=np.float64)
+        gain[medoids] = -1.0
+        nxt = int(np.argmax(gain))
+        medoids.append(nxt)
+        np.maximum(best, sim[nxt], out=best)
+
+    medoids = np.array(medoids)
+    for _ in range(KMEDOIDS_MAX_ITER):
+        assign = np.argmax(sim[medoids], axis=0)
+        assign[medoids] = np.arange(p)        # медоид — в своём кластере
+        updated = medoids.copy()
+        for c in range(p):
+            cluster = np.flatnonzero(assign == c)
+            within = sim[np.ix_(cluster, cluster)].sum(axis=1, dtype=np.float64)
+            updated[c] = cluster[int(np.argmax(within))]
+        if np.array_equal(updated, medoids):
+            break
+        medoids = updated
+    return medoids
+
+
+def _condensed_nn(blocks, labels, weights, rng):
+    """
+    Hart's CNN: обход flows в случайном порядке, flow добавляется в
+    прототипы, если ближайший прототип другого класса. Flows идут
+    пачками по CNN_BATCH против прототипов на начало пачки; добавленные
+    внутри пачки учитываются точно, построчно.
+    """
+    n = labels.shape[0]
+    order = rng.permutation(n)
+    protos = [int(order[np.argmax(labels[order] == cls)])
+              for cls in (False, True) if (labels == cls).any()]
+    is_proto = np.zeros(n, dtype=bool)
+    is_proto[protos] = True
+
+    for _ in range(CNN_MAX_PASSES):
+        added = 0
+        for start in range(0, n, CNN_BATCH):
+            batch = order[start:start + CNN_BATCH]
+            batch = batch[~is_proto[batch]]
+            if batch.size == 0:
+                continue
+            proto_idx = np.array(protos)
+            bufs = _tile_buffers(batch.size, proto_idx.size)
+            _similarity_tile(blocks, batch, weights, bufs, col_blocks=_subset(blocks, proto_idx))
+            nearest = np.argmax(bufs['out'], axis=1)
+            best_sim = bufs['out'][np.arange(batch.size), nearest]
+            wrong = np.flatnonzero(labels[proto_idx[nearest]] != labels[batch])
+
+            fresh = []
+            for row in wrong:
+                flow = batch[row]
+                if fresh:
+                    sims = _similarity_to(blocks, weights, flow, fresh)
+                    j = int(np.argmax(sims))
+                    if sims[j] > best_sim[row] and labels[fresh[j]] == labels[flow]:
+                        continue
+                fresh.append(int(flow))
+                if len(protos) + len(fresh) >= MAX_PROTOTYPES:
+                    break
+            protos.extend(fresh)
+            is_proto[fresh] = True
+            added += len(fresh)
+            if len(protos) >= MAX_PROTOTYPES:
+                return np.array(protos)
+        if added == 0:
+            break
+    return np.array(protos)
+
+
+def _similarity_to(blocks, weights, row, cols):
+    """sim одного flow с несколькими (float32, как тайл)."""
+    bufs = _tile_buffers(1, len(cols))
+    _similarity_tile(blocks, np.array([row]), weights, bufs, col_blocks=_subset(blocks, cols))
+    return bufs['out'][0]
+
+
+def _evaluate(blocks, labels, protos, weights, k, full_k, timer):
+    """Полный kNN (leave-one-out) против kNN по прототипам на той же выборке."""
+    n = labels.shape[0]
+    t0 = time.perf_counter()
+    full_idx, _ = _knn_topk_tiled(blocks, weights, full_k)
+    full_pred = labels[full_idx].sum(axis=1) / full_k > 0.5
+    t_full = time.perf_counter() - t0
+    timer.lap('fullKnn')
+
+    # Прототип не голосует сам за себя
+    exclude = np.full(n, -1, dtype=np.int64)
+    exclude[protos] = np.arange(len(protos))
+    t0 = time.perf_counter()
+    proto_idx, _ = _prototype_topk(blocks, _subset(blocks, protos), weights, k, exclude=exclude)
+    proto_pred = labels[protos][proto_idx].sum(axis=1) / max(proto_idx.shape[1], 1) > 0.5
+    t_proto = time.perf_counter() - t0
+    timer.lap('prototypeKnn')
+
+    return {
+        "fullKnn": {
+            "k": full_k,
+            "agreementWithOriginal": round(float((full_pred == labels).mean()), 4),
+            "attackFlows": int(full_pred.sum()),
+            "elapsedMs": round(t_full * 1000, 1),
+        },
+        "prototypeKnn": {
+            "k": k,
+            "agreementWithOriginal": round(float((proto_pred == labels).mean()), 4),
+            "agreementWithFullKnn": round(float((proto_pred == full_pred).mean()), 4),
+            "attackFlows": int(proto_pred.sum()),
+            "elapsedMs": round(t_proto * 1000, 1),
+        },
+        "speedup": round(t_full / t_proto, 1) if t_proto > 0 else None,
+    }
+
+
+def _prototype_topk(blocks, proto_blocks, weights, k, exclude=None, timer=NULL_TIMER):
+    """
+    top-k прототипов каждого flow: (idx (n, k), sim (n, k)) — тайлы
+    «flows × p прототипов», O(n·p). exclude[i] >= 0 — прототип, который
+    для flow i не учитывается (сам flow).
+    """
+    n, p = blocks['B'].shape[0], proto_blocks['B'].shape[0]
+    k = max(0, min(int(k), p - (1 if exclude is not None else 0)))
+    top_idx = np.zeros((n, k), dtype=np.int64)
+    top_sim = np.zeros((n, k), dtype=np.float64)
+    if k == 0 or n == 0:
+        return top_idx, top_sim
+
+    workers = max(1, min(current_budget() or 1, n))
+    step = _tile_rows_for(n, None, workers, width=p)
+    timer.count('tileRows', step)
+
+    def run_tile(start, stop, bufs):
+        out = bufs['out']
+        _similarity_tile(blocks, slice(start, stop), weights, bufs, col_blocks=proto_blocks)
+        if exclude is not None:
+            rows = np.flatnonzero(exclude[start:stop] >= 0)
+            out[rows, exclude[start:stop][rows]] = -1.0
+        top_idx[start:stop], top_sim[start:stop] = _tile_topk(
+            blocks, weights, k, start, stop, out, col_blocks=proto_blocks)
+
+    _map_tiles(n, step, workers, lambda: _tile_buffers(step, p), run_tile)
+    return top_idx, top_sim
+
+
+# ============================================================
+# КЛАССИФИКАЦИЯ ПО ПРОТОТИПАМ
+# ============================================================
+
+@scheduled
+def classify_with_prototypes(flows_json, name='default', labels_json=None, k=None,
+                             profile=False, profile_top=0, store_dir=None):
+    """
+    kNN flows_json по сохранённым прототипам name — O(n·p). Формат
+    predictions — как у knn_classify_flows (соседи — прототипы, их Id из
+    обучающей выборки). labels_json {id: bool} — если есть, считается
+    agreementWithOriginal. k — по умолчанию k из build_prototypes.
+    """
+    timer = make_timer(profile, profile_top)
+    flows = json.loads(flows_json)
+    labels_map = ({int(k_): bool(v) for k_, v in json.loads(labels_json).items()}
+                  if labels_json else None)
+    timer.lap('parse')
+
+    if not _valid_name(name):
+        return json.dumps({"error": "Invalid prototype set name (allowed: A-Z a-z 0-9 _ -)",
+                           "predictions": []})
+    loaded = _read(_prototype_path(name, store_dir))
+    if loaded is None:
+        return json.dumps({"error": f"Prototype set '{name}' not found", "predictions": []})
+    proto_blocks, meta = loaded
+    k = int(k or meta['k'])
+    weights = tuple(meta['weights'])
+    if not flows:
+        return json.dumps({"error": "Empty flows", "predictions": []})
+
+    blocks = _encode(flows, meta)
+    proto_blocks['B_sq'] = (proto_blocks['B'] * proto_blocks['B']).sum(axis=1)
+    timer.lap('blocks')
+    timer.count('rows', len(flows))
+
+    top_idx, top_sim = _prototype_topk(blocks, proto_blocks, weights, k, timer=timer)
+    k = top_idx.shape[1]
+    timer.lap('sim')
+
+    proto_ids = meta['prototypeIds']
+    proto_labels = np.array(meta['prototypeLabels'], dtype=bool)
+    original = np.array([labels_map.get(f.get('Id'), False) if labels_map else False
+                         for f in flows], dtype=bool)
+    predictions = [_knn_prediction(flows[i], proto_ids, proto_labels, top_idx[i], top_sim[i],
+                                   k, original[i])
+                   for i in range(len(flows))]
+    knn_attack = np.array([p['knnIsAttack'] for p in predictions], dtype=bool)
+
+    result = {
+        "name": name,
+        "method": meta['method'],
+        "totalFlows": len(flows),
+        "prototypes": len(proto_ids),
+        "knnAttackFlows": int(knn_attack.sum()),
+        "weights": {"w1": round(weights[0], 4), "w2": round(weights[1], 4),
+                    "w3": round(weights[2], 4)},
+        "k": k,
+        "buildEvaluation": meta['report'].get('evaluation'),
+    }
+    if labels_map is not None:
+        result["originalAttackFlows"] = int(original.sum())
+        result["agreementWithOriginal"] = round(float((knn_attack == original).mean()), 4)
+    result["predictions"] = predictions
+    timer.lap('format')
+
+    out = json.dumps(result)
+    timer.lap('serialize')
+    return append_profile(out, timer) if profile else out
+
+
+def _encode(flows, meta):
+    """Блоки новых flows в кодировке обучающей выборки прототипов."""
+    mean = np.array(meta['mean'], dtype=np.float64)
+    std = np.array(meta['std'], dtype=np.float64)
+    B = (_numeric_matrix(flows, meta['numericFields']) - mean) / std
+    vocabs = [{value: code for code, value in enumerate(col)} for col in meta['vocabs']]
+    return {
+        'numeric_fields': meta['numericFields'],
+        'A': _factorize_a(flows, vocabs),
+        'B': B,
+        'B_sq': (B * B).sum(axis=1),
+        'C': _pack_c(flows),
+    }
+
+
+# ============================================================
+# ХРАНЕНИЕ
+# ============================================================
+
+def _valid_name(name):
+    return isinstance(name, str) and _NAME_RE.fullmatch(name) is not None
+
+
+def _prototype_path(name, store_dir=None):
+    """Каталог набора; имя проверяется — путь не может выйти из хранилища."""
+    if not _valid_name(name):
+        raise ValueError(f"Invalid prototype set name: {name!r}")
+    root = os.path.realpath(store_dir or DEFAULT_PROTOTYPE_DIR)
+    path = os.path.join(root, name)
+    if os.path.dirname(os.path.realpath(path)) != root:
+        raise ValueError(f"Prototype set path escapes store: {name!r}")
+    return path
+
+
+def _read(path):
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        blocks = {name: np.load(os.path.join(path, name + '.npy')) for name in _BLOCK_ARRAYS}
+    except (OSError, ValueError) as e:
+        print(f"[Prototypes] Повреждён набор {path}: {e}")
+        return None
+    if meta.get('formatVersion') != PROTOTYPES_FORMAT_VERSION:
+        print(f"[Prototypes] Набор {path} в старом формате — нужен build_prototypes")
+        return None
+    blocks['A'] = np.asfortranarray(blocks['A'])
+    blocks['C'] = np.asfortranarray(blocks['C'])
+    return blocks, meta
+
+
+def _write(path, blocks, meta):
+    """Временный каталог, затем замена целиком: читатели не видят половину набора."""
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = os.path.join(parent, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(tmp)
+    try:
+        for name in _BLOCK_ARRAYS:
+            np.save(os.path.join(tmp, name + '.npy'), blocks[name])
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        old = None
+        if os.path.exists(path):
+            # Заменяем только прежний набор прототипов, не чужой каталог
+            if not os.path.isfile(os.path.join(path, 'meta.json')):
+                raise FileExistsError(f"{path} exists and is not a prototype set")
+            old = f"{tmp}.old"
+            os.replace(path, old)
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+    print(f"[Prototypes] Сохранено {len(meta['prototypeIds'])} прототипов: {path}")
@@ -0,0 +1,193 @@
+"""
+PythonScripts/similarity_store.py
+
+Кеш блоков сходства (A/B/C) по сессиям для similarity.py.
+
+Зачем:
+  Каждый find_similar_flows / knn_classify_flows / sweep_weights заново
+  определял поля Block B, строил z-score матрицу циклом по flows и полям,
+  факторизовал Block A и упаковывал флаги Block C — и выбрасывал всё
+  после ответа. Для одной и той же сессии (UI дёргает поиск десятки раз)
+  это одна и та же работа.
+
+Что хранится (каталог, по умолчанию models/similarity_store или
+IDS_SIMILARITY_STORE):
+  <session_id>/<fingerprint>/
+      meta.json   — поля Block B, число flows, fingerprint
+      A.npy       int32 (n, 5)            коды Block A (по колонкам)
+      B.npy       float64 (n, m_b)        z-score признаки
+      B_sq.npy    float64 (n,)            ||B||² строк
+      C.npy       uint8 (n, ceil(m_c/8))  упакованные флаги Block C
+  Массивы открываются через np.load(mmap_mode='r'); последние
+  MAX_WARM_SESSIONS сессий держатся открытыми в памяти процесса.
+
+Инвалидация — по fingerprint: число flows + CRC32 их Id (в порядке
+передачи) + CRC32 содержимого от вызывающего (similarity.py передаёт
+список полей Block B и сырую числовую матрицу: flow-analyze переписывает
+ThreatScore у тех же Id) + session_version (если задан) +
+STORE_FORMAT_VERSION. Хеш содержимого требует собрать числовую матрицу
+и при попадании в кеш (~0.9 с на 100k flows × 40 полей — около половины
+полного построения блоков); коды A и флаги C берутся из полей захвата,
+которые для данного Id не меняются. Новый fingerprint пишется в
+отдельный каталог (временный + os.replace), старые каталоги сессии
+удаляются. На диске хранится не больше MAX_STORED_SESSIONS сессий —
+давно не использованные (по mtime каталога) вытесняются при записи.
+"""
+
+import json
+import os
+import shutil
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+STORE_FORMAT_VERSION = 1
+DEFAULT_STORE_DIR = os.environ.get('IDS_SIMILARITY_STORE') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'models', 'similarity_store')
+MAX_WARM_SESSIONS = 8
+MAX_STORED_SESSIONS = int(os.environ.get('IDS_SIMILARITY_STORE_SESSIONS') or 64)
+
+_BLOCK_ARRAYS = ('A', 'B', 'B_sq', 'C')
+
+_WARM: 'OrderedDict[tuple, Dict]' = OrderedDict()
+_LOCK = threading.Lock()
+
+
+def session_fingerprint(flows: List[Dict], session_version=None, content=()) -> str:
+    """
+    n + CRC32 Id flows (порядок важен: строка блока = позиция flow) +
+    CRC32 content — строк и массивов, из которых строятся блоки.
+    """
+    ids = np.array([int(f.get('Id') or 0) for f in flows], dtype=np.int64)
+    crc = 0
+    for part in content:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        else:
+            part = np.ascontiguousarray(part).tobytes()
+        crc = zlib.crc32(part, crc)
+    fingerprint = (f"n{len(flows)}-{zlib.crc32(ids.tobytes()):08x}-c{crc:08x}"
+                   f"-f{STORE_FORMAT_VERSION}")
+    if session_version is not None:
+        fingerprint += f"-v{session_version}"
+    return fingerprint
+
+
+def load_or_build(session_id, flows: List[Dict], build: Callable[[], Dict],
+                  session_version=None, store_dir: Optional[str] = None, content=()):
+    """
+    Блоки сессии: из памяти процесса, с диска или build() (с записью на
+    диск). content — см. session_fingerprint. Возвращает (blocks, source),
+    source — 'memory' / 'disk' / 'built'.
+    """
+    store_dir = os.path.abspath(store_dir or DEFAULT_STORE_DIR)
+    fingerprint = session_fingerprint(flows, session_version, content)
+    key = (store_dir, str(session_id))
+
+    with _LOCK:
+        warm = _WARM.get(key)
+        if warm is not None and warm['fingerprint'] == fingerprint:
+            _WARM.move_to_end(key)
+            return warm['blocks'], 'memory'
+
+    session_dir = os.path.join(store_dir, str(session_id))
+    path = os.path.join(session_dir, fingerprint)
+    blocks = _read(path)
+    source = 'disk'
+    if blocks is None:
+        blocks = build()
+        try:
+            _write(session_dir, fingerprint, blocks)
+            _evict(store_dir, keep=session_dir)
+        except OSError as e:
+            print(f"[SimilarityStore] Не удалось сохранить сессию {session_id}: {e}")
+        source = 'built'
+    else:
+        _touch(session_dir)
+
+    with _LOCK:
+        _WARM[key] = {'fingerprint': fingerprint, 'blocks': blocks}
+        _WARM.move_to_end(key)
+        while len(_WARM) > MAX_WARM_SESSIONS:
+            _WARM.popitem(last=False)
+    return blocks, source
+
+
+def invalidate(session_id, store_dir: Optional[str] = None):
+    """Удаляет сессию из памяти и с диска (например, после пересчёта flows)."""
+    store_dir = os.path.abspath(store_dir or DEFAULT_STORE_DIR)
+    with _LOCK:
+        _WARM.pop((store_dir, str(session_id)), None)
+    shutil.rmtree(os.path.join(store_dir, str(session_id)), ignore_errors=True)
+
+
+def _touch(session_dir: str):
+    """mtime каталога сессии = время последнего использования (для _evict)."""
+    try:
+        os.utime(session_dir)
+    except OSError:
+        pass
+
+
+def _evict(store_dir: str, keep: str):
+    """Удаляет с диска давно не использованные сессии сверх MAX_STORED_SESSIONS."""
+    sessions = []
+    for name in os.listdir(store_dir):
+        path = os.path.join(store_dir, name)
+        if name.startswith('.') or path == keep or not os.path.isdir(path):
+            continue
+        try:
+            sessions.append((os.stat(path).st_mtime, name, path))
+        except OSError:
+            continue
+    sessions.sort()
+    for _, name, path in sessions[:max(0, len(sessions) + 1 - MAX_STORED_SESSIONS)]:
+        with _LOCK:
+            _WARM.pop((store_dir, name), None)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _read(path: str) -> Optional[Dict]:
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        blocks = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in _BLOCK_ARRAYS}
+    except (OSError, ValueError) as e:
+        print(f"[SimilarityStore] Повреждён кеш {path}: {e} — пересчёт")
+        return None
+    blocks['numeric_fields'] = meta['numeric_fields']
+    return blocks
+
+
+def _write(session_dir: str, fingerprint: str, blocks: Dict):
+    """Пишет во временный каталог, переименовывает целиком, чистит старые версии."""
+    os.makedirs(session_dir, exist_ok=True)
+    final = os.path.join(session_dir, fingerprint)
+    tmp = os.path.join(session_dir, f".{fingerprint}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(tmp)
+    try:
+        for name in _BLOCK_ARRAYS:
+            np.save(os.path.join(tmp, name + '.npy'), blocks[name])
+        with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'numeric_fields': blocks['numeric_fields'],
+                       'rows': int(blocks['B'].shape[0]),
+                       'fingerprint': fingerprint}, f, ensure_ascii=False)
+        os.replace(tmp, final)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(final, 'meta.json')):
+            raise
+        return   # параллельный вызов уже записал ту же версию
+
+    for name in os.listdir(session_dir):
+        if name != fingerprint and not name.startswith('.'):
+            shutil.rmtree(os.path.join(session_dir, name), ignore_errors=True)
@@ -22,6 +22,7 @@ Pipeline с поддержкой двух моделей: Random Forest или C
     python train_hybrid_model.py                              # RF (default)
     python train_hybrid_model.py --model_type catboost        # CatBoost
     python train_hybrid_model.py --model_type rf --fs_method rank_avg
+    python train_hybrid_model.py --skip_train --eval_cascade    # каскад на hold-out
 
 Feature selection остаётся общим (силуэт + RF importance + пересечение),
 обучение расходится по типу модели в конце.
@@ -30,6 +31,7 @@ Feature selection остаётся общим (силуэт + RF importance + п
 import os
 import sys
 import glob
+import time
 import argparse
 import json
 import numpy as np
@@ -218,17 +220,29 @@ def method_silhouette_only(sil_top, target):
 # =============================================================
 # TRAIN: DISPATCH ПО ТИПУ МОДЕЛИ
 # =============================================================
-def train_final(df, features, model_type):
-    print(f"\n[train] Обучение {model_type.upper()} на {len(df):,} строках, "
-          f"{len(features)} признаках")
-    print(f"[train] Признаки: {features}")
+def load_model(model_type, model_path):
+    # Импортируем нужный класс только когда надо
+    if model_type == 'catboost':
+        from catboost_ids import CatBoostIDS
+        return CatBoostIDS.load(model_path)
+    from hybrid_ids import HybridIDS
+    return HybridIDS.load(model_path)
 
+
+def split_holdout(df, features):
+    """Фиксированный split 80/20 — один и тот же для обучения и оценки."""
     X = df[features].values.astype(float)
     X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
     y = df['Label'].values.astype(int)
+    return train_test_split(X, y, test_size=0.2, stratify=y, random_state=42)
+
 
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=0.2, stratify=y, random_state=42)
+def train_final(df, features, model_type):
+    print(f"\n[train] Обучение {model_type.upper()} на {len(df):,} строках, "
+          f"{len(features)} признаках")
+    print(f"[train] Признаки: {features}")
+
+    X_train, X_test, y_train, y_test = split_holdout(df, features)
     print(f"[train] Train: {X_train.shape}, Test: {X_test.shape}")
 
     # Импортируем нужный класс только когда надо
@@ -241,13 +255,9 @@ def train_final(df, features, model_type):
 
     model.train(X_train, y_train, feature_names=features)
 
-    # Оценка
-    X_test_scaled = model.scaler.transform(X_test)
-    if model_type == 'catboost':
-        y_pred = model.supervised.predict(X_test_scaled).flatten().astype(int)
-    else:
-        y_pred = model.supervised.predict(X_test_scaled)
-    y_proba = model.supervised.predict_proba(X_test_scaled)[:, 1]
+    # Оценка (каждая модель сама решает, скейлить ли вход supervised-части)
+    y_proba = model.predict_proba_supervised(X_test)
+    y_pred = (y_proba > 0.5).astype(int)
 
     acc = accuracy_score(y_test, y_pred)
     f1 = f1_score(y_test, y_pred)
@@ -272,6 +282,61 @@ def train_final(df, features, model_type):
     }
 
 
+# =============================================================
+# КАСКАД: СКОРОСТЬ vs ТОЧНОСТЬ НА HOLD-OUT
+# =============================================================
+def evaluate_cascade(model, X_test, y_test, first_stage_trees, low, high,
+                     anomaly_on_all=False, repeats=3):
+    """
+    Сравнивает полный инференс и каскад (configure_cascade) на hold-out:
+    время (лучшее из repeats), F1 supervised-части и гибридного решения
+    (supervised OR anomaly), доля строк, решённых первой ступенью.
+    """
+    def timed_predict():
+        best, out = float('inf'), None
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            out = model._predict_raw(X_test)
+            best = min(best, time.perf_counter() - t0)
+        return out, best
+
+    model.disable_cascade()
+    (full_pred, _, full_if, _), t_full = timed_predict()
+
+    model.configure_cascade(first_stage_trees, low, high, anomaly_on_all)
+    (casc_pred, _, casc_if, stages), t_casc = timed_predict()
+    model.disable_cascade()
+
+    full_hybrid = (full_pred == 1) | (full_if == -1)
+    casc_hybrid = (casc_pred == 1) | (casc_if == -1)
+    result = {
+        'first_stage_trees': int(first_stage_trees),
+        'low': float(low),
+        'high': float(high),
+        'anomaly_on_all': bool(anomaly_on_all),
+        'rows': int(len(y_test)),
+        'stage1_ratio': float(np.mean(stages == 1)),
+        'full_seconds': float(t_full),
+        'cascade_seconds': float(t_casc),
+        'speedup': float(t_full / t_casc) if t_casc > 0 else None,
+        'f1_supervised_full': float(f1_score(y_test, full_pred)),
+        'f1_supervised_cascade': float(f1_score(y_test, casc_pred)),
+        'f1_hybrid_full': float(f1_score(y_test, full_hybrid)),
+        'f1_hybrid_cascade': float(f1_score(y_test, casc_hybrid)),
+        'agreement_supervised': float(np.mean(full_pred == casc_pred)),
+    }
+
+    print(f"\n[cascade] first_stage={first_stage_trees}, band=({low}, {high})")
+    print(f"[cascade] Решено первой ступенью: {result['stage1_ratio']:.2%}")
+    print(f"[cascade] Время: full={t_full:.3f}s, cascade={t_casc:.3f}s, "
+          f"speedup={result['speedup']:.2f}x")
+    print(f"[cascade] F1 supervised: {result['f1_supervised_full']:.4f} -> "
+          f"{result['f1_supervised_cascade']:.4f}")
+    print(f"[cascade] F1 hybrid:     {result['f1_hybrid_full']:.4f} -> "
+          f"{result['f1_hybrid_cascade']:.4f}")
+    return result
+
+
 # =============================================================
 # MAIN
 # =============================================================
@@ -289,6 +354,14 @@ def main():
     parser.add_argument('--fs_method',
                         choices=['intersection', 'rank_avg', 'silhouette_only'],
                         default='intersection')
+    parser.add_argument('--eval_cascade', action='store_true',
+                        help='Оценить каскадный инференс на hold-out')
+    parser.add_argument('--skip_train', action='store_true',
+                        help='Не обучать: загрузить --model_path и только оценить '
+                             '(вместе с --eval_cascade)')
+    parser.add_argument('--cascade_trees', type=int, default=20)
+    parser.add_argument('--cascade_low', type=float, default=0.1)
+    parser.add_argument('--cascade_high', type=float, default=0.9)
     args = parser.parse_args()
 
     # Авто-определение путей если не заданы
@@ -304,6 +377,14 @@ def main():
     df = load_cicids(args.data_dir)
     df = clean_data(df)
 
+    if args.skip_train:
+        model = load_model(args.model_type, args.model_path)
+        if args.eval_cascade:
+            _, X_test, _, y_test = split_holdout(df, model.feature_names)
+            evaluate_cascade(model, X_test, y_test, args.cascade_trees,
+                             args.cascade_low, args.cascade_high)
+        return
+
     sil_top, sil_ranking = fs_silhouette(df, args.sample_fs, args.top_prefilter)
     rf_top, rf_importances = fs_rf_importance(df, args.sample_rf, args.top_prefilter)
 
@@ -322,6 +403,12 @@ def main():
 
     model, metrics = train_final(df, final_features, args.model_type)
 
+    if args.eval_cascade:
+        _, X_test, _, y_test = split_holdout(df, final_features)
+        metrics['cascade'] = evaluate_cascade(
+            model, X_test, y_test, args.cascade_trees,
+            args.cascade_low, args.cascade_high)
+
     metrics['feature_selection'] = {
         'method': args.fs_method,
         'silhouette_top': sil_top,
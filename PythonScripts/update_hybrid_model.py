@@ -0,0 +1,139 @@
+"""
+PythonScripts/update_hybrid_model.py
+
+Быстрое дообучение HybridIDS на новых размеченных flows (метки,
+подтверждённые аналитиком) — минуты вместо часов полного
+train_hybrid_model.py на 2.8M строк CICIDS.
+
+Что делает (см. HybridIDS.update):
+  1. Добавляет --new_trees деревьев в RF через warm_start, обученных
+     на новых flows; с --max_trees отбрасывает самые старые деревья.
+  2. Кладёт нормальные flows в резервуар и переобучает на нём IsolationForest.
+     У моделей, обученных до появления резервуара, в нём нет обучающей
+     нормы — IF не трогается, пока не передан --refit_if_unseeded.
+  3. Увеличивает revision артефакта и пересохраняет .pkl + global_features.json
+     (дополнительные ключи JSON — features_by_block и т.п. — сохраняются).
+
+CSV: столбцы признаков (имена CICIDS или PascalCase, как при обучении)
+и Label — 0/1 или строка (BENIGN -> 0, остальное -> 1).
+
+Запуск:
+    cd PythonScripts
+    python update_hybrid_model.py --labeled data/labeled/confirmed_2024-05.csv
+    python update_hybrid_model.py --labeled "data/labeled/*.csv" --new_trees 30 --max_trees 300
+"""
+
+import os
+import sys
+import glob
+import argparse
+import json
+import numpy as np
+import pandas as pd
+
+from sklearn.metrics import f1_score, accuracy_score
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cicids_mapping import normalize_cicids_columns
+from hybrid_ids import HybridIDS, DEFAULT_RESERVOIR_SIZE
+from train_hybrid_model import model_path_for, meta_path_for
+
+
+def load_labeled(pattern: str, feature_names):
+    paths = sorted(glob.glob(pattern))
+    if not paths:
+        raise FileNotFoundError(f"Не найдены CSV по шаблону {pattern}")
+
+    dfs = []
+    for path in paths:
+        print(f"[load] Читаю: {path}")
+        dfs.append(normalize_cicids_columns(pd.read_csv(path, low_memory=False)))
+    df = pd.concat(dfs, ignore_index=True)
+
+    if 'Label' not in df.columns:
+        raise ValueError("Нет столбца Label")
+    missing = [f for f in feature_names if f not in df.columns]
+    if missing:
+        raise ValueError(f"В CSV нет признаков модели: {missing}")
+
+    labels = df['Label']
+    if pd.api.types.is_numeric_dtype(labels):
+        y = (labels.fillna(0).astype(int) != 0).astype(int).values
+    else:
+        y = labels.astype(str).str.strip().str.upper().ne('BENIGN').astype(int).values
+
+    X = df[feature_names].apply(pd.to_numeric, errors='coerce').values.astype(float)
+    X = np.nan_to_num(X, nan=0.0, posinf=0.0, neginf=0.0)
+    print(f"[load] {len(y):,} flows, атак: {int(y.sum()):,}")
+    return X, y
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--labeled', required=True,
+                        help='CSV (или glob-шаблон) с новыми размеченными flows')
+    parser.add_argument('--model_path', default=None,
+                        help='Путь к .pkl (по умолчанию — RF-модель из models/)')
+    parser.add_argument('--out_path', default=None,
+                        help='Куда сохранить (по умолчанию — поверх --model_path)')
+    parser.add_argument('--new_trees', type=int, default=20)
+    parser.add_argument('--max_trees', type=int, default=None,
+                        help='Максимум деревьев в RF; лишние старые отбрасываются')
+    parser.add_argument('--reservoir_size', type=int, default=DEFAULT_RESERVOIR_SIZE)
+    parser.add_argument('--no_refit_if', action='store_true',
+                        help='Не переобучать IsolationForest')
+    parser.add_argument('--refit_if_unseeded', action='store_true',
+                        help='Переобучать IF и для старой модели без обучающего резервуара '
+                             '(только на накопленных новых flows)')
+    args = parser.parse_args()
+
+    model_path = args.model_path or model_path_for('rf')
+    out_path = args.out_path or model_path
+    json_path = (meta_path_for('rf') if out_path == model_path_for('rf')
+                 else os.path.join(os.path.dirname(out_path), 'global_features.json'))
+
+    print("=" * 70)
+    print(f"UPDATE RF: {model_path}")
+    print("=" * 70)
+
+    model = HybridIDS.load(model_path)
+    X, y = load_labeled(args.labeled, model.feature_names)
+
+    # Насколько текущая модель ошибалась на новых метках
+    before = (model.predict_proba_supervised(X) > 0.5).astype(int)
+    print(f"[before] Accuracy на новых flows: {accuracy_score(y, before):.4f}, "
+          f"F1: {f1_score(y, before, zero_division=0):.4f}")
+
+    summary = model.update(X, y, n_new_trees=args.new_trees, max_trees=args.max_trees,
+                           refit_anomaly=not args.no_refit_if,
+                           reservoir_size=args.reservoir_size,
+                           refit_unseeded=args.refit_if_unseeded)
+    summary['f1_before'] = float(f1_score(y, before, zero_division=0))
+
+    old_meta = {}
+    if os.path.exists(json_path):
+        with open(json_path, 'r', encoding='utf-8') as f:
+            old_meta = json.load(f)
+
+    model.save(out_path, json_path=json_path, metrics=model.metrics)
+
+    # save() пишет базовую мету — возвращаем ключи, которые добавил train_hybrid_model
+    with open(json_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    for key, value in old_meta.items():
+        meta.setdefault(key, value)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2, ensure_ascii=False)
+
+    print("\n" + "=" * 70)
+    print(f"DONE: revision {summary['revision']}")
+    print("=" * 70)
+    print(f"Model:       {out_path}")
+    print(f"Trees:       {summary['trees_before']} -> {summary['trees_after']}")
+    print(f"IF refit:    {summary['anomaly_refit']} "
+          f"(резервуар {summary['reservoir_rows']:,} из {summary['reservoir_seen']:,}"
+          f"{'' if summary['reservoir_seeded'] else ', без обучающей нормы'})")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,9 @@ namespace TrafficAnalysisAPI.Services.Implementations
         private readonly string _scriptsPath;
         private readonly string _modelV2Path;
         private readonly string _catBoostModelPath;
+        private readonly string _similarityIndexPath;
+        // PythonScripts:ProfileInference — Python возвращает разбивку времени по стадиям, пишем её в лог
+        private readonly bool _profileInference;
 
         public PythonMLService(
             ILogger<PythonMLService> logger,
@@ -27,6 +30,24 @@ namespace TrafficAnalysisAPI.Services.Implementations
 
             _catBoostModelPath = configuration["PythonScripts:CatBoostModelPath"]
                 ?? Path.Combine(_scriptsPath, "models", "catboost_ids_v2.pkl");
+
+            _similarityIndexPath = configuration["PythonScripts:SimilarityIndexPath"]
+                ?? Path.Combine(_scriptsPath, "models", "similarity_index");
+
+            _profileInference = configuration.GetValue<bool>("PythonScripts:ProfileInference");
+        }
+
+        // Ответ с profile=True: {"<key>": [...], "profile": {...}} -> профиль в лог, возвращаем <key>
+        private string UnwrapProfile(string json, string key, string tag)
+        {
+            using var doc = JsonDocument.Parse(json);
+            if (doc.RootElement.ValueKind != JsonValueKind.Object ||
+                !doc.RootElement.TryGetProperty(key, out var payload))
+                return json;
+
+            if (doc.RootElement.TryGetProperty("profile", out var profile))
+                _logger.LogInformation($"[{tag}] Profile: {profile.GetRawText()}");
+            return payload.GetRawText();
         }
 
         // ============================================================
@@ -50,8 +71,12 @@ namespace TrafficAnalysisAPI.Services.Implementations
                     _logger.LogInformation(
                         $"[FlowFeatures] Sending {packets.Count} packets to Python");
 
-                    dynamic result = flowModule.build_flows_from_packets(packetsJson);
+                    dynamic result = _profileInference
+                        ? flowModule.build_flows_from_packets(packetsJson, Py.kw("profile", true))
+                        : flowModule.build_flows_from_packets(packetsJson);
                     string jsonResult = result?.ToString() ?? "[]";
+                    if (_profileInference)
+                        jsonResult = UnwrapProfile(jsonResult, "flows", "FlowFeatures");
 
                     var flows = JsonSerializer.Deserialize<List<FlowFeaturesDto>>(
                         jsonResult,
@@ -81,18 +106,16 @@ namespace TrafficAnalysisAPI.Services.Implementations
             if (flows == null || flows.Count == 0)
                 return new List<FlowMLPredictionDto>();
 
-            // Определяем какой модуль и файл использовать
-            string pyModuleName, pyClassName, pklPath;
+            // Определяем тип модели и файл
+            string pyModelType, pklPath;
             if (modelType?.ToLower() == "catboost")
             {
-                pyModuleName = "catboost_ids";
-                pyClassName = "CatBoostIDS";
+                pyModelType = "catboost";
                 pklPath = _catBoostModelPath;
             }
             else
             {
-                pyModuleName = "hybrid_ids";
-                pyClassName = "HybridIDS";
+                pyModelType = "rf";
                 pklPath = _modelV2Path;
             }
 
@@ -103,9 +126,9 @@ namespace TrafficAnalysisAPI.Services.Implementations
                     dynamic sys = Py.Import("sys");
                     sys.path.append(_scriptsPath);
 
-                    dynamic module = Py.Import(pyModuleName);
-                    dynamic modelClass = module.GetAttr(pyClassName);
-                    dynamic model = modelClass.load(pklPath);
+                    // Запрос идёт через micro-batching очередь: конкурентные
+                    // запросы склеиваются в один проход модели (см. micro_batcher.py)
+                    dynamic batcher = Py.Import("micro_batcher");
 
                     var jsonOptions = new JsonSerializerOptions
                     {
@@ -117,8 +140,12 @@ namespace TrafficAnalysisAPI.Services.Implementations
                     _logger.LogInformation(
                         $"[FlowML-{modelType}] Отправка {flows.Count} flows");
 
-                    dynamic resultPy = model.predict_batch(flowsJson);
+                    dynamic resultPy = _profileInference
+                        ? batcher.predict_batch(pyModelType, pklPath, flowsJson, Py.kw("profile", true))
+                        : batcher.predict_batch(pyModelType, pklPath, flowsJson);
                     string resultJson = resultPy?.ToString() ?? "[]";
+                    if (_profileInference)
+                        resultJson = UnwrapProfile(resultJson, "predictions", $"FlowML-{modelType}");
 
                     var rawList = JsonSerializer.Deserialize<List<FlowMLPredictionDto>>(
                         resultJson,
@@ -145,6 +172,113 @@ namespace TrafficAnalysisAPI.Services.Implementations
             }
         }
 
+        // ============================================================
+        //  PREDICT COMPARE (RF + CatBoost за один проход)
+        // ============================================================
+        public JointPredictionResultDto PredictCompare(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows)
+        {
+            if (flows == null || flows.Count == 0)
+                return new JointPredictionResultDto();
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic compareModule = Py.Import("model_compare");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    _logger.LogInformation(
+                        $"[FlowML-compare] Отправка {flows.Count} flows");
+
+                    dynamic resultPy = compareModule.predict_compare(
+                        _modelV2Path, _catBoostModelPath, flowsJson);
+                    string resultJson = resultPy?.ToString() ?? "{}";
+
+                    var result = JsonSerializer.Deserialize<JointPredictionResultDto>(
+                        resultJson,
+                        new JsonSerializerOptions { PropertyNameCaseInsensitive = true }
+                    ) ?? new JointPredictionResultDto();
+
+                    // Заполняем FlowId по порядку
+                    for (int i = 0; i < flows.Count; i++)
+                    {
+                        if (i < result.Rf.Count) result.Rf[i].FlowId = flows[i].Id;
+                        if (i < result.CatBoost.Count) result.CatBoost[i].FlowId = flows[i].Id;
+                    }
+
+                    _logger.LogInformation(
+                        $"[FlowML-compare] Получено {result.Rf.Count}/{result.CatBoost.Count} " +
+                        $"предсказаний, sharedPreprocessing={result.SharedPreprocessing}");
+                    return result;
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[FlowML-compare] Python error");
+                throw new Exception(
+                    $"ML compare failed: {ex.Message}. " +
+                    "Проверьте что обе модели обучены.");
+            }
+        }
+
+        // ============================================================
+        //  EXPLAIN FLOWS (вклады признаков для подозрительных flows)
+        // ============================================================
+        public string ExplainFlows(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            string modelType = "rf",
+            double threshold = 0.5,
+            int topK = 10)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"explanations\":[]}";
+
+            bool isCatBoost = modelType?.ToLower() == "catboost";
+            string pklPath = isCatBoost ? _catBoostModelPath : _modelV2Path;
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    _logger.LogInformation(
+                        $"[Explain-{modelType}] {flows.Count} flows, threshold={threshold}, topK={topK}");
+
+                    // Модель берётся из того же модульного кеша, что и для predict
+                    dynamic module = Py.Import(isCatBoost ? "catboost_ids" : "hybrid_ids");
+                    dynamic model = isCatBoost
+                        ? module.CatBoostIDS.load(pklPath)
+                        : module.HybridIDS.load(pklPath);
+                    dynamic resultPy = model.explain_batch(flowsJson, threshold, topK);
+                    return resultPy?.ToString() ?? "{\"explanations\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, $"[Explain-{modelType}] Python error");
+                throw new Exception($"Explanation failed ({modelType}): {ex.Message}");
+            }
+        }
+
         // ============================================================
         //  FIND SIMILAR FLOWS (режим 1, Этап 6)
         // ============================================================
@@ -152,7 +286,8 @@ namespace TrafficAnalysisAPI.Services.Implementations
             List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
             int targetFlowId,
             double w1, double w2, double w3,
-            int k = 10)
+            int k = 10,
+            int? sessionId = null)
         {
             if (flows == null || flows.Count == 0)
                 return "{\"error\":\"Empty flows\",\"results\":[]}";
@@ -177,8 +312,11 @@ namespace TrafficAnalysisAPI.Services.Implementations
                         $"[Similarity] Finding similar to flow #{targetFlowId} " +
                         $"in {flows.Count} flows (w1={w1}, w2={w2}, w3={w3}, k={k})");
 
+                    // С ProfileInference ответ дополняется ключом "profile" (остальные поля те же).
+                    // session_id — блоки A/B/C сессии берутся из кеша similarity_store
                     dynamic resultPy = simModule.find_similar_flows(
-                        flowsJson, targetFlowId, w1, w2, w3, k);
+                        flowsJson, targetFlowId, w1, w2, w3, k,
+                        Py.kw("profile", _profileInference, "session_id", sessionId));
                     return resultPy?.ToString() ?? "{\"results\":[]}";
                 }
             }
@@ -189,6 +327,50 @@ namespace TrafficAnalysisAPI.Services.Implementations
             }
         }
 
+        public string FindSimilarFlowsMulti(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            List<int> targetFlowIds,
+            double w1, double w2, double w3,
+            int k = 10,
+            int? sessionId = null)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"error\":\"Empty flows\",\"targets\":[]}";
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic simModule = Py.Import("similarity");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+                    string targetsJson = JsonSerializer.Serialize(targetFlowIds);
+
+                    _logger.LogInformation(
+                        $"[Similarity] Finding similar to {targetFlowIds.Count} targets " +
+                        $"in {flows.Count} flows (w1={w1}, w2={w2}, w3={w3}, k={k})");
+
+                    dynamic resultPy = simModule.find_similar_flows_multi(
+                        flowsJson, targetsJson, w1, w2, w3, k,
+                        Py.kw("profile", _profileInference, "session_id", sessionId));
+                    return resultPy?.ToString() ?? "{\"targets\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[Similarity] Python error in FindSimilarFlowsMulti");
+                throw new Exception($"Similarity calculation failed: {ex.Message}");
+            }
+        }
+
         // ============================================================
         //  kNN CLASSIFY (режим 2, Этап 6)
         // ============================================================
@@ -196,7 +378,8 @@ namespace TrafficAnalysisAPI.Services.Implementations
             List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
             Dictionary<int, bool> labelsByFlowId,
             double w1, double w2, double w3,
-            int k = 5)
+            int k = 5,
+            int? sessionId = null)
         {
             if (flows == null || flows.Count == 0)
                 return "{\"error\":\"Empty flows\",\"predictions\":[]}";
@@ -227,7 +410,8 @@ namespace TrafficAnalysisAPI.Services.Implementations
                         $"(w1={w1}, w2={w2}, w3={w3}, k={k})");
 
                     dynamic resultPy = simModule.knn_classify_flows(
-                        flowsJson, labelsJson, w1, w2, w3, k);
+                        flowsJson, labelsJson, w1, w2, w3, k,
+                        Py.kw("profile", _profileInference, "session_id", sessionId));
                     return resultPy?.ToString() ?? "{\"predictions\":[]}";
                 }
             }
@@ -237,5 +421,317 @@ namespace TrafficAnalysisAPI.Services.Implementations
                 throw new Exception($"kNN classification failed: {ex.Message}");
             }
         }
+
+        public string KnnClassifyIncremental(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool> labelsByFlowId,
+            double w1, double w2, double w3,
+            int k,
+            int sessionId,
+            bool refresh = false,
+            bool isDelta = false)
+        {
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic incModule = Py.Import("similarity_incremental");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows ?? new List<TrafficAnalysisAPI.Models.FlowMetrics>(), jsonOptions);
+
+                    var labelsStr = labelsByFlowId
+                        .ToDictionary(kv => kv.Key.ToString(), kv => kv.Value);
+                    string labelsJson = JsonSerializer.Serialize(labelsStr);
+
+                    _logger.LogInformation(
+                        $"[kNN-Sim] Incremental update of session {sessionId}: {flows?.Count ?? 0} flows " +
+                        $"(w1={w1}, w2={w2}, w3={w3}, k={k}, refresh={refresh}, isDelta={isDelta})");
+
+                    dynamic resultPy = incModule.knn_classify_incremental(
+                        flowsJson, labelsJson, w1, w2, w3, k,
+                        Py.kw("session_id", sessionId, "refresh", refresh,
+                              "is_delta", isDelta, "profile", _profileInference));
+                    return resultPy?.ToString() ?? "{\"predictions\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] Python error in KnnClassifyIncremental");
+                throw new Exception($"Incremental kNN classification failed: {ex.Message}");
+            }
+        }
+
+        public string SweepWeights(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool> labelsByFlowId,
+            List<int> kValues,
+            double gridStep = 0.1,
+            int? sessionId = null)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"error\":\"Empty flows\",\"results\":[]}";
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic simModule = Py.Import("similarity");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    var labelsStr = labelsByFlowId
+                        .ToDictionary(kv => kv.Key.ToString(), kv => kv.Value);
+                    string labelsJson = JsonSerializer.Serialize(labelsStr);
+                    string kValuesJson = JsonSerializer.Serialize(kValues);
+
+                    _logger.LogInformation(
+                        $"[kNN-Sim] Weight sweep over {flows.Count} flows " +
+                        $"(gridStep={gridStep}, k=[{string.Join(",", kValues)}])");
+
+                    dynamic resultPy = simModule.sweep_weights(
+                        flowsJson, labelsJson, null, kValuesJson, gridStep,
+                        Py.kw("profile", _profileInference, "session_id", sessionId));
+                    return resultPy?.ToString() ?? "{\"results\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] Python error in SweepWeights");
+                throw new Exception($"Weight sweep failed: {ex.Message}");
+            }
+        }
+
+        public string BuildPrototypes(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool> labelsByFlowId,
+            double w1, double w2, double w3,
+            string name,
+            string method = "kmedoids",
+            int perClass = 50,
+            int k = 1)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"error\":\"Empty flows\"}";
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic protoModule = Py.Import("similarity_prototypes");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    var labelsStr = labelsByFlowId
+                        .ToDictionary(kv => kv.Key.ToString(), kv => kv.Value);
+                    string labelsJson = JsonSerializer.Serialize(labelsStr);
+
+                    _logger.LogInformation(
+                        $"[kNN-Sim] Building prototypes '{name}' ({method}) from {flows.Count} flows " +
+                        $"(w1={w1}, w2={w2}, w3={w3}, perClass={perClass}, k={k})");
+
+                    dynamic resultPy = protoModule.build_prototypes(
+                        flowsJson, labelsJson, w1, w2, w3,
+                        Py.kw("name", name, "method", method, "per_class", perClass, "k", k,
+                              "profile", _profileInference));
+                    return resultPy?.ToString() ?? "{}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] Python error in BuildPrototypes");
+                throw new Exception($"Prototype selection failed: {ex.Message}");
+            }
+        }
+
+        public string ClassifyWithPrototypes(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            string name,
+            Dictionary<int, bool>? labelsByFlowId = null)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"error\":\"Empty flows\",\"predictions\":[]}";
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic protoModule = Py.Import("similarity_prototypes");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    string? labelsJson = labelsByFlowId == null ? null : JsonSerializer.Serialize(
+                        labelsByFlowId.ToDictionary(kv => kv.Key.ToString(), kv => kv.Value));
+
+                    _logger.LogInformation(
+                        $"[kNN-Sim] Classifying {flows.Count} flows by prototypes '{name}'");
+
+                    dynamic resultPy = protoModule.classify_with_prototypes(
+                        flowsJson, name,
+                        Py.kw("labels_json", labelsJson, "profile", _profileInference));
+                    return resultPy?.ToString() ?? "{\"predictions\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] Python error in ClassifyWithPrototypes");
+                throw new Exception($"Prototype classification failed: {ex.Message}");
+            }
+        }
+
+        public string ClusterSimilarityGraph(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool>? labelsByFlowId,
+            double w1, double w2, double w3,
+            int k = 10,
+            double tau = 0.75,
+            string method = "louvain",
+            string edges = "auto",
+            int? sessionId = null)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"error\":\"Empty flows\",\"clusters\":[]}";
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic graphModule = Py.Import("similarity_graph");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    string? labelsJson = labelsByFlowId == null ? null : JsonSerializer.Serialize(
+                        labelsByFlowId.ToDictionary(kv => kv.Key.ToString(), kv => kv.Value));
+
+                    _logger.LogInformation(
+                        $"[kNN-Sim] Clustering {flows.Count} flows by similarity graph " +
+                        $"(w1={w1}, w2={w2}, w3={w3}, k={k}, tau={tau}, method={method}, edges={edges})");
+
+                    dynamic resultPy = graphModule.cluster_flows(
+                        flowsJson, w1, w2, w3,
+                        Py.kw("k", k, "tau", tau, "method", method, "edges", edges,
+                              "labels_json", labelsJson, "profile", _profileInference,
+                              "session_id", sessionId));
+                    return resultPy?.ToString() ?? "{\"clusters\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[kNN-Sim] Python error in ClusterSimilarityGraph");
+                throw new Exception($"Similarity graph clustering failed: {ex.Message}");
+            }
+        }
+
+        // ============================================================
+        //  ИНДЕКС СХОДСТВА ПО ВСЕМ СЕССИЯМ
+        // ============================================================
+        public string IndexSessionFlows(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            int sessionId)
+        {
+            if (flows == null || flows.Count == 0)
+                return "{\"rows\":0}";
+
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic indexModule = Py.Import("similarity_index");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string flowsJson = JsonSerializer.Serialize(flows, jsonOptions);
+
+                    _logger.LogInformation(
+                        $"[SimilarityIndex] Indexing session #{sessionId}: {flows.Count} flows");
+
+                    dynamic resultPy = indexModule.index_session(_similarityIndexPath, flowsJson, sessionId);
+                    return resultPy?.ToString() ?? "{\"rows\":0}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[SimilarityIndex] Python error in IndexSessionFlows");
+                throw new Exception($"Similarity index update failed: {ex.Message}");
+            }
+        }
+
+        public string FindSimilarInIndex(
+            TrafficAnalysisAPI.Models.FlowMetrics target,
+            double w1, double w2, double w3,
+            int k = 10)
+        {
+            try
+            {
+                using (Py.GIL())
+                {
+                    dynamic sys = Py.Import("sys");
+                    sys.path.append(_scriptsPath);
+
+                    dynamic indexModule = Py.Import("similarity_index");
+
+                    var jsonOptions = new JsonSerializerOptions
+                    {
+                        PropertyNamingPolicy = null,
+                        ReferenceHandler = System.Text.Json.Serialization.ReferenceHandler.IgnoreCycles,
+                    };
+                    string targetJson = JsonSerializer.Serialize(target, jsonOptions);
+
+                    dynamic resultPy = indexModule.query_index(
+                        _similarityIndexPath, targetJson, w1, w2, w3, k);
+                    return resultPy?.ToString() ?? "{\"results\":[]}";
+                }
+            }
+            catch (PythonException ex)
+            {
+                _logger.LogError(ex, "[SimilarityIndex] Python error in FindSimilarInIndex");
+                throw new Exception($"Similarity index query failed: {ex.Message}");
+            }
+        }
     }
 }
@@ -27,14 +27,45 @@ namespace TrafficAnalysisAPI.Services.Interfaces
             string modelType = "rf");
 
 
+        /// Предсказания RF и CatBoost за один вызов Python (model_compare.py):
+        /// матрица признаков, скейлинг и Isolation Forest считаются один раз.
+        JointPredictionResultDto PredictCompare(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows);
+
+
+        /// Объяснения (вклады признаков) для flows с вероятностью атаки >= threshold:
+        ///   "rf"       — TreeSHAP / разложение по путям деревьев, в вероятности
+        ///   "catboost" — SHAP-значения CatBoost, в логите
+        /// Возвращает JSON-строку: method, outputSpace, explainedRows, explanations.
+        string ExplainFlows(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            string modelType = "rf",
+            double threshold = 0.5,
+            int topK = 10);
+
+
         /// Режим 1: Поиск k flows наиболее похожих на target по формуле:
         ///   Sim = w1·Sim_port + w2·Sim_num + w3·Sim_bin
         /// Возвращает JSON-строку с targetFlow, weights, blocks, results.
+        /// sessionId (здесь и в kNN/sweep) — ключ кеша блоков A/B/C
+        /// (similarity_store.py): повторные вызовы по сессии не пересчитывают их.
         string FindSimilarFlows(
             List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
             int targetFlowId,
             double w1, double w2, double w3,
-            int k = 10);
+            int k = 10,
+            int? sessionId = null);
+
+
+        /// Режим 1 для нескольких target сразу (например, кластер алертов):
+        /// блоки считаются один раз. JSON: targets[{targetFlow, results}],
+        /// missingTargetIds, weights, blocks.
+        string FindSimilarFlowsMulti(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            List<int> targetFlowIds,
+            double w1, double w2, double w3,
+            int k = 10,
+            int? sessionId = null);
 
 
         /// Режим 2: kNN-классификация всех flows на основе меры сходства.
@@ -46,6 +77,90 @@ namespace TrafficAnalysisAPI.Services.Interfaces
             List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
             Dictionary<int, bool> labelsByFlowId,
             double w1, double w2, double w3,
-            int k = 5);
+            int k = 5,
+            int? sessionId = null);
+
+
+        /// kNN-классификация с дозаписью flows в сессию
+        /// (similarity_incremental.py): считаются только пары с новыми
+        /// flows, в ответе — предсказания изменившихся flows. Уже известные
+        /// Python flows пропускаются. isDelta=true — переданы только новые
+        /// flows: если Python не помнит сессию (перезапуск процесса,
+        /// вытеснение из кеша сессий), ответ — {"error": "sessionStateMissing"},
+        /// и вызывающий должен повторить вызов со всей сессией (isDelta=false).
+        string KnnClassifyIncremental(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool> labelsByFlowId,
+            double w1, double w2, double w3,
+            int k,
+            int sessionId,
+            bool refresh = false,
+            bool isDelta = false);
+
+
+        /// Подбор весов kNN: agreement/precision/recall/F1 для каждой точки
+        /// симплекса w1+w2+w3=1 (шаг gridStep) и каждого k из kValues за
+        /// один проход — компоненты сходства считаются один раз.
+        string SweepWeights(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool> labelsByFlowId,
+            List<int> kValues,
+            double gridStep = 0.1,
+            int? sessionId = null);
+
+
+        /// Отбирает прототипы kNN (similarity_prototypes.py) по размеченным
+        /// flows: k-medoids ("kmedoids", perClass на класс) или condensed
+        /// nearest neighbour ("cnn"), сохраняет набор под именем name.
+        /// В ответе — сравнение с полным kNN на тех же flows.
+        string BuildPrototypes(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool> labelsByFlowId,
+            double w1, double w2, double w3,
+            string name,
+            string method = "kmedoids",
+            int perClass = 50,
+            int k = 1);
+
+
+        /// kNN-классификация flows только по сохранённым прототипам
+        /// (O(n·p) вместо O(n²)). labelsByFlowId — необязательно, для
+        /// agreementWithOriginal.
+        string ClassifyWithPrototypes(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            string name,
+            Dictionary<int, bool>? labelsByFlowId = null);
+
+
+        /// Кластеры flows по разреженному графу сходства
+        /// (similarity_graph.py): рёбра — k ближайших соседей с sim ≥ tau,
+        /// кластеры — компоненты связности ("components") или сообщества
+        /// Louvain ("louvain"). edges: "auto" / "exact" / "lsh".
+        /// В ответе — clusterId каждого flow и доля атак по кластерам.
+        string ClusterSimilarityGraph(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            Dictionary<int, bool>? labelsByFlowId,
+            double w1, double w2, double w3,
+            int k = 10,
+            double tau = 0.75,
+            string method = "louvain",
+            string edges = "auto",
+            int? sessionId = null);
+
+
+        /// Добавляет flows сессии в персистентный индекс сходства
+        /// (similarity_index.py); повторный вызов для той же сессии
+        /// переиндексирует её. Первый вызов создаёт индекс.
+        string IndexSessionFlows(
+            List<TrafficAnalysisAPI.Models.FlowMetrics> flows,
+            int sessionId);
+
+
+        /// Поиск k flows, похожих на target, по ВСЕМ проиндексированным
+        /// сессиям (LSH-кандидаты + re-rank полной мерой Sim).
+        string FindSimilarInIndex(
+            TrafficAnalysisAPI.Models.FlowMetrics target,
+            double w1, double w2, double w3,
+            int k = 10);
     }
 }